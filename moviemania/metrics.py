@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request instrumentation of query count, database, view and render time.
+
+``MetricsMiddleware`` wraps the cursors of every database connection to
+time statements and row fetches, and splits the rest of the request into
+view time (including serialization, which DRF does in the view) and
+render time. Samples are aggregated per endpoint into fixed bucket
+latency histograms and query count distributions, so the memory used
+stays constant however many requests are served.
+
+Metrics are kept per process and exposed at ``/api/_metrics/`` to admin
+users. Set ``METRICS_SLOW_REQUEST_MS`` to log the requests slower than
+that along with their SQL.
+"""
+from __future__ import unicode_literals
+
+from collections import Counter, OrderedDict
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.urls import Resolver404, resolve
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+logger = logging.getLogger('moviemania.metrics')
+
+# upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+PERCENTILES = (50, 95, 99)
+
+# statements kept for the slow request log
+MAX_LOGGED_QUERIES = 100
+
+_local = threading.local()
+
+
+class RequestStats(object):
+
+    def __init__(self, log_queries=False):
+        self.start = time.time()
+        self.queries = 0
+        self.db_time = 0.0
+        self.view_start = self.view_end = None
+        self.render_start = None
+        self.sql = [] if log_queries else None
+
+    def add_query(self, sql, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        if self.sql is not None and len(self.sql) < MAX_LOGGED_QUERIES:
+            self.sql.append((sql, elapsed))
+
+
+class TimedCursor(object):
+    """Adds the time spent in the database to the current request stats."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def timed(self, sql, method, *args):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return method(*args)
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.time() - start
+            if sql is None:
+                stats.db_time += elapsed
+            else:
+                stats.add_query(sql, elapsed)
+
+    def execute(self, sql, params=None):
+        return self.timed(sql, self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(sql, self.cursor.executemany, sql, param_list)
+
+    # SQLite computes most rows as they are fetched
+    def fetchone(self):
+        return self.timed(None, self.cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.timed(None, self.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.timed(None, self.cursor.fetchall)
+
+
+def instrument(connection):
+    """Make every cursor of the connection a `TimedCursor`, once."""
+    if getattr(connection, 'metrics_instrumented', False):
+        return
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: TimedCursor(make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: TimedCursor(
+        make_debug_cursor(cursor))
+    connection.metrics_instrumented = True
+
+
+def percentile(counts, bounds, p):
+    """
+    The `p`th percentile of a histogram, as the upper bound of the bucket
+    it falls in.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * p / 100.0
+    seen = 0
+    for count, bound in zip(counts, bounds):
+        seen += count
+        if seen >= rank:
+            return bound
+    return bounds[-1]
+
+
+class EndpointMetrics(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = self.db_time = 0.0
+        self.view_time = self.render_time = 0.0
+        self.max_time = 0.0
+        # one more bucket for anything slower than the last bound
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.queries = Counter()
+
+    def record(self, sample):
+        self.requests += 1
+        self.errors += sample['status'] >= 500
+        self.total_time += sample['total_ms']
+        self.db_time += sample['db_ms']
+        self.view_time += sample['view_ms']
+        self.render_time += sample['render_ms']
+        self.max_time = max(self.max_time, sample['total_ms'])
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if sample['total_ms'] <= bound:
+                self.latency[i] += 1
+                break
+        else:
+            self.latency[-1] += 1
+        self.queries[sample['queries']] += 1
+
+    def as_dict(self):
+        labels = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        # the slowest request bounds the last bucket
+        bounds = list(LATENCY_BUCKETS) + [round(self.max_time, 3)]
+        query_counts = sorted(self.queries)
+        query_histogram = [self.queries[count] for count in query_counts]
+        return OrderedDict([
+            ('requests', self.requests),
+            ('errors', self.errors),
+            ('mean_ms', OrderedDict([
+                (name, round(value / self.requests, 3)) for name, value in [
+                    ('total', self.total_time), ('db', self.db_time),
+                    ('view', self.view_time), ('render', self.render_time)]
+            ])),
+            ('latency_ms', OrderedDict([
+                ('buckets', OrderedDict(zip(labels, self.latency))),
+            ] + [
+                ('p{}'.format(p), min(
+                    percentile(self.latency, bounds, p), bounds[-1]))
+                for p in PERCENTILES
+            ] + [('max', bounds[-1])])),
+            ('queries', OrderedDict([
+                ('p{}'.format(p),
+                 percentile(query_histogram, query_counts, p))
+                for p in PERCENTILES
+            ] + [('max', query_counts[-1])])),
+        ])
+
+
+class Metrics(object):
+    """Per endpoint metrics of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.since = time.time()
+
+    def record(self, endpoint, sample):
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointMetrics()
+            self.endpoints[endpoint].record(sample)
+
+    def snapshot(self):
+        with self.lock:
+            return OrderedDict([
+                ('since', self.since),
+                ('endpoints', OrderedDict(
+                    (endpoint, self.endpoints[endpoint].as_dict())
+                    for endpoint in sorted(self.endpoints))),
+            ])
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.since = time.time()
+
+
+metrics = Metrics()
+
+
+class MetricsMiddleware(object):
+    """
+    Records the metrics of each request. Put it first in `MIDDLEWARE` so
+    that responses served by other middleware are measured too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request_ms = getattr(
+            settings, 'METRICS_SLOW_REQUEST_MS', None)
+
+    def __call__(self, request):
+        for connection in connections.all():
+            instrument(connection)
+
+        stats = _local.stats = RequestStats(
+            log_queries=self.slow_request_ms is not None)
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.stats = None
+        end = time.time()
+
+        view_end = stats.view_end or stats.render_start or end
+        sample = {
+            'status': response.status_code,
+            'queries': stats.queries,
+            'total_ms': (end - stats.start) * 1000,
+            'db_ms': stats.db_time * 1000,
+            'view_ms': ((view_end - stats.view_start) * 1000
+                        if stats.view_start else 0.0),
+            'render_ms': ((end - stats.render_start) * 1000
+                          if stats.render_start else 0.0),
+        }
+        metrics.record(self.endpoint(request), sample)
+
+        if (self.slow_request_ms is not None and
+                sample['total_ms'] >= self.slow_request_ms):
+            self.log_slow_request(request, sample, stats.sql)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _local.stats.view_start = time.time()
+
+    def process_template_response(self, request, response):
+        # called once the view returned, right before rendering
+        _local.stats.view_end = _local.stats.render_start = time.time()
+        return response
+
+    def endpoint(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # answered before the URL was resolved, e.g. from the cache
+            try:
+                match = resolve(request.path_info)
+            except Resolver404:
+                return '{} <unresolved>'.format(request.method)
+        return '{} {}'.format(request.method, match.view_name)
+
+    def log_slow_request(self, request, sample, sql):
+        lines = ['{:.1f}ms {}'.format(elapsed * 1000, statement)
+                 for statement, elapsed in sql]
+        logger.warning(
+            'Slow request %s %s: %.1fms total, %.1fms db, %d queries\n%s',
+            request.method, request.get_full_path(), sample['total_ms'],
+            sample['db_ms'], sample['queries'], '\n'.join(lines))
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes((IsAdminUser,))
+def metrics_view(request):
+    """Metrics of this process, `DELETE` to reset them."""
+    if request.method == 'DELETE':
+        metrics.reset()
+    return Response(metrics.snapshot())
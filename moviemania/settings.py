@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'moviemania.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -51,6 +52,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'movies.cache.ResponseCacheMiddleware',
+    # inside the response cache, which keeps the compressed responses
+    'django.middleware.gzip.GZipMiddleware',
 ]
 
 ROOT_URLCONF = 'moviemania.urls'
@@ -81,6 +85,45 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # keep connections open between requests
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            # seconds a writer waits for the write lock
+            'timeout': 20,
+        },
+    },
+}
+
+# Read-only connections to the same database, for the reads of
+# `movies.db.ReadReplicaRouter`. Remove it to read from `default`.
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['movies.db.ReadReplicaRouter']
+
+# Applied to each new SQLite connection by `movies.db.configure_connection`.
+# WAL journaling lets readers run while a write is in progress, and the
+# page cache (in KiB when negative) and memory mapping serve reads of a
+# catalog held in memory without going through the file system.
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -64000),
+    ('mmap_size', 268435456),
+]
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+#
+# Also holds the data version and the versioned API responses of
+# `movies.cache`, which must be shared by the workers and management
+# commands writing to the database: local memory, private to each process,
+# fails the `movies.E001` check.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
     }
 }
 
@@ -133,5 +176,23 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
+    # compact JSON, with orjson when installed; the browsable API in DEBUG only
+    'DEFAULT_RENDERER_CLASSES': [
+        'movies.renderers.CompactJSONRenderer',
+    ] + (['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
     'PAGE_SIZE': 10
 }
+
+
+# Request metrics
+# Requests slower than this many milliseconds are logged, with their SQL, to
+# the `moviemania.metrics` logger. None disables the log.
+
+METRICS_SLOW_REQUEST_MS = None
+
+
+# Read model
+# Serve the movie and genre lists and the top genres by year from an in-memory
+# copy of the catalog in each process, see `movies.readmodel`.
+
+MOVIES_READ_MODEL = False
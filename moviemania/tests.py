@@ -1,13 +1,45 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import csv
 import datetime
+from decimal import Decimal
+import gzip
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
 
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.test import APIClient, APITransactionTestCase
+import numpy as np
 
 from django.contrib.auth.models import User
-from movies.models import Movie, Genre
+from moviemania.metrics import metrics
+from movies import denorm, loadtest, readmodel, renderers, search, snapshot
+from movies import urls as movies_urls
+from movies.cache import bump_data_version, check_shared_cache
+from movies.db import ReadReplicaRouter
+from movies.management.commands.benchmark import (
+    compare_results, generate_tsv)
+from movies.management.commands.loaddata_movies_genres import (
+    DATA_PATH, Command as LoadDataCommand, expand_paths, file_ranges,
+    read_range)
+from movies.models import Movie, Genre, GenreYearStat, Franchise, DataChange
+from movies.readmodel import Catalog
 
 
 class MoviesAPITestCase(TestCase):
@@ -186,6 +218,158 @@ class MoviesAPITestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data.get('count'), 6)
 
+    def test_movie_genre_boolean_filter(self):
+        action = Genre.objects.create(name='Action')
+        comedy = Genre.objects.create(name='Comedy')
+        horror = Genre.objects.create(name='Horror')
+        for title, genres in [('Helium', [action, comedy]),
+                              ('Neon', [action, comedy, horror]),
+                              ('Argon', [action]),
+                              ('Krypton', [comedy, horror]),
+                              ('Xenon', [])]:
+            Movie.objects.create(
+                title=title, release_date='2006-01-01').genres.add(*genres)
+
+        def titles(query):
+            response = self.client.get('/api/movies/?' + query, format='json')
+            self.assertEqual(response.status_code, 200)
+            return sorted(movie['title'] for movie in response.data['results'])
+
+        query = 'genres_all={}&genres_all={}&genres_none={}'.format(
+            action.id, comedy.id, horror.id)
+        self.assertEqual(titles(query), ['Helium'])
+        self.assertEqual(titles('genres={}&genres={}&genres_none={}'.format(
+            action.id, horror.id, comedy.id)), ['Argon'])
+        self.assertEqual(titles('genres_none={}&genres_none={}'.format(
+            action.id, comedy.id)), ['Xenon'])
+
+        # genres beyond the bits of the mask are filtered by their links
+        Genre.objects.filter(pk=comedy.id).update(bit=None)
+        Movie.objects.update(
+            genre_mask=F('genre_mask').bitand(~(1 << comedy.bit)))
+        cache.clear()
+        self.assertEqual(titles(query), ['Helium'])
+        self.assertEqual(titles('genres={}&genres={}'.format(
+            comedy.id, horror.id)), ['Helium', 'Krypton', 'Neon'])
+
+    def test_movie_list_queries(self):
+        another_genre = Genre.objects.create(name='Another Genre')
+        for idx in range(10):
+            m = Movie.objects.create(
+                title='Movie {}'.format(idx),
+                release_date=self.test_movie_data['release_date'])
+            m.genres.add(self.expected_genre, another_genre)
+        # count, page and genre links, whatever the page size
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/movies/', format='json')
+        self.assertEqual(response.data['results'][0]['genres'], [
+            'http://testserver/api/genres/{}/'.format(another_genre.id),
+            'http://testserver/api/genres/{}/'.format(self.expected_genre.id)])
+
+    def test_movie_sparse_fields(self):
+        for idx in range(3):
+            m = Movie.objects.create(
+                title='Movie {}'.format(idx),
+                release_date=self.test_movie_data['release_date'])
+            m.genres.add(self.expected_genre)
+        # count and page, without genre links nor unused columns
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                '/api/movies/?fields=title,release_date', format='json')
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('sequels_count', queries[1]['sql'])
+        self.assertEqual(list(response.data['results'][0]),
+                         ['title', 'release_date'])
+
+        response = self.client.get(
+            '/api/movies/?exclude=genres&cursor=', format='json')
+        self.assertEqual(list(response.data['results'][0]),
+                         ['title', 'release_date', 'sequels_count',
+                          'franchise'])
+        response = self.client.get(
+            '/api/genres/?fields=name', format='json')
+        self.assertEqual(response.data['results'],
+                         [{'name': 'Test Movie Genre'}])
+
+        response = self.client.get('/api/movies/?fields=title,budget')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'message': 'Unknown fields: budget'})
+
+    # title search
+    def test_movie_search(self):
+        another_genre = Genre.objects.create(name='Another Genre')
+        test_movies = ['The Godfather', 'The Godfather Part II',
+                       'Godfather Returns', 'The God of War', 'Amélie']
+        for idx, movie in enumerate(test_movies):
+            m = Movie.objects.create(
+                title=movie, release_date=self.test_movie_data['release_date'])
+            m.genres.add(another_genre if idx == 2 else self.expected_genre)
+
+        def titles(query):
+            response = self.client.get('/api/movies/?' + query, format='json')
+            self.assertEqual(response.status_code, 200)
+            return [movie['title'] for movie in response.data['results']]
+
+        self.assertEqual(set(titles('search=godfather')), set(test_movies[:3]))
+        self.assertEqual(titles('search=part godfather'), test_movies[1:2])
+        self.assertEqual(titles('search=amelie'), ['Amélie'])
+        self.assertEqual(set(titles('search=god*')), set(test_movies[:4]))
+        self.assertEqual(set(titles('title_prefix=the godf')),
+                         set(test_movies[:2]))
+        self.assertEqual(
+            titles('search=godfather&genres={}'.format(another_genre.id)),
+            ['Godfather Returns'])
+        self.assertEqual(titles('search=!!!'), [])
+
+        # kept in sync with writes
+        movie = Movie.objects.get(title='The God of War')
+        movie.title = 'The Godfather Saga'
+        movie.save()
+        Movie.objects.get(title='Amélie').delete()
+        self.assertEqual(set(titles('title_prefix=the godf')),
+                         set(test_movies[:2] + ['The Godfather Saga']))
+        self.assertEqual(titles('search=war'), [])
+        self.assertEqual(titles('search=amelie'), [])
+
+    # cursor pagination
+    def test_movie_cursor_pagination(self):
+        another_genre = Genre.objects.create(name='Another Genre')
+        expected = []
+        for idx in range(25):
+            # several movies share each release date
+            m = Movie.objects.create(
+                title='Movie {}'.format(idx),
+                release_date='{}-01-01'.format(2000 + idx // 4))
+            m.genres.add(self.expected_genre if idx % 3 else another_genre)
+            expected.append((m.release_date, m.id))
+        expected.sort(reverse=True)
+
+        titles, url = [], '/api/movies/?cursor='
+        while url:
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            titles.extend(movie['title'] for movie in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(
+            titles, [Movie.objects.get(id=pk).title for _, pk in expected])
+
+        # walk back from the last page
+        response = self.client.get(
+            '/api/movies/?cursor=&genres={}'.format(self.expected_genre.id),
+            format='json')
+        first_page = response.data['results']
+        self.assertEqual(len(first_page), 10)
+        response = self.client.get(response.data['next'], format='json')
+        self.assertEqual(len(response.data['results']), 6)
+        response = self.client.get(response.data['previous'], format='json')
+        self.assertEqual(response.data['results'], first_page)
+
+    def test_movie_cursor_pagination_invalid(self):
+        response = self.client.get('/api/movies/?cursor=cD1hc2Rm',
+                                   format='json')
+        self.assertEqual(response.status_code, 404)
+
     # sequels count
     def test_movie_sequels_count(self):
         test_movies = ['The Godfather', 'The Godfather Part II',
@@ -212,6 +396,62 @@ class MoviesAPITestCase(TestCase):
         data = response.data
         self.assertEqual(data.get('sequels_count'), 0)
 
+    def test_movie_sequels_count_update(self):
+        first = Movie.objects.create(
+            title='Alien', release_date=self.test_movie_data['release_date'])
+        second = Movie.objects.create(
+            title='Aliens', release_date=self.test_movie_data['release_date'])
+        self.client.force_authenticate(user=self.user)
+        response = self.client.put(
+            '/api/movies/{}/'.format(second.id),
+            {'title': 'Predator', 'release_date': '1987-01-01',
+             'genres': ['/api/genres/{}/'.format(self.expected_genre.id)]},
+            format='json')
+        self.client.force_authenticate(user=None)
+        self.assertEqual(response.status_code, 200)
+        first.refresh_from_db()
+        self.assertEqual(first.sequels_count, 0)
+        second.title = 'Alien 3'
+        second.save()
+        first.refresh_from_db()
+        self.assertEqual(first.sequels_count, 1)
+
+    def test_movie_sequels_count_delete(self):
+        first = Movie.objects.create(
+            title='Alien', release_date=self.test_movie_data['release_date'])
+        second = Movie.objects.create(
+            title='Aliens', release_date=self.test_movie_data['release_date'])
+        self.client.force_authenticate(user=self.user)
+        response = self.client.delete('/api/movies/{}/'.format(second.id))
+        self.client.force_authenticate(user=None)
+        self.assertEqual(response.status_code, 204)
+        first.refresh_from_db()
+        self.assertEqual(first.sequels_count, 0)
+
+    def test_movie_sequels_count_stale_save(self):
+        first = Movie.objects.create(
+            title='Alien', release_date=self.test_movie_data['release_date'])
+        Movie.objects.create(
+            title='Aliens', release_date=self.test_movie_data['release_date'])
+        # saving an instance loaded before the sequel keeps its count
+        first.release_date = '1980-01-01'
+        first.save()
+        first.refresh_from_db()
+        self.assertEqual(first.sequels_count, 1)
+
+    def test_movie_sequels_count_rebuild(self):
+        test_movies = ['Rocky', 'Rocky II', 'Rocky III', 'Rocky', 'Rambo']
+        for movie in test_movies:
+            Movie.objects.create(
+                title=movie, release_date=self.test_movie_data['release_date'])
+        expected = dict(Movie.objects.values_list('id', 'sequels_count'))
+        Movie.objects.update(sequels_count=0)
+        denorm.rebuild_sequels_count()
+        self.assertEqual(
+            dict(Movie.objects.values_list('id', 'sequels_count')), expected)
+        self.assertEqual(
+            Movie.objects.filter(title='Rocky').first().sequels_count, 3)
+
 
 class GenreAPITestCase(APITransactionTestCase):
     def setUp(self):
@@ -332,6 +572,102 @@ class GenreAPITestCase(APITransactionTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data.get('movie_count'), 3)
 
+    def test_genre_movie_count_maintained(self):
+        test_genre = Genre.objects.create(name='Test Genre')
+        another_genre = Genre.objects.create(name='Another Genre')
+        movies = [Movie.objects.create(title=title, release_date='2006-01-01')
+                  for title in ('Helium', 'Neon', 'Argon')]
+        test_genre.movie_set.add(*movies)
+        movies[0].genres.add(another_genre)
+        movies[1].genres.remove(test_genre)
+        movies[2].delete()
+        response = self.client.get('/api/genres/', format='json')
+        counts = {genre['name']: genre['movie_count']
+                  for genre in response.data['results']}
+        self.assertEqual(counts, {'Test Genre': 1, 'Another Genre': 1})
+        # saving an instance loaded before the changes keeps the count
+        another_genre.name = 'Other Genre'
+        another_genre.save()
+        another_genre.refresh_from_db()
+        self.assertEqual(another_genre.movie_count, 1)
+
+    def test_genre_masks_maintained(self):
+        genre = Genre.objects.create(name='Test Genre')
+        other = Genre.objects.create(name='Other Genre')
+        movies = [Movie.objects.create(title=title, release_date='2006-01-01')
+                  for title in ('Helium', 'Neon', 'Argon')]
+        movies[0].genres.add(genre, other)
+        movies[1].genres.add(other)
+        other.movie_set.add(movies[2])
+        movies[0].genres.remove(other)
+        movies[1].genres.clear()
+
+        masks = dict(Movie.objects.values_list('id', 'genre_mask'))
+        self.assertEqual(masks[movies[0].id], 1 << genre.bit)
+        self.assertEqual(masks[movies[2].id], 1 << other.bit)
+        denorm.rebuild_genre_masks()
+        self.assertEqual(
+            masks, dict(Movie.objects.values_list('id', 'genre_mask')))
+
+        # a deleted genre frees its bit for the next one
+        bit = other.bit
+        other.delete()
+        self.assertEqual(Movie.objects.get(pk=movies[2].id).genre_mask, 0)
+        self.assertEqual(Genre.objects.create(name='New Genre').bit, bit)
+
+    def test_genre_masks_freed_bit(self):
+        genres = [Genre.objects.create(name='Genre {}'.format(i))
+                  for i in range(denorm.GENRE_BITS + 2)]
+        late, later = genres[-2:]
+        self.assertEqual([late.bit, later.bit], [None, None])
+        for genre, title in [(late, 'Helium'), (later, 'Neon')]:
+            genre.movie_set.add(Movie.objects.create(
+                title=title, release_date='2006-01-01'))
+
+        # a freed bit goes to the next genre saved, or the oldest genre
+        # without one on batch writes, and to the movies they have
+        genres[0].delete()
+        late.save()
+        genres[1].delete()
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/api/genres/batch/', [
+            {'action': 'create', 'data': {'name': 'Latest'}}], format='json')
+        self.client.force_authenticate(user=None)
+        self.assertEqual(response.status_code, 200)
+        late.refresh_from_db()
+        later.refresh_from_db()
+        self.assertIsNotNone(late.bit)
+        self.assertIsNotNone(later.bit)
+
+        admin = User.objects.create_superuser(
+            username='admin', email='admin@test.com', password='top_secret')
+        self.client.force_login(admin)
+        for genre, title in [(late, 'Helium'), (later, 'Neon')]:
+            response = self.client.get(
+                '/api/movies/?genres={}'.format(genre.pk), format='json')
+            self.assertEqual([movie['title'] for movie in
+                              response.data['results']], [title])
+            response = self.client.get(
+                '/api/movies/?genres_none={}'.format(genre.pk), format='json')
+            self.assertNotIn(title, [movie['title'] for movie in
+                                     response.data['results']])
+            response = self.client.get(
+                '/admin/movies/movie/?genre={}'.format(genre.pk))
+            self.assertEqual([movie.title for movie in
+                              response.context['cl'].result_list], [title])
+
+    def test_check_genre_counts(self):
+        test_genre = Genre.objects.create(name='Test Genre')
+        movie = Movie.objects.create(title='Helium', release_date='2006-01-01')
+        movie.genres.add(test_genre)
+        Genre.objects.update(movie_count=5)
+        out = StringIO()
+        call_command('check_genre_counts', dry_run=True, stdout=out)
+        self.assertIn('stored 5, actual 1', out.getvalue())
+        self.assertEqual(Genre.objects.get().movie_count, 5)
+        call_command('check_genre_counts', stdout=out)
+        self.assertEqual(Genre.objects.get().movie_count, 1)
+
 
 class TopGenreByYearTestCase(TestCase):
 
@@ -376,3 +712,1190 @@ class TopGenreByYearTestCase(TestCase):
     def test_top_genre_by_year_bad_year_input(self):
         response = self.client.get('/api/topGenreByYear/?year=asdf', format='json')
         self.assertEqual(response.status_code, 400)
+
+    def test_top_genre_by_year_count(self):
+        response = self.client.get('/api/topGenreByYear/?year=3001', format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data,
+                         {'year': 3001, 'name': 'Wind', 'movie_count': 6})
+
+    def test_top_genre_by_years(self):
+        response = self.client.get(
+            '/api/topGenreByYear/?years=3001,1800,3000', format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(d['year'], d['name']) for d in response.data],
+                         [(3000, 'Earth'), (3001, 'Wind')])
+        response = self.client.get(
+            '/api/topGenreByYear/?year_from=2999&year_to=3001', format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([d['name'] for d in response.data],
+                         ['Earth', 'Earth', 'Wind'])
+        response = self.client.get(
+            '/api/topGenreByYear/?year_from=asdf', format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            '/api/topGenreByYear/?years=3000,[3001]', format='json')
+        self.assertEqual(response.status_code, 400)
+        # more years than fit in a query
+        response = self.client.get('/api/topGenreByYear/?years={}'.format(
+            ','.join(str(year) for year in range(1000, 2000))), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data,
+                         {'message': 'Too many years, at most 200'})
+        response = self.client.get(
+            '/api/stats/genresByYear/?years={}'.format(','.join(
+                str(year) for year in range(1000, 2000))), format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_genre_year_stats_matrix(self):
+        response = self.client.get('/api/stats/genresByYear/', format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['years'], [2999, 3000, 3001])
+        self.assertEqual(response.data['genres']['name'],
+                         ['Earth', 'Fire', 'Wind'])
+        self.assertEqual(response.data['counts'],
+                         [[3, 3, 0], [3, 3, 0], [0, 0, 6]])
+        self.assertNotIn('top', response.data)
+
+        wind = Genre.objects.get(name='Wind')
+        fire = Genre.objects.get(name='Fire')
+        response = self.client.get(
+            '/api/stats/genresByYear/?year_from=3000&genres={},{}'.format(
+                wind.pk, fire.pk), format='json')
+        self.assertEqual(response.data['years'], [3000, 3001])
+        self.assertEqual(response.data['genres']['id'], [fire.pk, wind.pk])
+        self.assertEqual(response.data['counts'], [[3, 0], [0, 6]])
+
+        for url in ['/api/stats/genresByYear/?year=asdf',
+                    '/api/stats/genresByYear/?genres=asdf',
+                    '/api/stats/genresByYear/?top=0']:
+            self.assertEqual(
+                self.client.get(url, format='json').status_code, 400)
+
+    def test_genre_year_stats_top(self):
+        # both genres tied for first place in 2999 and 3000
+        response = self.client.get(
+            '/api/stats/topGenresByYear/', format='json')
+        self.assertEqual(response.data['top'], [[0, 1], [0, 1], [2]])
+        Movie.objects.create(title='Oganesson',
+                             release_date='3000-01-01').genres.add(
+                                 Genre.objects.get(name='Fire'))
+        response = self.client.get(
+            '/api/stats/genresByYear/?top=1&years=3000,3001', format='json')
+        self.assertEqual(response.data['counts'], [[3, 4, 0], [0, 0, 6]])
+        self.assertEqual(response.data['top'], [[1], [2]])
+        response = self.client.get(
+            '/api/stats/genresByYear/?top=2&years=3000', format='json')
+        self.assertEqual(response.data['top'], [[1, 0]])
+        cache.clear()
+        with self.settings(MOVIES_READ_MODEL=True):
+            readmodel.reset()
+            self.assertEqual(self.client.get(
+                '/api/stats/genresByYear/?top=2&years=3000',
+                format='json').data, response.data)
+
+    def test_genre_year_stats_maintained(self):
+        stats = lambda: sorted(GenreYearStat.objects.values_list(
+            'year', 'genre_id', 'movie_count'))
+        wind = Genre.objects.get(name='Wind')
+        earth = Genre.objects.get(name='Earth')
+        movies = list(Movie.objects.filter(release_date__year=3000))
+        movies[0].genres.add(wind)
+        wind.movie_set.add(movies[1], movies[2])
+        movies[3].genres.remove(wind, earth)
+        movies[4].genres.clear()
+        movies[5].release_date = '2999-06-01'
+        movies[5].save()
+        movies[1].delete()
+        wind.movie_set.remove(movies[2])
+        expected = stats()
+        denorm.rebuild_genre_year_stats()
+        self.assertEqual(stats(), expected)
+
+
+class FranchiseTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.drama = Genre.objects.create(name='Drama')
+        self.horror = Genre.objects.create(name='Horror')
+        test_movies = [('The Godfather', '1972-03-24', self.drama),
+                       ('The Godfather Part II', '1974-12-20', self.drama),
+                       ('The Godfather Part III', '1990-12-25', self.drama),
+                       ('Alien', '1979-05-25', self.horror),
+                       ('Aliens', '1986-07-18', self.horror),
+                       ('Heat', '1995-12-15', self.drama)]
+        self.movies = {}
+        for title, release_date, genre in test_movies:
+            movie = Movie.objects.create(
+                title=title, release_date=release_date)
+            movie.genres.add(genre)
+            self.movies[title] = movie
+
+    def franchises(self):
+        return {franchise.title: sorted(
+            franchise.movies.values_list('title', flat=True))
+            for franchise in Franchise.objects.all()}
+
+    def test_franchises(self):
+        self.assertEqual(self.franchises(), {
+            'Alien': ['Alien', 'Aliens'],
+            'The Godfather': ['The Godfather', 'The Godfather Part II',
+                              'The Godfather Part III']})
+        self.assertEqual(Franchise.objects.get(
+            title='The Godfather').movie_count, 3)
+        self.assertIsNone(Movie.objects.get(title='Heat').franchise_id)
+
+    def test_franchises_maintained(self):
+        alien = Franchise.objects.get(title='Alien')
+        aliens = self.movies['Aliens']
+        aliens.title = 'Predator'
+        aliens.save()
+        self.assertFalse(Franchise.objects.filter(title='Alien').exists())
+        Movie.objects.create(title='Alien 3', release_date='1992-05-22')
+        self.assertEqual(self.franchises()['Alien'], ['Alien', 'Alien 3'])
+        self.movies['The Godfather'].delete()
+        self.assertEqual(self.franchises()['The Godfather Part II'], [
+            'The Godfather Part II', 'The Godfather Part III'])
+        # incremental updates agree with a rebuild, keeping primary keys
+        expected = dict(Franchise.objects.values_list('title', 'pk'))
+        movies = dict(Movie.objects.values_list('pk', 'franchise_id'))
+        denorm.rebuild_franchises()
+        self.assertEqual(
+            dict(Franchise.objects.values_list('title', 'pk')), expected)
+        self.assertEqual(
+            dict(Movie.objects.values_list('pk', 'franchise_id')), movies)
+        self.assertNotEqual(Franchise.objects.get(title='Alien').pk, alien.pk)
+
+    def test_franchise_list(self):
+        response = self.client.get('/api/franchises/', format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(franchise['title'], franchise['movie_count'])
+             for franchise in response.data['results']],
+            [('Alien', 2), ('The Godfather', 3)])
+
+    def test_franchise_filters(self):
+        def titles(query):
+            response = self.client.get('/api/franchises/?' + query,
+                                       format='json')
+            self.assertEqual(response.status_code, 200)
+            return [franchise['title']
+                    for franchise in response.data['results']]
+        self.assertEqual(titles('genres={}'.format(self.horror.pk)),
+                         ['Alien'])
+        self.assertEqual(titles('year=1990'), ['The Godfather'])
+        self.assertEqual(titles('year_from=1975&year_to=1989'), ['Alien'])
+        # one movie meets both conditions
+        self.assertEqual(
+            titles('genres={}&year=1990'.format(self.horror.pk)), [])
+        # out of range years match nothing, as other invalid filters
+        self.assertEqual(titles('year=0'), [])
+
+    def test_movie_franchise(self):
+        franchise = Franchise.objects.get(title='Alien')
+        response = self.client.get(
+            '/api/movies/{}/'.format(self.movies['Aliens'].pk), format='json')
+        self.assertTrue(response.data['franchise'].endswith(
+            '/api/franchises/{}/'.format(franchise.pk)))
+        response = self.client.get(
+            '/api/movies/?franchise={}'.format(franchise.pk), format='json')
+        self.assertEqual(
+            sorted(movie['title'] for movie in response.data['results']),
+            ['Alien', 'Aliens'])
+
+
+class LoadDataMoviesGenresTestCase(TestCase):
+
+    def test_bulk_loaddata_idempotent(self):
+        out = StringIO()
+        call_command('loaddata_movies_genres', bulk=True, stdout=out)
+        self.assertIn('rows/s', out.getvalue())
+        counts = (Movie.objects.count(), Genre.objects.count(),
+                  Movie.genres.through.objects.count())
+        self.assertEqual(counts[2], 10000)
+        call_command('loaddata_movies_genres', bulk=True, stdout=out)
+        self.assertEqual(counts, (Movie.objects.count(),
+                                  Genre.objects.count(),
+                                  Movie.genres.through.objects.count()))
+        sequels = dict(Movie.objects.values_list('id', 'sequels_count'))
+        denorm.rebuild_sequels_count()
+        self.assertEqual(
+            sequels, dict(Movie.objects.values_list('id', 'sequels_count')))
+
+    def test_bulk_loaddata_parallel(self):
+        with open(str(DATA_PATH)) as data:
+            lines = data.readlines()
+        links = lambda: sorted(Movie.genres.through.objects.values_list(
+            'movie__title', 'movie__release_date', 'genre__name'))
+        LoadDataCommand().bulk_loaddata(DATA_PATH)
+        expected = links()
+        Movie.objects.all().delete()
+        Genre.objects.all().delete()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(3):
+                path = os.path.join(tmp, 'part{}.tsv'.format(i))
+                with open(path, 'w') as part:
+                    part.writelines(lines[i::3])
+            command = LoadDataCommand()
+            command.workers = 2
+            command.chunk_bytes = 4096
+            rows = command.bulk_loaddata(
+                expand_paths([os.path.join(tmp, 'part*.tsv')]))
+        self.assertEqual(rows, len(lines))
+        self.assertEqual(links(), expected)
+
+    def test_read_range(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'movies.tsv')
+            self.write_tsv(path, [('Helium', '2001', 'Wind'),
+                                  ('Neon', '2002', 'Wind'),
+                                  ('Argon', '2003', 'Fire')])
+            blocks = [read_range(*args) for args in file_ranges([path], 7)]
+            with open(path, 'rb') as data:
+                self.assertEqual(b''.join(blocks), data.read())
+        self.assertEqual(blocks[0], b'Helium\t2001\tWind\n')
+
+    def write_tsv(self, path, lines):
+        with open(path, 'w') as data:
+            data.writelines('\t'.join(line) + '\n' for line in lines)
+
+    def test_incremental_loaddata(self):
+        lines = [('Helium', '2001', 'Wind'), ('Helium', '2001', 'Earth'),
+                 ('Neon', '2002', 'Wind'), ('Argon', '2003', 'Fire')]
+        links = lambda: sorted(Movie.genres.through.objects.values_list(
+            'movie__title', 'genre__name'))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'movies.tsv')
+            self.write_tsv(path, lines)
+            out = StringIO()
+            command = LoadDataCommand(stdout=out)
+            self.assertEqual(command.incremental_loaddata(path), 4)
+            self.assertEqual(len(links()), 4)
+            self.assertEqual(command.incremental_loaddata(path), 0)
+            self.assertIn('Skipped unchanged', out.getvalue())
+
+            stored = Movie.objects.get(title='Helium').pk
+            self.write_tsv(path, [
+                (' Helium ', '2001', 'Earth'), ('Helium', '2001', 'Fire'),
+                ('Neon', '2002', 'Wind'), ('Xenon', '2004', 'Water')])
+            self.assertEqual(command.incremental_loaddata(path), 4)
+            self.assertIn('1 movies added, 1 relinked, 1 not in the file',
+                          out.getvalue())
+            self.assertEqual(Movie.objects.get(title='Helium').pk, stored)
+            self.assertEqual(links(), [
+                ('Argon', 'Fire'), ('Helium', 'Earth'), ('Helium', 'Fire'),
+                ('Neon', 'Wind'), ('Xenon', 'Water')])
+
+            # the same content with a new modification time is skipped
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(command.incremental_loaddata(path), 0)
+            command.incremental_loaddata(path, prune=True, force=True)
+            self.assertFalse(Movie.objects.filter(title='Argon').exists())
+
+        self.assertEqual(Genre.objects.get(name='Fire').movie_count, 1)
+        stats = sorted(GenreYearStat.objects.values_list(
+            'year', 'genre__name', 'movie_count'))
+        denorm.rebuild_all()
+        self.assertEqual(stats, sorted(GenreYearStat.objects.values_list(
+            'year', 'genre__name', 'movie_count')))
+
+
+class BatchAPITestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='test', email='test@test.com', password='top_secret')
+        self.drama = Genre.objects.create(name='Drama')
+        self.comedy = Genre.objects.create(name='Comedy')
+        self.movie = Movie.objects.create(
+            title='Cobalt', release_date='2006-01-01')
+        self.movie.genres.add(self.drama)
+        self.deleted = Movie.objects.create(
+            title='Cobalt 2', release_date='2008-01-01')
+        self.deleted.genres.add(self.drama, self.comedy)
+
+    def batch(self, url, actions):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(url, actions, format='json')
+        self.client.force_authenticate(user=None)
+        return response
+
+    def test_movie_batch(self):
+        drama = '/api/genres/{}/'.format(self.drama.id)
+        comedy = '/api/genres/{}/'.format(self.comedy.id)
+        response = self.batch('/api/movies/batch/', [
+            {'action': 'create', 'data': {
+                'title': 'Cobalt 3', 'release_date': '2010-01-01',
+                'genres': [drama, comedy]}},
+            {'action': 'create', 'data': {
+                'title': 'Iron', 'release_date': '2010-01-01',
+                'genres': [comedy]}},
+            {'action': 'update', 'id': self.movie.id, 'data': {
+                'title': 'Cobalt Blue', 'release_date': '2010-01-01',
+                'genres': [comedy]}},
+            {'action': 'delete', 'id': self.deleted.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results],
+                         [201, 201, 200, 204])
+        self.assertEqual(results[2]['id'], self.movie.id)
+
+        created = Movie.objects.get(pk=results[0]['id'])
+        self.assertEqual(created.title, 'Cobalt 3')
+        self.assertEqual(set(created.genres.all()), {self.drama, self.comedy})
+        self.movie.refresh_from_db()
+        self.assertEqual(self.movie.title, 'Cobalt Blue')
+        self.assertEqual(list(self.movie.genres.all()), [self.comedy])
+        self.assertFalse(Movie.objects.filter(pk=self.deleted.id).exists())
+
+        # the denormalized data matches a rebuild
+        sequels = dict(Movie.objects.values_list('title', 'sequels_count'))
+        self.assertEqual(sequels, {'Cobalt 3': 0, 'Iron': 0, 'Cobalt Blue': 0})
+        stats = set(GenreYearStat.objects.values_list(
+            'year', 'genre_id', 'movie_count'))
+        self.assertEqual(stats, {(2010, self.drama.id, 1),
+                                 (2010, self.comedy.id, 3)})
+        self.assertEqual(
+            dict(Genre.objects.values_list('id', 'movie_count')),
+            denorm.genre_movie_counts())
+        response = self.client.get('/api/movies/?search=iron', format='json')
+        self.assertEqual(response.data['count'], 1)
+
+    def test_movie_batch_sequels(self):
+        response = self.batch('/api/movies/batch/', [
+            {'action': 'create', 'data': {
+                'title': 'Cobalt {}'.format(i), 'release_date': '2010-01-01',
+                'genres': ['/api/genres/{}/'.format(self.drama.id)]}}
+            for i in range(3, 6)
+        ] + [
+            {'action': 'update', 'id': self.deleted.id,
+             'data': {'title': 'Nickel'}},
+        ])
+        self.assertEqual(response.status_code, 200)
+        sequels = dict(Movie.objects.values_list('id', 'sequels_count'))
+        denorm.rebuild_sequels_count()
+        self.assertEqual(
+            sequels, dict(Movie.objects.values_list('id', 'sequels_count')))
+        self.assertEqual(sequels[self.movie.id], 3)
+
+    def test_movie_batch_invalid(self):
+        response = self.batch('/api/movies/batch/', [
+            {'action': 'create', 'data': {
+                'title': 'Iron', 'release_date': '2010-01-01',
+                'genres': ['/api/genres/{}/'.format(self.drama.id)]}},
+            {'action': 'create', 'data': {
+                'title': 'Zinc', 'release_date': 'soon',
+                'genres': ['/api/genres/0/']}},
+            {'action': 'update', 'id': 0, 'data': {}},
+            {'action': 'delete', 'id': self.movie.id},
+            {'action': 'delete', 'id': self.movie.id},
+            {'action': 'rename'},
+            {'action': 'update', 'id': [self.movie.id], 'data': {}},
+            {'action': 'delete', 'id': {'id': self.movie.id}},
+            {'action': 'delete', 'id': True},
+            {'action': 'delete', 'id': str(self.movie.id)},
+        ])
+        self.assertEqual(response.status_code, 400)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results],
+                         [424, 400, 404, 424, 400, 400, 400, 400, 400, 400])
+        self.assertEqual(results[-1]['errors'],
+                         {'id': ['A valid integer is required.']})
+        self.assertEqual(set(results[1]['errors']),
+                         {'release_date', 'genres'})
+        self.assertEqual(Movie.objects.count(), 2)
+
+    def test_genre_batch(self):
+        response = self.batch('/api/genres/batch/', [
+            {'action': 'create', 'data': {'name': 'Western'}},
+            {'action': 'update', 'id': self.comedy.id,
+             'data': {'name': 'Satire'}},
+            {'action': 'delete', 'id': self.drama.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(Genre.objects.values_list('name', flat=True)),
+            ['Satire', 'Western'])
+        western = Genre.objects.get(pk=response.data['results'][0]['id'])
+        self.assertEqual(western.name, 'Western')
+        self.assertIsNotNone(western.bit)
+
+        response = self.batch('/api/genres/batch/', [
+            {'action': 'create', 'data': {'name': 'Satire'}},
+            # keeping its own name
+            {'action': 'update', 'id': western.id,
+             'data': {'name': 'Western'}}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['results'][0]['errors'], {
+            'name': ['genre with this name already exists.']})
+        self.assertEqual(response.data['results'][1]['status'], 424)
+
+    def test_batch_anon(self):
+        response = self.client.post('/api/genres/batch/', [
+            {'action': 'create', 'data': {'name': 'Western'}}], format='json')
+        self.assertEqual(response.status_code, 403)
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        drama = Genre.objects.create(name='Drama')
+        comedy = Genre.objects.create(name='Comedy')
+        self.movies = [
+            Movie.objects.create(title='Copper', release_date='2001-01-01'),
+            Movie.objects.create(title='Copper 2', release_date='2003-01-01'),
+            Movie.objects.create(title='Tin, Lead', release_date='2002-01-01'),
+        ]
+        self.movies[0].genres.add(drama, comedy)
+        self.movies[2].genres.add(comedy)
+
+    def test_export_ndjson(self):
+        response = self.client.get('/api/export/movies.ndjson?sequels=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(
+            response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual(rows[0], {
+            'id': self.movies[0].id, 'title': 'Copper',
+            'release_date': '2001-01-01', 'genres': ['Comedy', 'Drama'],
+            'sequels_count': 1})
+        self.assertEqual([row['genres'] for row in rows[1:]],
+                         [[], ['Comedy']])
+
+    def test_export_gzip(self):
+        response = self.client.get('/api/export/movies.ndjson')
+        compressed = self.client.get('/api/export/movies.ndjson',
+                                     HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertTrue(compressed.streaming)
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.decompress(b''.join(compressed.streaming_content)),
+            b''.join(response.streaming_content))
+
+    def test_export_csv(self):
+        response = self.client.get('/api/export/movies.csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.reader(b''.join(
+            response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(rows[0], ['id', 'title', 'release_date', 'genres'])
+        self.assertEqual(rows[3], [str(self.movies[2].id), 'Tin, Lead',
+                                   '2002-01-01', 'Comedy'])
+
+    def test_export_chunks(self):
+        out = StringIO()
+        with self.assertNumQueries(5):
+            call_command('export_movies', chunk_size=2, stdout=out)
+        self.assertEqual(
+            [json.loads(line)['title'] for line in out.getvalue().splitlines()],
+            ['Copper', 'Copper 2', 'Tin, Lead'])
+
+
+class SnapshotTestCase(TestCase):
+
+    def setUp(self):
+        drama = Genre.objects.create(name='Drama')
+        comedy = Genre.objects.create(name='Comédie')
+        movies = [
+            Movie.objects.create(title='Copper', release_date='2001-01-01'),
+            Movie.objects.create(title='Copper 2', release_date='2003-05-06'),
+            Movie.objects.create(title='Tin', release_date='2002-01-01'),
+        ]
+        movies[0].genres.add(drama, comedy)
+        movies[1].genres.add(drama)
+
+    def tables(self):
+        return [list(model.objects.order_by('pk').values_list())
+                for model in snapshot.snapshot_models()]
+
+    def test_dump_restore(self):
+        expected = self.tables()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'catalog.npz')
+            out = StringIO()
+            call_command('snapshot_dump', path, stdout=out)
+            self.assertIn('2 genres, 1 franchises, 3 movies', out.getvalue())
+
+            Movie.objects.get(title='Copper').delete()
+            Genre.objects.filter(name='Drama').update(name='Noir')
+            Movie.objects.create(title='Lead', release_date='2004-01-01')
+            call_command('snapshot_restore', path, stdout=out)
+        self.assertEqual(self.tables(), expected)
+
+        self.assertEqual(
+            [movie.title for movie in search.filter_titles(
+                Movie.objects.all(), 'copper')], ['Copper', 'Copper 2'])
+        movie = Movie.objects.create(title='Lead', release_date='2004-01-01')
+        self.assertGreater(movie.pk, max(row[0] for row in expected[1]))
+
+    def test_restore_invalid(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'catalog.npz')
+            with open(path, 'wb') as output:
+                np.savez(output, version=np.array(0))
+            with self.assertRaises(CommandError):
+                call_command('snapshot_restore', path)
+        self.assertEqual(Movie.objects.count(), 3)
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_generate_tsv(self):
+        fd, path = tempfile.mkstemp(suffix='.tsv')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        movies = generate_tsv(path, 2000, seed=1)
+        with open(path) as data:
+            rows = [line.rstrip('\n').split('\t') for line in data]
+        self.assertEqual(len(rows), 2000)
+        self.assertEqual(len({title for title, year, genre in rows}),
+                         movies)
+        self.assertTrue(all(1890 <= int(year) <= 2020 and genre
+                            for title, year, genre in rows))
+
+        LoadDataCommand().bulk_loaddata(path)
+        self.assertEqual(Movie.objects.count(), movies)
+        self.assertTrue(Movie.objects.filter(sequels_count__gt=0).exists())
+
+    def test_command(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        output = os.path.join(tmp.name, 'results.json')
+        # in a process of its own, the command replaces the test database
+        subprocess.check_output([
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+            'benchmark', '--rows', '500', '--repeat', '1',
+            '--output', output], stderr=subprocess.STDOUT)
+        with open(output) as data:
+            results = json.load(data)
+        self.assertEqual(results['meta']['rows'], 500)
+        self.assertGreater(results['meta']['movies'], 0)
+        # counting the reads of the replica too
+        self.assertGreater(results['results']['movie_list']['queries'], 0)
+        for name in ('render_drf_indent', 'render_drf', 'render_compact_json'):
+            self.assertIn(name, results['results'])
+        for transfer in results['transfers'].values():
+            self.assertLess(transfer['gzip_bytes'], transfer['bytes'])
+
+    def test_invalid_options(self):
+        for rows in ('0', '-1'):
+            with self.assertRaisesRegex(CommandError, 'positive'):
+                call_command('benchmark', '--rows', rows, stdout=StringIO())
+        for repeat in ('0', '-1'):
+            with self.assertRaisesRegex(CommandError, 'at least 1'):
+                call_command('benchmark', '--repeat', repeat,
+                             stdout=StringIO())
+
+    def test_compare_results(self):
+        baseline = {'results': {
+            'movie_list': {'median_ms': 10.0},
+            'genre_list': {'median_ms': 1.0},
+        }}
+        results = {'results': {
+            'movie_list': {'median_ms': 14.0},
+            'genre_list': {'median_ms': 1.9},
+            'movie_search': {'median_ms': 5.0},
+        }}
+        self.assertEqual(compare_results(results, baseline, 0.25),
+                         [('movie_list', 10.0, 14.0)])
+        self.assertEqual(compare_results(results, baseline, 0.5), [])
+
+
+# worker threads read what the test case committed
+@override_settings(ALLOWED_HOSTS=['127.0.0.1'], MOVIES_CACHED_PATHS=())
+class LoadTestTestCase(TransactionTestCase):
+
+    def setUp(self):
+        genre = Genre.objects.create(name='Drama')
+        for title in ['Helium', 'Neon', 'Argon']:
+            Movie.objects.create(
+                title=title, release_date='2006-01-01').genres.add(genre)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.scenario = os.path.join(tmp.name, 'scenario.json')
+        self.output = os.path.join(tmp.name, 'results.json')
+        with open(self.scenario, 'w') as scenario:
+            json.dump({'threads': 3, 'endpoints': [
+                {'name': 'movie_detail', 'path': '/api/movies/{movie}/',
+                 'weight': 3},
+                {'name': 'genre_list', 'path': '/api/genres/'},
+                {'name': 'missing', 'path': '/api/movies/0/'},
+            ]}, scenario)
+
+    def run_loadtest(self, **options):
+        call_command('loadtest', self.scenario, requests=30,
+                     output=self.output, stdout=StringIO(), **options)
+        with open(self.output) as output:
+            return json.load(output)['results']
+
+    def test_loadtest(self):
+        results = self.run_loadtest()
+        self.assertEqual(results['total']['requests'], 30)
+        self.assertEqual(sum(results[name]['requests'] for name in [
+            'movie_detail', 'genre_list', 'missing']), 30)
+        self.assertEqual(results['movie_detail']['errors'], 0)
+        self.assertEqual(results['missing']['error_rate'], 1.0)
+        self.assertEqual(list(results['missing']['statuses']), ['404'])
+        self.assertLessEqual(results['total']['p50_ms'],
+                             results['total']['p99_ms'])
+
+    def test_loadtest_server(self):
+        results = self.run_loadtest(server=True, processes=1)
+        self.assertEqual(results['total']['requests'], 30)
+        self.assertEqual(results['genre_list']['errors'], 0)
+
+    def test_processes(self):
+        scenario = {'endpoints': [{'name': 'home', 'path': '/', 'weight': 1}]}
+        deadline = time.time() + 60
+        results = loadtest.run_processes(
+            lambda path: 200, scenario, {}, 2, 2, deadline, 10, 0)
+        self.assertEqual(results['home']['statuses'], {200: 10})
+
+        def crash(path):
+            # as the OOM killer would
+            os.kill(os.getpid(), signal.SIGKILL)
+        with self.assertRaisesRegex(RuntimeError, 'exit code -9'):
+            loadtest.run_processes(
+                crash, scenario, {}, 2, 1, deadline, 10, 0)
+
+    def test_invalid_scenario(self):
+        with open(self.scenario, 'w') as scenario:
+            json.dump({'endpoints': [{'path': '/api/movies/{actor}/'}]},
+                      scenario)
+        with self.assertRaisesRegex(CommandError, 'Unknown placeholders'):
+            call_command('loadtest', self.scenario, stdout=StringIO())
+        self.assertEqual(loadtest.percentile([1.0, 2.0, 3.0, 4.0], 50), 3.0)
+
+
+class AdminTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            username='admin', email='admin@test.com', password='top_secret')
+        self.client.force_login(self.user)
+        self.wind = Genre.objects.create(name='Wind')
+        self.earth = Genre.objects.create(name='Earth')
+
+    def add_movies(self, count):
+        for i in range(count):
+            movie = Movie.objects.create(
+                title='Movie {}'.format(i),
+                release_date='{}-{:02}-01'.format(2000 + i % 2, i % 12 + 1))
+            movie.genres.add(self.wind if i % 3 else self.earth)
+
+    def titles(self, query=''):
+        response = self.client.get('/admin/movies/movie/' + query)
+        self.assertEqual(response.status_code, 200)
+        return {movie.title for movie in response.context['cl'].result_list}
+
+    def test_changelist_queries(self):
+        self.add_movies(3)
+        with CaptureQueriesContext(connection) as queries:
+            self.titles()
+        self.add_movies(30)
+        with self.assertNumQueries(len(queries)):
+            self.assertEqual(len(self.titles()), 30)
+        self.wind.movie_set.add(*Movie.objects.filter(title='Movie 0'))
+        self.assertContains(self.client.get('/admin/movies/movie/'),
+                            '<td class="field-genre_names">Earth, Wind</td>')
+
+    def test_changelist_filters(self):
+        self.add_movies(12)
+        self.assertEqual(self.titles('?genre={}'.format(self.earth.pk)),
+                         {'Movie 0', 'Movie 3', 'Movie 6', 'Movie 9'})
+        self.assertEqual(self.titles('?year=2001&month=4'), {'Movie 3'})
+        response = self.client.get('/admin/movies/movie/?year=2001')
+        self.assertContains(response, '?month=2&amp;year=2001')
+        for query in ['?year=never', '?year=0', '?year=9999',
+                      '?year=10000', '?year=9999&month=12',
+                      '?year=10000&month=1', '?year=2001&month=13']:
+            self.assertEqual(self.client.get(
+                '/admin/movies/movie/' + query)['Location'],
+                '/admin/movies/movie/?e=1', query)
+
+
+class DatabaseRoutingTestCase(TestCase):
+
+    def test_routing(self):
+        router = ReadReplicaRouter()
+        # the test case runs in a transaction, whose writes only it sees
+        self.assertEqual(router.db_for_read(Movie), 'default')
+        with mock.patch.object(connections['default'], 'in_atomic_block',
+                               False):
+            self.assertEqual(router.db_for_read(Movie), 'replica')
+        self.assertEqual(router.db_for_write(Movie), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'movies'))
+
+    def test_connection_setup(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -64000)
+        with connections['replica'].cursor() as cursor:
+            with self.assertRaisesRegex(OperationalError, 'readonly'):
+                cursor.execute('DELETE FROM movies_genre')
+
+
+class ResponseCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.genre = Genre.objects.create(name='Test Genre')
+        m = Movie.objects.create(title='Helium', release_date='2006-01-01')
+        m.genres.add(self.genre)
+
+    def test_cached_response(self):
+        response = self.client.get('/api/movies/', format='json')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/movies/', format='json')
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], etag)
+        self.assertEqual(cached['Content-Type'], response['Content-Type'])
+
+    def test_conditional_get(self):
+        etag = self.client.get('/api/genres/', format='json')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/genres/', format='json',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_write_invalidates(self):
+        response = self.client.get('/api/genres/', format='json')
+        Movie.objects.create(title='Neon', release_date='2006-01-01').genres.add(
+            self.genre)
+        updated = self.client.get('/api/genres/', format='json',
+                                  HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(updated.status_code, 200)
+        self.assertNotEqual(updated['ETag'], response['ETag'])
+        self.assertEqual(updated.data['results'][0]['movie_count'], 2)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_cache_check(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)],
+                         ['movies.E001'])
+
+    def test_rebuild_invalidates(self):
+        response = self.client.get('/api/genres/', format='json')
+        call_command('rebuild_denormalized', 'genre_movie_counts',
+                     stdout=StringIO())
+        rebuilt = self.client.get('/api/genres/', format='json',
+                                  HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(rebuilt.status_code, 200)
+        self.assertNotEqual(rebuilt['ETag'], response['ETag'])
+
+    def test_repair_invalidates(self):
+        Genre.objects.update(movie_count=5)
+        response = self.client.get('/api/genres/', format='json')
+        call_command('check_genre_counts', stdout=StringIO())
+        repaired = self.client.get('/api/genres/', format='json',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repaired.status_code, 200)
+        self.assertEqual(repaired.data['results'][0]['movie_count'], 1)
+
+    def test_gzip(self):
+        for i in range(10):
+            Movie.objects.create(title='Neon {}'.format(i),
+                                 release_date='2006-01-01')
+        response = self.client.get('/api/movies/', format='json')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        compressed = self.client.get('/api/movies/', format='json',
+                                     HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        self.assertEqual(gzip.decompress(compressed.content), response.content)
+        self.assertNotEqual(compressed['ETag'], response['ETag'])
+        # cached compressed
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/movies/', format='json',
+                                     HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(cached.content, compressed.content)
+        self.assertEqual(cached['Content-Encoding'], 'gzip')
+
+
+class RendererTestCase(TestCase):
+
+    def test_compact_json(self):
+        cache.clear()
+        Movie.objects.create(title='Helium', release_date='2006-01-01')
+        response = APIClient().get(
+            '/api/movies/', HTTP_ACCEPT='application/json; indent=4')
+        self.assertNotIn(b'\n', response.content)
+        self.assertEqual(response.content, renderers.dumps(response.data))
+
+    def test_dumps(self):
+        data = {'title': 'Caf\xe9 \u2028', 'date': datetime.date(2006, 1, 1),
+                'rating': Decimal('7.5'), 'genres': [1, 2]}
+        expected = (
+            '{"title":"Caf\xe9 \\u2028","date":"2006-01-01",'
+            '"rating":7.5,"genres":[1,2]}').encode('utf-8')
+        self.assertEqual(json.loads(renderers.dumps(data).decode('utf-8')),
+                         json.loads(expected.decode('utf-8')))
+        self.assertEqual(renderers.dumps(data, fast=False), expected)
+        self.assertNotIn(b'\xe2\x80\xa8', renderers.dumps(data))
+        # keys orjson doesn't encode
+        self.assertEqual(renderers.dumps({1: 'a'}), b'{"1":"a"}')
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.client = APIClient()
+        self.admin = User.objects.create_superuser(
+            username='admin', email='admin@test.com', password='top_secret')
+        self.user = User.objects.create_user(
+            username='test', email='test@test.com', password='top_secret')
+        genre = Genre.objects.create(name='Test Genre')
+        Movie.objects.create(
+            title='Helium', release_date='2006-01-01').genres.add(genre)
+
+    def test_metrics(self):
+        self.client.get('/api/movies/', format='json')
+        self.client.get('/api/movies/', format='json')
+        self.client.get('/api/topGenreByYear/', format='json')
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get('/api/_metrics/', format='json')
+        self.client.force_authenticate(user=None)
+        self.assertEqual(response.status_code, 200)
+
+        movies = response.data['endpoints']['GET movie-list']
+        self.assertEqual(movies['requests'], 2)
+        self.assertEqual(movies['errors'], 0)
+        self.assertEqual(sum(movies['latency_ms']['buckets'].values()), 2)
+        # the second response came from the cache, without any query
+        self.assertEqual(movies['queries']['max'], 3)
+        self.assertEqual(movies['queries']['p50'], 0)
+        self.assertGreater(movies['mean_ms']['view'], 0)
+        self.assertGreater(movies['mean_ms']['render'], 0)
+        self.assertGreaterEqual(
+            movies['mean_ms']['total'], movies['mean_ms']['db'])
+        self.assertEqual(response.data['endpoints'][
+            'GET movies.views.topGenreByYearView']['requests'], 1)
+
+        self.client.force_authenticate(user=self.admin)
+        self.client.delete('/api/_metrics/')
+        self.client.force_authenticate(user=None)
+        self.assertNotIn('GET movie-list', metrics.snapshot()['endpoints'])
+
+    def test_metrics_admin_only(self):
+        response = self.client.get('/api/_metrics/', format='json')
+        self.assertEqual(response.status_code, 403)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/api/_metrics/', format='json')
+        self.client.force_authenticate(user=None)
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_SLOW_REQUEST_MS=0)
+    def test_slow_request_log(self):
+        with self.assertLogs('moviemania.metrics', 'WARNING') as logs:
+            self.client.get('/api/genres/', format='json')
+        self.assertIn('/api/genres/', logs.output[0])
+        self.assertIn('FROM "movies_genre"', logs.output[0])
+
+
+@override_settings(MOVIES_READ_MODEL=True, MOVIES_CACHED_PATHS=())
+class ReadModelTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        readmodel.reset()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='test', email='test@test.com', password='top_secret')
+        self.client.force_authenticate(user=self.user)
+        self.genres = [Genre.objects.create(name=name)
+                       for name in ['Wind', 'Earth', 'Fire']]
+        titles = ['Helium', 'Helium 2', 'Neon', 'Argon', 'Argon II', 'Xenon']
+        for i, title in enumerate(titles):
+            movie = Movie.objects.create(
+                title=title, release_date='{}-01-01'.format(2000 + i % 3))
+            movie.genres.add(*self.genres[:i % 3 + 1])
+
+    def urls(self):
+        wind, earth, fire = self.genres
+        return [
+            '/api/movies/',
+            '/api/movies/?page=2',
+            '/api/movies/?genres={}&genres={}'.format(earth.pk, fire.pk),
+            '/api/movies/?genres_all={}&genres_all={}'.format(
+                wind.pk, earth.pk),
+            '/api/movies/?genres_none={}'.format(fire.pk),
+            '/api/movies/?search=helium',
+            '/api/movies/?fields=title,sequels_count',
+            '/api/movies/?exclude=genres&genres={}'.format(wind.pk),
+            '/api/genres/',
+            '/api/genres/?fields=name',
+            '/api/topGenreByYear/?year=2001',
+            '/api/topGenreByYear/?years=2000,2002,1800',
+            '/api/topGenreByYear/?year_from=2001',
+        ]
+
+    def assertMatchesDatabase(self):
+        for url in self.urls():
+            response = self.client.get(url, format='json')
+            with self.settings(MOVIES_READ_MODEL=False):
+                expected = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, expected.status_code)
+            self.assertEqual(response.data, expected.data, url)
+
+    def test_matches_database(self):
+        self.assertMatchesDatabase()
+        # the last change logged only
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/movies/?genres={}'.format(
+                self.genres[0].pk), format='json')
+        self.assertEqual(response.data['count'], 6)
+        sequels = {movie['title']: movie['sequels_count']
+                   for movie in response.data['results']}
+        self.assertEqual(sequels['Helium'], 1)
+
+    def test_incremental_refresh(self):
+        catalog = readmodel.get_catalog()
+        wind, earth, fire = self.genres
+        with mock.patch.object(Catalog, 'load', side_effect=AssertionError):
+            helium = Movie.objects.get(title='Helium')
+            helium.title = 'Argon'
+            helium.release_date = '1999-01-01'
+            helium.save()
+            helium.genres.remove(wind)
+            fire.movie_set.add(helium)
+            Movie.objects.get(title='Neon').delete()
+            earth.name = 'Water'
+            earth.save()
+            Movie.objects.create(title='Argon III', release_date='2002-06-01')
+            self.assertMatchesDatabase()
+            fire.delete()
+            self.assertMatchesDatabase()
+        self.assertGreater(readmodel.get_catalog().change_id,
+                           catalog.change_id)
+
+    def test_other_process_write(self):
+        readmodel.get_catalog()
+        xenon = Movie.objects.get(title='Xenon')
+        # as logged by another process, without a version in this cache
+        Movie.objects.filter(pk=xenon.pk).update(title='Krypton')
+        DataChange.objects.create(movie_id=xenon.pk)
+        with mock.patch.object(Catalog, 'load', side_effect=AssertionError):
+            self.assertMatchesDatabase()
+
+    def test_batch_and_reload(self):
+        readmodel.get_catalog()
+        response = self.client.post('/api/movies/batch/', [
+            {'action': 'create', 'data': {
+                'title': 'Helium 3', 'release_date': '2003-01-01',
+                'genres': ['/api/genres/{}/'.format(self.genres[0].pk)]}},
+            {'action': 'update', 'id': Movie.objects.get(title='Xenon').pk,
+             'data': {'title': 'Argon 2'}},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertMatchesDatabase()
+
+        Movie.objects.all().update(title=F('title'))
+        readmodel.log_reload()
+        bump_data_version()
+        with mock.patch.object(Catalog, 'load', wraps=Catalog.load) as load:
+            self.assertMatchesDatabase()
+        self.assertEqual(load.call_count, 1)
+
+
+def movie_data(values):
+    return {'title': 'Budget', 'release_date': '2001-01-01',
+            'genres': ['/api/genres/{}/'.format(values['genre'])]}
+
+
+def movie_batch(values):
+    # as many creates, and updates, as movies in a page
+    return [{'action': 'create', 'data': movie_data(values)}
+            for _ in range(values['page_size'])] + [
+        {'action': 'update', 'id': pk, 'data': {'title': 'Budget 2'}}
+        for pk in values['movies'][:values['page_size']]]
+
+
+def genre_batch(values):
+    return [{'action': 'create', 'data': {
+        'name': 'Budget {}.{}'.format(values['serial'], i)}}
+        for i in range(values['page_size'])] + [
+        {'action': 'update', 'id': values['genre'],
+         'data': {'name': 'Budget'}}]
+
+
+# the (method, path, data, queries allowed) of requests to each route of
+# movies/urls.py, whatever the page size and the size of the catalog. Paths
+# are formatted with, and data built from, `QueryBudgetTestCase.values()`
+QUERY_BUDGETS = {
+    'api-root': [('get', '/api/', None, 0)],
+    'movie-list': [
+        ('get', '/api/movies/', None, 3),
+        ('get', '/api/movies/?cursor=', None, 2),
+        ('get', '/api/movies/?genres={genre}&genres_none={other_genre}',
+         None, 5),
+        ('get', '/api/movies/?genres_all={genre}&genres_all={other_genre}',
+         None, 4),
+        ('get', '/api/movies/?search=movie', None, 3),
+        ('get', '/api/movies/?title_prefix=mov', None, 3),
+        ('get', '/api/movies/?franchise={franchise}', None, 4),
+        ('get', '/api/movies/?fields=title,sequels_count', None, 2),
+        # sequel, franchise, search, statistics and genre maintenance
+        ('post', '/api/movies/', movie_data, 24),
+    ],
+    'movie-detail': [
+        ('get', '/api/movies/{movie}/', None, 2),
+        ('put', '/api/movies/{movie}/', movie_data, 7),
+        ('patch', '/api/movies/{movie}/', lambda values: {'title': 'X'}, 5),
+        ('delete', '/api/movies/{last_movie}/', None, 19),
+    ],
+    'movie-batch': [('post', '/api/movies/batch/', movie_batch, 28)],
+    'genre-list': [
+        ('get', '/api/genres/', None, 2),
+        ('post', '/api/genres/',
+         lambda values: {'name': 'Budget {}'.format(values['serial'])}, 3),
+    ],
+    'genre-detail': [
+        ('get', '/api/genres/{genre}/', None, 1),
+        ('patch', '/api/genres/{genre}/', lambda values: {'name': 'X'}, 4),
+    ],
+    'genre-batch': [('post', '/api/genres/batch/', genre_batch, 13)],
+    'franchise-list': [
+        ('get', '/api/franchises/', None, 2),
+        ('get', '/api/franchises/?genres={genre}&year_from=2001', None, 3),
+    ],
+    'franchise-detail': [('get', '/api/franchises/{franchise}/', None, 1)],
+    'topGenreByYearView': [
+        ('get', '/api/topGenreByYear/?year=2001', None, 1),
+        ('get', '/api/topGenreByYear/?year_from=2000&year_to=2010', None, 1),
+    ],
+    'genreYearStatsView': [
+        ('get', '/api/stats/genresByYear/?top=2', None, 2),
+        ('get', '/api/stats/topGenresByYear/', None, 2),
+    ],
+    'exportMoviesView': [
+        ('get', '/api/export/movies.ndjson?sequels=1', None, 3),
+        ('get', '/api/export/movies.csv', None, 3),
+    ],
+}
+
+
+def route_names(patterns):
+    """The names of routes, or of their views when unnamed."""
+    names = set()
+    for pattern in patterns:
+        if hasattr(pattern, 'url_patterns'):
+            names |= route_names(pattern.url_patterns)
+        else:
+            names.add(pattern.name or pattern.callback.__name__)
+    return names
+
+
+@override_settings(MOVIES_CACHED_PATHS=())
+class QueryBudgetTestCase(TestCase):
+    """
+    Requests every route with growing catalogs and page sizes, failing
+    when the queries of a request exceed the budget of its route, or vary
+    with the size of the page or the catalog, as N+1 queries would.
+    """
+    catalog_sizes = (3, 10, 30)
+    page_sizes = (2, 5, 20)
+
+    def setUp(self):
+        readmodel.reset()
+        self.client = APIClient()
+        self.user = User.objects.create_superuser(
+            username='admin', email='admin@test.com', password='top_secret')
+        self.genres = [Genre.objects.create(name=name)
+                       for name in ['Wind', 'Earth', 'Fire']]
+        self.added = self.serial = 0
+
+    def grow_catalog(self, size):
+        while Movie.objects.count() < size:
+            # pairs of titles, making franchises and sequels
+            movie = Movie.objects.create(
+                title='Movie {}{}'.format(
+                    self.added // 2, ' 2' * (self.added % 2)),
+                release_date='{}-01-01'.format(2000 + self.added % 4))
+            movie.genres.add(*self.genres[:self.added % 3 + 1])
+            self.added += 1
+
+    def values(self, page_size):
+        movies = list(Movie.objects.order_by('pk').values_list(
+            'pk', flat=True))
+        self.serial += 1
+        return {
+            'serial': self.serial,
+            'movie': movies[len(movies) // 2],
+            'last_movie': movies[-1],
+            'movies': movies,
+            'genre': self.genres[0].pk,
+            'other_genre': self.genres[2].pk,
+            'franchise': Franchise.objects.order_by('pk')[0].pk,
+            'page_size': page_size,
+        }
+
+    def request(self, method, path, data, page_size):
+        values = self.values(page_size)
+        path = path.format(**values)
+        if data is not None:
+            data = data(values)
+        self.client.force_authenticate(
+            user=None if method == 'get' else self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, data, format='json')
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, '{} {}: {} {}'.format(
+            method.upper(), path, response.status_code,
+            getattr(response, 'data', None)))
+        return path, queries.captured_queries
+
+    def assertWithinBudget(self, method, path, data, budget):
+        first = None
+        for catalog_size in self.catalog_sizes:
+            self.grow_catalog(catalog_size)
+            for page_size in self.page_sizes:
+                with mock.patch.object(
+                        PageNumberPagination, 'page_size', page_size), \
+                        mock.patch.object(
+                            CursorPagination, 'page_size', page_size):
+                    # warm up first, and count the next request
+                    self.request(method, path, data, page_size)
+                    url, queries = self.request(
+                        method, path, data, page_size)
+                run = '{} {} with {} movies, {} per page'.format(
+                    method.upper(), url, catalog_size, page_size)
+                if first is None:
+                    first = (run, len(queries))
+                if len(queries) > budget:
+                    problem = 'over the budget of {}'.format(budget)
+                elif len(queries) > first[1]:
+                    problem = 'more than the {} of {}'.format(
+                        first[1], first[0])
+                else:
+                    continue
+                self.fail('{}: {} queries, {}\n{}'.format(
+                    run, len(queries), problem, '\n'.join(
+                        '{}. {}'.format(i, query['sql'])
+                        for i, query in enumerate(queries, 1))))
+
+    def test_every_route_has_budget(self):
+        self.assertEqual(route_names(movies_urls.urlpatterns),
+                         set(QUERY_BUDGETS))
+
+    def test_query_budgets(self):
+        for route, requests in sorted(QUERY_BUDGETS.items()):
+            for method, path, data, budget in requests:
+                with self.subTest(route=route, method=method, path=path):
+                    self.assertWithinBudget(method, path, data, budget)
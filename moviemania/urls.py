@@ -17,8 +17,11 @@ from django.conf import settings
 from django.conf.urls import url, include
 from django.contrib import admin
 
+from moviemania.metrics import metrics_view
+
 
 urlpatterns = [
+    url(r'^api/_metrics/$', metrics_view),
     url(r'^api/', include('movies.urls')),
 
     url(r'^admin/', admin.site.urls),
@@ -1,22 +1,151 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
+
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.paginator import Paginator
+from django.db.models import F, Max
+from django.utils.functional import cached_property
+
+from movies.filters import in_genres, split_genres
+from movies.models import Movie, Genre, GenreYearStat
+
+# filtered changelists count their rows up to this many
+MAX_EXACT_COUNT = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Pages without a COUNT(*) over the whole table: the size of an
+    unfiltered table is estimated from its highest primary key, and
+    filtered rows are counted up to `MAX_EXACT_COUNT`.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        if not queryset.query.where:
+            return queryset.aggregate(last=Max('pk'))['last'] or 0
+        return queryset[:MAX_EXACT_COUNT].count()
+
+
+class GenreListFilter(admin.SimpleListFilter):
+    """Movies of a genre, found by their genre bitmap rather than a join."""
+    title = 'genre'
+    parameter_name = 'genre'
+
+    def lookups(self, request, model_admin):
+        return [(str(pk), '{} ({})'.format(name, movie_count))
+                for pk, name, movie_count in Genre.objects.values_list(
+                    'pk', 'name', 'movie_count')]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        try:
+            genre = Genre.objects.get(pk=self.value())
+        except (ValueError, Genre.DoesNotExist):
+            raise IncorrectLookupParameters
+        mask, unmasked = split_genres([genre])
+        if mask:
+            return queryset.annotate(
+                genre_bits=F('genre_mask').bitand(mask)).filter(
+                    genre_bits__gt=0)
+        return queryset.annotate(in_genre=in_genres(unmasked)).filter(
+            in_genre=True)
+
 
-from movies.models import Movie, Genre
+def year_dates(value):
+    """
+    The first days of the year given, and of the next one. Raises
+    `IncorrectLookupParameters` if it is no year `datetime.date` can hold
+    the next one of.
+    """
+    try:
+        year = int(value)
+    except ValueError:
+        raise IncorrectLookupParameters
+    if not datetime.MINYEAR <= year < datetime.MAXYEAR:
+        raise IncorrectLookupParameters
+    return datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+
+
+class ReleaseYearFilter(admin.SimpleListFilter):
+    """Release years, as listed by the genre year statistics."""
+    title = 'year released'
+    parameter_name = 'year'
+
+    def lookups(self, request, model_admin):
+        years = GenreYearStat.objects.order_by('-year').values_list(
+            'year', flat=True).distinct()
+        return [(str(year), str(year)) for year in years]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        start, end = year_dates(self.value())
+        # a range on the release date index, unlike `release_date__year`
+        return queryset.filter(release_date__gte=start, release_date__lt=end)
+
+
+class ReleaseMonthFilter(admin.SimpleListFilter):
+    """Release months of the year selected by `ReleaseYearFilter`."""
+    title = 'month released'
+    parameter_name = 'month'
+
+    def lookups(self, request, model_admin):
+        year = request.GET.get(ReleaseYearFilter.parameter_name)
+        if not year:
+            return []
+        try:
+            start, end = year_dates(year)
+        except IncorrectLookupParameters:
+            # rejected by `ReleaseYearFilter`
+            return []
+        months = Movie.objects.filter(
+            release_date__gte=start, release_date__lt=end).dates(
+                'release_date', 'month')
+        return [(str(month.month), month.strftime('%B')) for month in months]
+
+    def queryset(self, request, queryset):
+        year = request.GET.get(ReleaseYearFilter.parameter_name)
+        if not self.value() or not year:
+            return queryset
+        try:
+            start = year_dates(year)[0].replace(month=int(self.value()))
+        except ValueError:
+            raise IncorrectLookupParameters
+        end = (start + datetime.timedelta(days=31)).replace(day=1)
+        return queryset.filter(release_date__gte=start, release_date__lt=end)
 
 
 @admin.register(Movie)
 class MovieAdmin(admin.ModelAdmin):
-    date_hierarchy = 'release_date'
-    filter_horizontal = ('genres',)
-    list_display = ('title', 'year_released',)
-    list_filter = ('genres',)
+    # genres are picked by id, without rendering every genre in the form
+    raw_id_fields = ('genres',)
+    list_display = ('title', 'year_released', 'genre_names')
+    list_filter = (GenreListFilter, ReleaseYearFilter, ReleaseMonthFilter)
+    # newest first, a walk of the (release_date, id) index
+    ordering = ('-release_date', '-id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # genre names of a whole page at once
+        return super(MovieAdmin, self).get_queryset(request).prefetch_related(
+            'genres')
 
     def year_released(self, obj):
-        return obj.release_date.strftime('%Y')
+        return obj.release_date.year
+    year_released.admin_order_field = 'release_date'
+
+    def genre_names(self, obj):
+        return ', '.join(genre.name for genre in obj.genres.all())
+    genre_names.short_description = 'genres'
 
 
 @admin.register(Genre)
 class GenreAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('name', 'movie_count')
@@ -2,7 +2,13 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MoviesConfig(AppConfig):
     name = 'movies'
+
+    def ready(self):
+        from movies import signals  # noqa: F401
+        from movies.db import configure_connection
+        connection_created.connect(configure_connection)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Set-based writes of many movies and genres at once.
+
+Bulk statements skip the model signals, so these functions maintain the
+denormalized data of ``movies.denorm`` and the title search index
+themselves, with one statement per chunk of rows instead of per row.
+They must run inside a transaction.
+"""
+from __future__ import unicode_literals
+
+from collections import Counter
+
+from django.db import DEFAULT_DB_ALIAS, NotSupportedError, connections
+from django.db.models import Case, Value, When
+
+from movies import denorm, readmodel, search
+from movies.models import Movie, Genre
+
+
+def allocate_ids(model, count, using=DEFAULT_DB_ALIAS):
+    """
+    Reserve `count` primary keys of `model` on SQLite, where bulk inserts
+    don't return the ids they assign.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        raise NotSupportedError(
+            'Primary keys can only be reserved on SQLite')
+    assert connection.in_atomic_block, 'allocate_ids() needs a transaction'
+
+    table = model._meta.db_table
+    quote_name = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        # a write takes the database lock until the transaction ends, so no
+        # other connection can insert rows with the same ids meanwhile
+        cursor.execute(
+            'UPDATE sqlite_sequence SET seq = seq WHERE name = %s', [table])
+        cursor.execute(
+            'SELECT MAX(seq) FROM sqlite_sequence WHERE name = %s', [table])
+        last_seq = cursor.fetchone()[0] or 0
+        cursor.execute('SELECT MAX({}) FROM {}'.format(
+            quote_name(model._meta.pk.column), quote_name(table)))
+        last_id = cursor.fetchone()[0] or 0
+    start = max(last_seq, last_id) + 1
+    return range(start, start + count)
+
+
+def bulk_insert(objs, using=DEFAULT_DB_ALIAS):
+    """Insert model instances of one model, setting their primary keys."""
+    if not objs:
+        return
+    model = type(objs[0])
+    if not connections[using].features.can_return_ids_from_bulk_insert:
+        for obj, pk in zip(objs, allocate_ids(model, len(objs), using)):
+            obj.pk = pk
+    model.objects.using(using).bulk_create(objs)
+
+
+def bulk_update(objs, fields, using=DEFAULT_DB_ALIAS):
+    """Store `fields` of model instances of one model, a CASE per field."""
+    if not objs or not fields:
+        return
+    model = type(objs[0])
+    model_fields = [model._meta.get_field(name) for name in fields]
+    # two parameters per field and row, one more per row for the filter
+    size = denorm.CHUNK_SIZE // (2 * len(fields) + 1)
+    for chunk in denorm.chunked(objs, size):
+        model.objects.using(using).filter(
+            pk__in=[obj.pk for obj in chunk]).update(**{
+                field.name: Case(*[
+                    When(pk=obj.pk, then=Value(
+                        getattr(obj, field.attname), output_field=field))
+                    for obj in chunk], output_field=field)
+                for field in model_fields})
+
+
+def set_genre_links(links, using=DEFAULT_DB_ALIAS):
+    """
+    Replace the genres of movies with a {movie_id: genre_ids} mapping,
+    as `movie.genres.set()` would for each movie.
+    """
+    Through = Movie.genres.through
+    stored = {}
+    for chunk in denorm.chunked(links):
+        for pk, movie_id, genre_id in Through.objects.using(using).filter(
+                movie_id__in=chunk).values_list('id', 'movie_id', 'genre_id'):
+            stored[(movie_id, genre_id)] = pk
+
+    removed = [link for link in stored if link[1] not in links[link[0]]]
+    denorm.update_links(removed, -1, using=using)
+    for chunk in denorm.chunked(stored[link] for link in removed):
+        Through.objects.using(using).filter(pk__in=chunk).delete()
+
+    added = [(movie_id, genre_id)
+             for movie_id, genre_ids in links.items()
+             for genre_id in genre_ids
+             if (movie_id, genre_id) not in stored]
+    Through.objects.using(using).bulk_create([
+        Through(movie_id=movie_id, genre_id=genre_id)
+        for movie_id, genre_id in added])
+    denorm.update_links(added, 1, using=using)
+
+
+def save_movies(creates, updates, using=DEFAULT_DB_ALIAS):
+    """
+    Insert movies from `creates`, a list of validated serializer data, and
+    apply `updates`, a list of (movie, validated data) pairs. Returns the
+    created movies.
+    """
+    links = {}
+    # titles added or removed, whose prefixes have their sequels changed
+    titles = set()
+    indexed = []
+
+    fields = set()
+    moved = {}
+    for movie, data in updates:
+        data = dict(data)
+        genres = data.pop('genres', None)
+        if genres is not None:
+            links[movie.pk] = {genre.pk for genre in genres}
+        if data.get('title', movie.title) != movie.title:
+            titles.update((movie.title, data['title']))
+            indexed.append(movie)
+        release_date = data.get('release_date', movie.release_date)
+        if release_date.year != movie.release_date.year:
+            moved[movie.pk] = (movie.release_date.year, release_date.year)
+        for name, value in data.items():
+            setattr(movie, name, value)
+        fields.update(data)
+
+    # year statistics move along with the links stored before the update
+    stats = Counter()
+    for movie_id, genre_id in denorm.movie_links(moved, using=using):
+        old_year, new_year = moved[movie_id]
+        stats[(old_year, genre_id)] -= 1
+        stats[(new_year, genre_id)] += 1
+    denorm.update_genre_year_stats(stats, using=using)
+    bulk_update([movie for movie, data in updates], sorted(fields),
+                using=using)
+
+    created, created_genres = [], []
+    for data in creates:
+        data = dict(data)
+        created_genres.append(data.pop('genres', []))
+        created.append(Movie(**data))
+    bulk_insert(created, using=using)
+    for movie, genres in zip(created, created_genres):
+        links[movie.pk] = {genre.pk for genre in genres}
+        titles.add(movie.title)
+    indexed.extend(created)
+
+    set_genre_links(links, using=using)
+    denorm.recount_sequels(titles, using=using)
+    denorm.update_franchises(titles, using=using)
+    search.index_titles(indexed, using=using)
+    readmodel.log_changes(
+        movie_ids=[movie.pk for movie, data in updates] +
+        [movie.pk for movie in created], using=using)
+    return created
+
+
+def save_genres(creates, updates, using=DEFAULT_DB_ALIAS):
+    """Like `save_movies()`, for genres."""
+    fields = set()
+    for genre, data in updates:
+        for name, value in data.items():
+            setattr(genre, name, value)
+        fields.update(data)
+    bulk_update([genre for genre, data in updates], sorted(fields),
+                using=using)
+
+    created = [Genre(**data) for data in creates]
+    bulk_insert(created, using=using)
+    if created:
+        denorm.assign_genre_bits(using=using)
+    readmodel.log_changes(
+        genre_ids=[genre.pk for genre, data in updates] +
+        [genre.pk for genre in created], using=using)
+    return created
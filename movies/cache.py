@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned response cache for the read API.
+
+Every write to movies, genres or their links bumps a data version stored
+in the cache. Cached responses are keyed on the version, so a bump makes
+all of them unreachable at once, and ETags derived from it let clients
+revalidate without the database being touched. Responses to clients
+accepting gzip are cached as compressed by `GZipMiddleware`, so they are
+only compressed once per version.
+
+The version is a fresh random token rather than a counter, so a version
+evicted from the cache can never be reissued for different data. It must
+live in a cache backend shared by every process writing to the database,
+workers and management commands alike (e.g. the file backend), or their
+writes go unseen: the ``movies.E001`` check rejects local memory caches.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.http import HttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date
+
+DATA_VERSION_KEY = 'movies:data-version'
+
+CACHED_PATHS = ('/api/movies/', '/api/genres/', '/api/franchises/',
+                '/api/topGenreByYear/', '/api/stats/')
+
+
+def get_cache():
+    return caches[getattr(settings, 'MOVIES_CACHE_ALIAS', 'default')]
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """The data version must be seen by every process."""
+    if isinstance(get_cache(), LocMemCache):
+        return [checks.Error(
+            'The data version of the response cache is kept in a local '
+            'memory cache, private to each process.',
+            hint='Configure a cache shared by the workers and management '
+                 'commands, e.g. the file based cache, in CACHES, or '
+                 'another alias in MOVIES_CACHE_ALIAS.',
+            id='movies.E001')]
+    return []
+
+
+def get_data_version():
+    """Return the current (version, last modified timestamp)."""
+    data_version = get_cache().get(DATA_VERSION_KEY)
+    if data_version is None:
+        data_version = set_data_version()
+    return data_version
+
+
+def set_data_version():
+    data_version = (uuid.uuid4().hex, int(time.time()))
+    get_cache().set(DATA_VERSION_KEY, data_version, None)
+    return data_version
+
+
+def bump_data_version(using=None):
+    """
+    Invalidate cached responses now, for this process and test cases, and
+    again on commit, for anything cached while the transaction was open.
+    """
+    set_data_version()
+    transaction.on_commit(set_data_version, using=using)
+
+
+class ResponseCacheMiddleware(object):
+    """
+    Serves anonymous GET requests of the read API from the cache, and
+    answers matching `If-None-Match`/`If-Modified-Since` with a 304.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.paths = tuple(getattr(
+            settings, 'MOVIES_CACHED_PATHS', CACHED_PATHS))
+
+    def __call__(self, request):
+        if not self.is_cacheable(request):
+            return self.get_response(request)
+
+        version, last_modified = get_data_version()
+        digest = self.request_digest(request, version)
+        key = 'movies:response:{}'.format(digest)
+        etag = '"{}"'.format(digest)
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return self.add_headers(response, etag, last_modified)
+
+        cache = get_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            status, headers, content = cached
+            response = HttpResponse(content, status=status)
+            for header, value in headers:
+                response[header] = value
+        else:
+            response = self.get_response(request)
+            if (response.status_code == 200 and not response.streaming and
+                    not request.META.get('CSRF_COOKIE_USED') and
+                    not response.cookies):
+                headers = [(header, value) for header, value in
+                           response.items()]
+                cache.set(key, (
+                    response.status_code, headers, response.content))
+            else:
+                return response
+
+        return self.add_headers(response, etag, last_modified)
+
+    def is_cacheable(self, request):
+        # requests that may be authenticated could be served differently
+        return (request.method in ('GET', 'HEAD') and
+                request.path.startswith(self.paths) and
+                'HTTP_AUTHORIZATION' not in request.META and
+                settings.SESSION_COOKIE_NAME not in request.COOKIES)
+
+    def request_digest(self, request, version):
+        return hashlib.md5(force_bytes('\n'.join([
+            version,
+            request.path,
+            request.META.get('QUERY_STRING', ''),
+            request.META.get('HTTP_ACCEPT', ''),
+            # cached compressed or not, as negotiated by GZipMiddleware
+            'gzip' if re_accepts_gzip.search(
+                request.META.get('HTTP_ACCEPT_ENCODING', '')) else '',
+        ]))).hexdigest()
+
+    def add_headers(self, response, etag, last_modified):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Database routing and connection setup.
+
+``ReadReplicaRouter`` sends reads to the read-only ``replica`` alias when
+it is configured, and writes to ``default``. Reads made while ``default``
+has a transaction open stay on it, to see the rows the transaction wrote.
+
+``configure_connection`` applies ``SQLITE_PRAGMAS`` to every new SQLite
+connection, and makes the replica connections read-only. In WAL mode
+readers don't wait for writers, nor writers for readers.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_DB_ALIAS = 'replica'
+
+
+def has_replica():
+    return REPLICA_DB_ALIAS in settings.DATABASES
+
+
+class ReadReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if has_replica() and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return REPLICA_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', ()):
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        if connection.alias == REPLICA_DB_ALIAS:
+            cursor.execute('PRAGMA query_only = ON')
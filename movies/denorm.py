@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Maintenance of denormalized movie data.
+
+Every derived value exposed by the API is stored alongside the rows it is
+derived from, so serializers and views can read it without aggregating.
+Each value has a bulk ``rebuild_*`` function, used by migrations, the
+loader and the ``rebuild_denormalized`` command, and incremental
+functions called from ``movies.signals``.
+
+Rebuild functions look their models up in ``apps`` so migrations can pass
+their historical app registry.
+"""
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
+from django.apps import apps as global_apps
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Case, Count, F, Value, When
+from django.db.models.functions import ExtractYear
+
+from movies import search
+from movies.models import Movie, Genre, GenreYearStat, Franchise
+
+# highest code point, sorts after any character that can follow a prefix
+MAX_CHAR = '\U0010ffff'
+
+# stay below SQLite's default limit of 999 bound parameters
+CHUNK_SIZE = 900
+
+
+def chunked(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# sequels
+
+def title_prefixes(title):
+    return [title[:i] for i in range(1, len(title) + 1)]
+
+
+def titles_with_prefix(title, using=DEFAULT_DB_ALIAS):
+    # a range scan on the title index, unlike `title__startswith`
+    return Movie.objects.using(using).filter(
+        title__gte=title, title__lt=title + MAX_CHAR)
+
+
+def rebuild_sequels_count(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """
+    Recompute ``sequels_count`` for every movie with a single sorted pass.
+
+    In a sorted list all titles sharing a prefix are contiguous, so the
+    number of sequels of a title is the width of its prefix range.
+    """
+    movies = apps.get_model('movies', 'Movie').objects.using(using)
+    rows = sorted(movies.order_by().values_list('title', 'pk'))
+    titles = [title for title, pk in rows]
+
+    counts = {}
+    for title, pk in rows:
+        start = bisect_left(titles, title)
+        end = bisect_left(titles, title + MAX_CHAR, start)
+        if end - start > 1:
+            counts.setdefault(end - start - 1, []).append(pk)
+
+    movies.exclude(sequels_count=0).update(sequels_count=0)
+    for count, pks in counts.items():
+        for chunk in chunked(pks):
+            movies.filter(pk__in=chunk).update(sequels_count=count)
+
+
+def index_title(movie, using=DEFAULT_DB_ALIAS):
+    """Count a newly stored title as a sequel of its prefixes."""
+    movies = Movie.objects.using(using)
+    movies.filter(title__in=title_prefixes(movie.title)).exclude(
+        pk=movie.pk).update(sequels_count=F('sequels_count') + 1)
+
+    count = titles_with_prefix(movie.title, using=using).exclude(
+        pk=movie.pk).count()
+    movies.filter(pk=movie.pk).update(sequels_count=count)
+    movie.sequels_count = count
+
+
+def unindex_title(movie, title, using=DEFAULT_DB_ALIAS):
+    """Stop counting a removed or replaced title as a sequel."""
+    Movie.objects.using(using).filter(
+        title__in=title_prefixes(title)).exclude(
+            pk=movie.pk).update(sequels_count=F('sequels_count') - 1)
+
+
+def recount_sequels(titles, using=DEFAULT_DB_ALIAS):
+    """
+    Recompute ``sequels_count`` of the movies titled like a prefix of any of
+    `titles`. After adding, renaming or removing many movies at once, that
+    covers every count changed when given their old and new titles.
+    """
+    prefixes = set()
+    for title in titles:
+        prefixes.update(title_prefixes(title))
+
+    movies = Movie.objects.using(using)
+    found = []
+    for chunk in chunked(prefixes):
+        found.extend(movies.filter(title__in=chunk).values_list('pk', 'title'))
+
+    # the same range scan as `titles_with_prefix()`, without building a
+    # queryset for each of possibly thousands of titles
+    connection = connections[using]
+    sql = 'SELECT COUNT(*) FROM {} WHERE title >= %s AND title < %s'.format(
+        connection.ops.quote_name(Movie._meta.db_table))
+    counts = {}
+    groups = {}
+    with connection.cursor() as cursor:
+        for pk, title in found:
+            if title not in counts:
+                cursor.execute(sql, [title, title + MAX_CHAR])
+                counts[title] = cursor.fetchone()[0] - 1
+            groups.setdefault(counts[title], []).append(pk)
+
+    for count, pks in groups.items():
+        for chunk in chunked(pks):
+            movies.filter(pk__in=chunk).update(sequels_count=count)
+
+
+# genre links
+
+def movie_links(movie_ids, using=DEFAULT_DB_ALIAS):
+    """Return the stored (movie_id, genre_id) links of the given movies."""
+    links = []
+    for chunk in chunked(movie_ids):
+        links.extend(Movie.genres.through.objects.using(using).filter(
+            movie_id__in=chunk).values_list('movie_id', 'genre_id'))
+    return links
+
+
+def update_links(links, delta, using=DEFAULT_DB_ALIAS):
+    """
+    Account for (movie_id, genre_id) links being added (``delta=1``) or
+    removed (``delta=-1``). Removals must be applied while the movies are
+    still stored.
+    """
+    links = list(links)
+    if not links:
+        return
+
+    years = {}
+    for chunk in chunked({movie_id for movie_id, genre_id in links}):
+        years.update(
+            (pk, release_date.year)
+            for pk, release_date in Movie.objects.using(using).filter(
+                pk__in=chunk).values_list('pk', 'release_date'))
+
+    stats = Counter()
+    for movie_id, genre_id in links:
+        stats[(years[movie_id], genre_id)] += delta
+    update_genre_year_stats(stats, using=using)
+
+    counts = Counter()
+    for movie_id, genre_id in links:
+        counts[genre_id] += delta
+    update_genre_movie_counts(counts, using=using)
+
+    update_genre_masks(links, delta, using=using)
+
+
+def move_year(movie_id, old_year, new_year, using=DEFAULT_DB_ALIAS):
+    """Account for a movie's release year changing."""
+    stats = Counter()
+    for movie_id, genre_id in movie_links([movie_id], using=using):
+        stats[(old_year, genre_id)] -= 1
+        stats[(new_year, genre_id)] += 1
+    update_genre_year_stats(stats, using=using)
+
+
+# genre per year statistics
+
+def rebuild_genre_year_stats(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """Recompute the whole (year, genre, count) table with one GROUP BY."""
+    Movie = apps.get_model('movies', 'Movie')
+    GenreYearStat = apps.get_model('movies', 'GenreYearStat')
+
+    rows = Movie.genres.through.objects.using(using).annotate(
+        year=ExtractYear('movie__release_date')).values(
+            'year', 'genre_id').annotate(
+                movie_count=Count('id')).order_by()
+
+    GenreYearStat.objects.using(using).all().delete()
+    GenreYearStat.objects.using(using).bulk_create(
+        [GenreYearStat(**row) for row in rows])
+
+
+def update_genre_year_stats(changes, using=DEFAULT_DB_ALIAS):
+    """Apply a {(year, genre_id): delta} counter to the statistics."""
+    changes = {key: delta for key, delta in changes.items() if delta}
+    if not changes:
+        return
+
+    stats = GenreYearStat.objects.using(using)
+    years = {year for year, genre_id in changes}
+    existing = set(stats.filter(year__in=years).values_list(
+        'year', 'genre_id'))
+
+    stats.bulk_create([
+        GenreYearStat(year=year, genre_id=genre_id, movie_count=delta)
+        for (year, genre_id), delta in changes.items()
+        if (year, genre_id) not in existing and delta > 0])
+
+    # one statement per (year, delta) rather than per row
+    groups = {}
+    for (year, genre_id), delta in changes.items():
+        if (year, genre_id) in existing:
+            groups.setdefault((year, delta), []).append(genre_id)
+    for (year, delta), genre_ids in groups.items():
+        stats.filter(year=year, genre_id__in=genre_ids).update(
+            movie_count=F('movie_count') + delta)
+
+    stats.filter(year__in=years, movie_count=0).delete()
+
+
+# genre movie counts
+
+def genre_movie_counts(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """Return {genre_id: count} computed from the stored links."""
+    Genre = apps.get_model('movies', 'Genre')
+    Movie = apps.get_model('movies', 'Movie')
+
+    counts = dict.fromkeys(
+        Genre.objects.using(using).values_list('pk', flat=True), 0)
+    counts.update(Movie.genres.through.objects.using(using).values_list(
+        'genre_id').annotate(Count('id')).order_by())
+    return counts
+
+
+def set_genre_movie_counts(counts, apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """Store a {genre_id: count} mapping, one statement per count."""
+    genres = apps.get_model('movies', 'Genre').objects.using(using)
+    groups = {}
+    for genre_id, count in counts.items():
+        groups.setdefault(count, []).append(genre_id)
+    for count, genre_ids in groups.items():
+        for chunk in chunked(genre_ids):
+            genres.filter(pk__in=chunk).update(movie_count=count)
+
+
+def rebuild_genre_movie_counts(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    set_genre_movie_counts(
+        genre_movie_counts(apps=apps, using=using), apps=apps, using=using)
+
+
+def update_genre_movie_counts(changes, using=DEFAULT_DB_ALIAS):
+    """Apply a {genre_id: delta} counter to the genre movie counts."""
+    groups = {}
+    for genre_id, delta in changes.items():
+        if delta:
+            groups.setdefault(delta, []).append(genre_id)
+    for delta, genre_ids in groups.items():
+        for chunk in chunked(genre_ids):
+            Genre.objects.using(using).filter(pk__in=chunk).update(
+                movie_count=F('movie_count') + delta)
+
+
+# genre bitmaps
+
+# bits of a signed 64 bit integer, but the sign
+GENRE_BITS = 63
+
+
+def free_genre_bit(using=DEFAULT_DB_ALIAS):
+    """Return the lowest bit no genre has taken, None if there is none."""
+    taken = set(Genre.objects.using(using).exclude(bit=None).values_list(
+        'bit', flat=True))
+    return next((bit for bit in range(GENRE_BITS) if bit not in taken), None)
+
+
+def assign_genre_bits(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """Give the free bits to the genres without one, oldest first."""
+    genres = apps.get_model('movies', 'Genre').objects.using(using)
+    taken = set(genres.exclude(bit=None).values_list('bit', flat=True))
+    free = [bit for bit in range(GENRE_BITS) if bit not in taken]
+    assigned = list(zip(genres.filter(bit=None).order_by('pk').values_list(
+        'pk', flat=True)[:len(free)], free))
+    if assigned:
+        # a single statement, there are no more than GENRE_BITS of them
+        genres.filter(pk__in=[pk for pk, bit in assigned]).update(bit=Case(
+            *[When(pk=pk, then=Value(bit)) for pk, bit in assigned]))
+        fill_genre_bits(dict(assigned), apps=apps, using=using)
+
+
+def fill_genre_bits(bits, apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """
+    Set the bits given to genres, {pk: bit}, on the movies they already
+    have: genres created while all bits were taken get one once freed.
+    """
+    Movie = apps.get_model('movies', 'Movie')
+    # new genres have no movies yet
+    linked = Movie.genres.through.objects.using(using).filter(
+        genre_id__in=list(bits)).values_list('genre_id', flat=True).distinct()
+    for pk in list(linked):
+        Movie.objects.using(using).filter(genres=pk).update(
+            genre_mask=F('genre_mask').bitor(1 << bits[pk]))
+
+
+def rebuild_genre_masks(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """Recompute ``genre_mask`` with one statement per genre."""
+    assign_genre_bits(apps=apps, using=using)
+    Genre = apps.get_model('movies', 'Genre')
+    movies = apps.get_model('movies', 'Movie').objects.using(using)
+
+    movies.exclude(genre_mask=0).update(genre_mask=0)
+    for pk, bit in Genre.objects.using(using).exclude(bit=None).values_list(
+            'pk', 'bit'):
+        movies.filter(genres=pk).update(
+            genre_mask=F('genre_mask').bitor(1 << bit))
+
+
+def update_genre_masks(links, delta, using=DEFAULT_DB_ALIAS):
+    """Set (``delta=1``) or clear (``delta=-1``) the bits of links."""
+    bits = dict(Genre.objects.using(using).filter(
+        pk__in={genre_id for movie_id, genre_id in links}).exclude(
+            bit=None).values_list('pk', 'bit'))
+    groups = {}
+    for movie_id, genre_id in links:
+        if genre_id in bits:
+            groups.setdefault(bits[genre_id], []).append(movie_id)
+
+    for bit, movie_ids in groups.items():
+        if delta > 0:
+            mask = F('genre_mask').bitor(1 << bit)
+        else:
+            mask = F('genre_mask').bitand(~(1 << bit))
+        for chunk in chunked(movie_ids):
+            Movie.objects.using(using).filter(pk__in=chunk).update(
+                genre_mask=mask)
+
+
+def clear_genre_bit(genre, using=DEFAULT_DB_ALIAS):
+    """Free the bit of a genre being deleted, for a later genre to reuse."""
+    if genre.bit is not None:
+        Movie.objects.using(using).annotate(
+            has_bit=F('genre_mask').bitand(1 << genre.bit)).exclude(
+                has_bit=0).update(genre_mask=F('genre_mask').bitand(
+                    ~(1 << genre.bit)))
+
+
+# franchises
+
+def franchise_roots(titles):
+    """
+    Return the franchise root of each of sorted `titles`: the shortest of
+    the titles that is a prefix of it. In a sorted list the titles
+    extending a root follow it, so one pass finds every root.
+    """
+    roots = []
+    root = None
+    for title in titles:
+        if root is None or not title.startswith(root):
+            root = title
+        roots.append(root)
+    return roots
+
+
+def regroup_franchises(movies, franchises, using=DEFAULT_DB_ALIAS):
+    """
+    Store the franchises of `movies`, a queryset of all the movies titled
+    with some prefix, `franchises` being those whose title has it too.
+    Franchises keep their primary key as long as their root title stays.
+    """
+    rows = sorted(movies.order_by().values_list(
+        'title', 'pk', 'franchise_id'))
+    groups = OrderedDict()
+    for (title, pk, franchise_id), root in zip(
+            rows, franchise_roots([title for title, pk, f in rows])):
+        groups.setdefault(root, []).append((pk, franchise_id))
+    # a title without sequels, nor remakes, is no franchise
+    groups = OrderedDict((root, members) for root, members in groups.items()
+                         if len(members) > 1)
+
+    stored = {title: (pk, movie_count) for title, pk, movie_count in
+              franchises.values_list('title', 'pk', 'movie_count')}
+    missing = [root for root in groups if root not in stored]
+    if missing:
+        franchises.model.objects.using(using).bulk_create(
+            [franchises.model(title=root) for root in missing])
+        for chunk in chunked(missing):
+            stored.update(
+                (title, (pk, movie_count)) for title, pk, movie_count in
+                franchises.filter(title__in=chunk).values_list(
+                    'title', 'pk', 'movie_count'))
+
+    moves = {}
+    counts = {}
+    for root, members in groups.items():
+        pk, movie_count = stored[root]
+        for movie_id, franchise_id in members:
+            if franchise_id != pk:
+                moves.setdefault(pk, []).append(movie_id)
+        if movie_count != len(members):
+            counts.setdefault(len(members), []).append(pk)
+    grouped = {movie_id for members in groups.values()
+               for movie_id, franchise_id in members}
+    moves[None] = [pk for title, pk, franchise_id in rows
+                   if franchise_id is not None and pk not in grouped]
+
+    for franchise_id, movie_ids in moves.items():
+        for chunk in chunked(movie_ids):
+            movies.model.objects.using(using).filter(pk__in=chunk).update(
+                franchise_id=franchise_id)
+    for movie_count, pks in counts.items():
+        for chunk in chunked(pks):
+            franchises.filter(pk__in=chunk).update(movie_count=movie_count)
+    for chunk in chunked(pk for title, (pk, movie_count) in stored.items()
+                         if title not in groups):
+        franchises.filter(pk__in=chunk).delete()
+
+
+def rebuild_franchises(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    """Regroup every movie in a single sorted pass."""
+    regroup_franchises(
+        apps.get_model('movies', 'Movie').objects.using(using),
+        apps.get_model('movies', 'Franchise').objects.using(using),
+        using=using)
+
+
+def update_franchises(titles, using=DEFAULT_DB_ALIAS):
+    """
+    Regroup the movies whose franchise may have changed with movies titled
+    `titles` being added, renamed or removed (given their old and new
+    titles): those sharing a root title with one of `titles`.
+    """
+    prefixes = set()
+    for title in titles:
+        prefixes.update(title_prefixes(title))
+    stored = set()
+    for chunk in chunked(prefixes):
+        stored.update(Movie.objects.using(using).filter(
+            title__in=chunk).values_list('title', flat=True))
+
+    # the shortest stored prefix of a title is its root, or itself
+    regions = set()
+    for title in titles:
+        regions.add(next((prefix for prefix in title_prefixes(title)
+                          if prefix in stored), title))
+    # regions within others are regrouped with them
+    roots = []
+    for root in sorted(regions):
+        if not roots or not root.startswith(roots[-1]):
+            roots.append(root)
+
+    for root in roots:
+        regroup_franchises(
+            titles_with_prefix(root, using=using),
+            Franchise.objects.using(using).filter(
+                title__gte=root, title__lt=root + MAX_CHAR),
+            using=using)
+
+
+REBUILDERS = OrderedDict([
+    ('sequels_count', rebuild_sequels_count),
+    ('genre_year_stats', rebuild_genre_year_stats),
+    ('genre_movie_counts', rebuild_genre_movie_counts),
+    ('genre_masks', rebuild_genre_masks),
+    ('franchises', rebuild_franchises),
+    ('title_search', search.rebuild_title_search),
+])
+
+
+def rebuild_all(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    for rebuild in REBUILDERS.values():
+        rebuild(apps=apps, using=using)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of the whole movie catalog.
+
+Movies are read in primary key order, one keyset chunk at a time, with
+the genre links of each chunk, so memory use depends on the chunk size
+only. Each chunk is rendered to a single string as soon as it is read.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import csv
+import json
+
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.six import StringIO
+
+from movies.models import Movie, Genre
+
+CHUNK_SIZE = 2000
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+# joins genre names within a CSV field
+GENRE_SEPARATOR = '|'
+
+
+def export_chunks(sequels=False, chunk_size=CHUNK_SIZE,
+                  using=DEFAULT_DB_ALIAS):
+    """Yield lists of movie rows, each a dict, in primary key order."""
+    genre_names = dict(
+        Genre.objects.using(using).order_by().values_list('pk', 'name'))
+    movies = Movie.objects.using(using).order_by('pk')
+    links = Movie.genres.through.objects.using(using)
+    fields = ['pk', 'title', 'release_date']
+    if sequels:
+        fields.append('sequels_count')
+
+    last_pk = 0
+    while True:
+        chunk = list(movies.filter(pk__gt=last_pk).values(*fields)[
+            :chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1]['pk']
+
+        genres = {}
+        for movie_id, genre_id in links.filter(
+                movie_id__gte=chunk[0]['pk'],
+                movie_id__lte=last_pk).values_list('movie_id', 'genre_id'):
+            genres.setdefault(movie_id, []).append(genre_names[genre_id])
+
+        rows = []
+        for movie in chunk:
+            row = OrderedDict([
+                ('id', movie['pk']),
+                ('title', movie['title']),
+                ('release_date', movie['release_date'].isoformat()),
+                ('genres', sorted(genres.get(movie['pk'], []))),
+            ])
+            if sequels:
+                row['sequels_count'] = movie['sequels_count']
+            rows.append(row)
+        yield rows
+
+        if len(chunk) < chunk_size:
+            return
+
+
+def columns(sequels=False):
+    names = ['id', 'title', 'release_date', 'genres']
+    if sequels:
+        names.append('sequels_count')
+    return names
+
+
+def render_ndjson(chunks, sequels=False):
+    for rows in chunks:
+        yield ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def render_csv(chunks, sequels=False):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    # the header goes out before the first query
+    writer.writerow(columns(sequels))
+    yield flush()
+    for rows in chunks:
+        for row in rows:
+            row['genres'] = GENRE_SEPARATOR.join(row['genres'])
+            writer.writerow(row.values())
+        yield flush()
+
+
+RENDERERS = {
+    'ndjson': render_ndjson,
+    'csv': render_csv,
+}
+
+
+def export_movies(format, sequels=False, chunk_size=CHUNK_SIZE,
+                  using=DEFAULT_DB_ALIAS):
+    """Yield the catalog rendered in `format`, a string per chunk."""
+    chunks = export_chunks(
+        sequels=sequels, chunk_size=chunk_size, using=using)
+    return RENDERERS[format](chunks, sequels=sequels)
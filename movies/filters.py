@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db.models import Exists, F, OuterRef, Q
+from django_filters import rest_framework as filters
+
+from movies.models import Movie, Genre, Franchise
+from movies.search import filter_titles
+
+
+def split_genres(genres):
+    """Return the `genre_mask` bits of genres, and the genres without one."""
+    mask, unmasked = 0, []
+    for genre in genres:
+        if genre.bit is None:
+            unmasked.append(genre)
+        else:
+            mask |= 1 << genre.bit
+    return mask, unmasked
+
+
+def in_genres(genres):
+    # a correlated EXISTS rather than a join, so the database can keep
+    # walking movies in index order and needs no DISTINCT
+    return Exists(Movie.genres.through.objects.filter(
+        movie_id=OuterRef('pk'), genre_id__in=[genre.pk for genre in genres]))
+
+
+def filter_any_genre(queryset, genres):
+    """Filter movies of any of `genres`."""
+    mask, unmasked = split_genres(genres)
+    condition = Q()
+    if mask:
+        queryset = queryset.annotate(
+            any_genre_bits=F('genre_mask').bitand(mask))
+        condition |= Q(any_genre_bits__gt=0)
+    if unmasked:
+        queryset = queryset.annotate(in_genres=in_genres(unmasked))
+        condition |= Q(in_genres=True)
+    return queryset.filter(condition)
+
+
+class MovieFilter(filters.FilterSet):
+    """
+    Genre filters test bits of `Movie.genre_mask`, so any combination is
+    resolved in a single pass over movies. Genres beyond the 63 bits of
+    the mask fall back to an EXISTS subquery.
+    """
+    # movies of any of the genres
+    genres = filters.ModelMultipleChoiceFilter(
+        queryset=Genre.objects.all(), method='filter_genres')
+    genres_all = filters.ModelMultipleChoiceFilter(
+        queryset=Genre.objects.all(), method='filter_genres_all')
+    genres_none = filters.ModelMultipleChoiceFilter(
+        queryset=Genre.objects.all(), method='filter_genres_none')
+    search = filters.CharFilter(method='filter_search')
+    title_prefix = filters.CharFilter(method='filter_title_prefix')
+
+    class Meta:
+        model = Movie
+        fields = ('genres', 'franchise')
+
+    def filter_genres(self, queryset, name, value):
+        if not value:
+            return queryset
+        return filter_any_genre(queryset, value)
+
+    def filter_genres_all(self, queryset, name, value):
+        mask, unmasked = split_genres(value)
+        if mask:
+            queryset = queryset.annotate(
+                all_genre_bits=F('genre_mask').bitand(mask)).filter(
+                    all_genre_bits=mask)
+        for genre in unmasked:
+            in_genre = 'in_genre_{}'.format(genre.pk)
+            queryset = queryset.annotate(
+                **{in_genre: in_genres([genre])}).filter(**{in_genre: True})
+        return queryset
+
+    def filter_genres_none(self, queryset, name, value):
+        mask, unmasked = split_genres(value)
+        if mask:
+            queryset = queryset.annotate(
+                no_genre_bits=F('genre_mask').bitand(mask)).filter(
+                    no_genre_bits=0)
+        if unmasked:
+            queryset = queryset.annotate(
+                in_no_genres=in_genres(unmasked)).filter(in_no_genres=False)
+        return queryset
+
+    def filter_search(self, queryset, name, value):
+        return filter_titles(queryset, value)
+
+    def filter_title_prefix(self, queryset, name, value):
+        return filter_titles(queryset, value, prefix=True)
+
+
+class FranchiseFilter(filters.FilterSet):
+    """
+    Franchises with a movie of any of `genres`, released in `year` or
+    between `year_from` and `year_to`. The conditions apply to the same
+    movie, in one EXISTS subquery.
+    """
+    genres = filters.ModelMultipleChoiceFilter(
+        queryset=Genre.objects.all(), method='filter_movies')
+    year = filters.NumberFilter(
+        method='filter_movies', min_value=1, max_value=9998)
+    year_from = filters.NumberFilter(
+        method='filter_movies', min_value=1, max_value=9998)
+    year_to = filters.NumberFilter(
+        method='filter_movies', min_value=1, max_value=9998)
+
+    class Meta:
+        model = Franchise
+        fields = ()
+
+    def filter_movies(self, queryset, name, value):
+        # applied together by `qs`
+        return queryset
+
+    @property
+    def qs(self):
+        if not hasattr(self, '_qs'):
+            queryset = super(FranchiseFilter, self).qs
+            if self.is_bound and self.form.is_valid():
+                movies = self.filter_movie_conditions(self.form.cleaned_data)
+                if movies is not None:
+                    queryset = queryset.annotate(has_movies=Exists(
+                        movies.values('pk'))).filter(has_movies=True)
+            self._qs = queryset
+        return self._qs
+
+    def filter_movie_conditions(self, data):
+        """The movies of a franchise meeting the conditions, if any."""
+        movies = Movie.objects.filter(franchise=OuterRef('pk'))
+        year_from = data.get('year_from')
+        year_to = data.get('year_to')
+        if data.get('year') is not None:
+            year_from = year_to = data['year']
+        if data.get('genres'):
+            movies = filter_any_genre(movies, data['genres'])
+        if year_from is not None:
+            movies = movies.filter(
+                release_date__gte=datetime.date(int(year_from), 1, 1))
+        if year_to is not None:
+            movies = movies.filter(
+                release_date__lt=datetime.date(int(year_to) + 1, 1, 1))
+        if data.get('genres') or year_from is not None or year_to is not None:
+            return movies
+        return None
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load testing of the WSGI application.
+
+A scenario is a small JSON file weighting the endpoints to request::
+
+    {
+        "duration": 10,
+        "threads": 8,
+        "headers": {"Accept-Encoding": "gzip"},
+        "endpoints": [
+            {"name": "movie_list", "path": "/api/movies/?page={page}",
+             "weight": 10},
+            {"name": "movie_detail", "path": "/api/movies/{movie}/",
+             "weight": 5}
+        ]
+    }
+
+Each placeholder of ``PLACEHOLDERS`` in a path takes a random value per
+request, drawn from the catalog before the run. Worker threads, in one or
+more processes, pick endpoints at random in proportion to their weight
+until the duration is over, or until they made `requests` requests between
+them. They call the application in-process, or a local HTTP server
+started for the run. Every latency is kept, so percentiles are exact.
+"""
+from __future__ import unicode_literals
+
+from collections import Counter, OrderedDict
+from io import BytesIO
+from itertools import accumulate
+import http.client
+import json
+import multiprocessing
+import random
+import socketserver
+import string
+import threading
+import time
+from wsgiref.util import setup_testing_defaults
+
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+from django.db import connections
+from django.db.models import Max
+from rest_framework.settings import api_settings
+
+from movies.models import Movie, Genre, GenreYearStat, Franchise
+
+PLACEHOLDERS = ('movie', 'genre', 'franchise', 'year', 'word', 'page')
+
+PERCENTILES = (50, 95, 99)
+
+# movies drawn from, kept under SQLite's limit of query parameters
+SAMPLE_SIZE = 500
+
+DURATION = 10
+THREADS = 8
+
+
+def placeholders(path):
+    return {name for _, name, _, _ in string.Formatter().parse(path) if name}
+
+
+def load_scenario(path):
+    """Read a scenario file, filling in the endpoint defaults."""
+    try:
+        with open(path) as scenario_file:
+            scenario = json.load(scenario_file)
+    except (OSError, ValueError) as e:
+        raise ValueError('Cannot read scenario {}: {}'.format(path, e))
+    endpoints = scenario.get('endpoints') if isinstance(
+        scenario, dict) else None
+    if not endpoints:
+        raise ValueError('Scenario {} has no endpoints'.format(path))
+    for endpoint in endpoints:
+        if not endpoint.get('path', '').startswith('/'):
+            raise ValueError('Endpoint {} has no absolute path'.format(
+                endpoint))
+        endpoint.setdefault('name', endpoint['path'])
+        endpoint.setdefault('weight', 1)
+        if endpoint['weight'] <= 0:
+            raise ValueError('Endpoint {} has no positive weight'.format(
+                endpoint['name']))
+        unknown = placeholders(endpoint['path']).difference(PLACEHOLDERS)
+        if unknown:
+            raise ValueError('Unknown placeholders {} in {}'.format(
+                ', '.join(sorted(unknown)), endpoint['path']))
+    return scenario
+
+
+def sample_values(scenario, seed=0):
+    """Return the values to draw from for each placeholder of a scenario."""
+    rnd = random.Random(seed)
+    used = set().union(*(placeholders(endpoint['path'])
+                         for endpoint in scenario['endpoints']))
+    values = {}
+    if used & {'movie', 'word'}:
+        # random primary keys, rather than an ORDER BY RANDOM() of them all
+        last = Movie.objects.aggregate(last=Max('pk'))['last'] or 0
+        movies = Movie.objects.filter(pk__in=[
+            rnd.randint(1, last) for _ in range(SAMPLE_SIZE)]).values_list(
+                'pk', 'title') if last else []
+        values['movie'] = [pk for pk, title in movies]
+        values['word'] = sorted({word for pk, title in movies
+                                 for word in title.split() if word.isalpha()})
+    if 'genre' in used:
+        values['genre'] = list(Genre.objects.values_list('pk', flat=True))
+    if 'franchise' in used:
+        values['franchise'] = list(Franchise.objects.order_by('?').values_list(
+            'pk', flat=True)[:SAMPLE_SIZE])
+    if 'year' in used:
+        values['year'] = list(GenreYearStat.objects.order_by().values_list(
+            'year', flat=True).distinct())
+    if 'page' in used:
+        pages = Movie.objects.count() // api_settings.PAGE_SIZE
+        values['page'] = list(range(1, max(pages, 1) + 1))
+    for name in used:
+        if not values[name]:
+            raise ValueError('No {} values to request'.format(name))
+    return values
+
+
+def wsgi_requester(application, headers):
+    """Return a function requesting a path from the WSGI application."""
+    base = {}
+    setup_testing_defaults(base)
+    for name, value in headers.items():
+        base['HTTP_' + name.upper().replace('-', '_')] = value
+
+    def request(path):
+        path_info, _, query_string = path.partition('?')
+        environ = dict(base, PATH_INFO=path_info, QUERY_STRING=query_string)
+        environ['wsgi.input'] = BytesIO()
+        statuses = []
+
+        def start_response(status, response_headers, exc_info=None):
+            statuses.append(status)
+            return lambda data: None
+
+        body = application(environ, start_response)
+        try:
+            for chunk in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return int(statuses[0].split()[0])
+    return request
+
+
+def http_requester(address, headers):
+    """Return a function requesting a path from the server at `address`."""
+    def request(path):
+        connection = http.client.HTTPConnection(*address, timeout=60)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+    return request
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadTestServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # as many waiting connections as there are load test threads
+    request_queue_size = 128
+
+
+def start_server(application):
+    """Serve the application on a free local port, in the background."""
+    server = LoadTestServer(('127.0.0.1', 0), QuietRequestHandler)
+    server.set_app(application)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class RequestBudget(object):
+    """The requests left to make, None for no limit, shared by threads."""
+
+    def __init__(self, requests):
+        self.left = requests
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.left is None:
+            return True
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+def new_results(scenario):
+    return OrderedDict(
+        (endpoint['name'], {'latencies': [], 'statuses': Counter()})
+        for endpoint in scenario['endpoints'])
+
+
+def merge_results(results, other):
+    for name, result in other.items():
+        results[name]['latencies'].extend(result['latencies'])
+        results[name]['statuses'].update(result['statuses'])
+
+
+def run_worker(request, scenario, values, deadline, budget, seed, results):
+    rnd = random.Random(seed)
+    endpoints = [(endpoint['name'], endpoint['path'],
+                  placeholders(endpoint['path']))
+                 for endpoint in scenario['endpoints']]
+    cum_weights = list(accumulate(
+        endpoint['weight'] for endpoint in scenario['endpoints']))
+    worker_results = new_results(scenario)
+    try:
+        while time.time() < deadline and budget.take():
+            name, path, names = rnd.choices(
+                endpoints, cum_weights=cum_weights)[0]
+            path = path.format(**{
+                placeholder: rnd.choice(values[placeholder])
+                for placeholder in names})
+            start = time.time()
+            try:
+                status = request(path)
+            except Exception:
+                status = 'error'
+            worker_results[name]['latencies'].append(
+                (time.time() - start) * 1000)
+            worker_results[name]['statuses'][status] += 1
+    finally:
+        # in-process requests opened connections of this thread
+        connections.close_all()
+    results.append(worker_results)
+
+
+def run_threads(request, scenario, values, threads, deadline, requests,
+                seed):
+    """Run the scenario from threads, returning their merged results."""
+    budget = RequestBudget(requests)
+    worker_results = []
+    workers = [threading.Thread(target=run_worker, args=(
+        request, scenario, values, deadline, budget, seed + i,
+        worker_results)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results = new_results(scenario)
+    for other in worker_results:
+        merge_results(results, other)
+    return results
+
+
+def run_processes(request, scenario, values, processes, threads, deadline,
+                  requests, seed):
+    """
+    Run `run_threads` in forked processes, returning merged results.
+    Raises RuntimeError if a process dies without sending its results.
+    """
+    # children must not share the connections of this process
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+
+    def run_process(index, requests, sender):
+        sender.send(run_threads(request, scenario, values, threads, deadline,
+                                requests, seed + index * threads))
+        sender.close()
+
+    children = []
+    for index in range(processes):
+        share = None
+        if requests is not None:
+            share = requests // processes + (index < requests % processes)
+        receiver, sender = context.Pipe(duplex=False)
+        child = context.Process(target=run_process,
+                                args=(index, share, sender))
+        child.start()
+        # only the child holds the sending end, so its exit ends the pipe
+        sender.close()
+        children.append((child, receiver))
+
+    results = new_results(scenario)
+    failed = []
+    for child, receiver in children:
+        try:
+            merge_results(results, receiver.recv())
+        except EOFError:
+            failed.append(child)
+        receiver.close()
+    for child, receiver in children:
+        child.join()
+    if failed:
+        raise RuntimeError('Load test process(es) died without results: '
+                           '{}'.format(', '.join(
+                               'pid {} (exit code {})'.format(
+                                   child.pid, child.exitcode)
+                               for child in failed)))
+    return results
+
+
+def percentile(latencies, p):
+    """The `p`th percentile of sorted latencies."""
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def summarize(results, elapsed):
+    """Per endpoint, and total, throughput, latencies and errors."""
+    total = {'latencies': [], 'statuses': Counter()}
+    for result in results.values():
+        total['latencies'].extend(result['latencies'])
+        total['statuses'].update(result['statuses'])
+    summary = OrderedDict()
+    for name, result in list(results.items()) + [('total', total)]:
+        latencies = sorted(result['latencies'])
+        count = len(latencies)
+        # no response, or an error status
+        errors = sum(n for status, n in result['statuses'].items()
+                     if status == 'error' or status >= 400)
+        summary[name] = OrderedDict([
+            ('requests', count),
+            ('rps', count / elapsed if elapsed else 0.0),
+        ] + [
+            ('p{}_ms'.format(p), percentile(latencies, p))
+            for p in PERCENTILES
+        ] + [
+            ('errors', errors),
+            ('error_rate', errors / count if count else 0.0),
+            ('statuses', OrderedDict(sorted(
+                (str(status), n)
+                for status, n in result['statuses'].items()))),
+        ])
+    return summary
+
+
+def run(application, scenario, values, threads=THREADS, processes=1,
+        duration=DURATION, requests=None, server=False, seed=0):
+    """
+    Run a scenario against the WSGI application, in-process or through a
+    local server. Returns the `summarize` of the run and its duration.
+    """
+    headers = scenario.get('headers', {})
+    http_server = None
+    if server:
+        http_server = start_server(application)
+        request = http_requester(http_server.server_address[:2], headers)
+    else:
+        request = wsgi_requester(application, headers)
+    try:
+        start = time.time()
+        deadline = start + duration if duration else float('inf')
+        if processes > 1:
+            results = run_processes(request, scenario, values, processes,
+                                    threads, deadline, requests, seed)
+        else:
+            results = run_threads(request, scenario, values, threads,
+                                  deadline, requests, seed)
+        elapsed = time.time() - start
+    finally:
+        if http_server is not None:
+            http_server.shutdown()
+            http_server.server_close()
+    return summarize(results, elapsed), elapsed
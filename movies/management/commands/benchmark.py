@@ -0,0 +1,382 @@
+from collections import OrderedDict
+from contextlib import ExitStack
+from itertools import accumulate
+from pathlib import Path
+import datetime
+import json
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from movies import denorm, renderers
+from movies.cache import set_data_version
+from movies.db import REPLICA_DB_ALIAS, has_replica
+from movies.management.commands.loaddata_movies_genres import (
+    Command as LoadDataCommand)
+from movies.models import Movie, Genre
+from movies.serializers import MovieSerializer
+
+# genre frequencies of the bundled movies_genres.tsv
+GENRE_WEIGHTS = OrderedDict([
+    ('Comedy', 2323), ('Drama', 1813), ('Documentary', 1226),
+    ('Family', 632), ('Animation', 472), ('Romance', 455),
+    ('Adventure', 318), ('Music', 309), ('Action', 307), ('Crime', 305),
+    ('News', 253), ('Sport', 228), ('History', 213), ('Thriller', 208),
+    ('Fantasy', 193), ('Mystery', 183), ('Biography', 117), ('Horror', 114),
+    ('Short', 113), ('Musical', 82), ('War', 74), ('Western', 33),
+    ('Adult', 29),
+])
+
+# leading words shared by many titles, as in real catalogs
+TITLE_STARTS = ['The', 'A', 'La', 'Le', 'Die', 'El', 'Il', 'Les', 'My', 'Love']
+SEQUEL_SUFFIXES = [' 2', ' 3', ' II', ' III', ' Part II', ' Returns',
+                   ': The Beginning', ' Reloaded']
+
+# movies of the page rendered by each JSON renderer
+RENDER_PAGE_SIZE = 1000
+
+# a slower median than baseline * (1 + tolerance) is a regression, unless
+# the difference is below this noise floor
+NOISE_FLOOR_MS = 1.0
+
+
+def generate_tsv(path, rows, seed=0):
+    """
+    Write `rows` synthetic (title, year, genre) lines. Returns the number
+    of movies. Titles draw from a Zipf-like vocabulary, about one in ten
+    movies is a sequel of an earlier title, and most movies have one or
+    two genres. Titles are made unique by the number of the movie, and
+    sequels by taking each suffix once per title, so memory doesn't grow
+    with `rows`.
+    """
+    rnd = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rnd.choice(letters) for _ in range(rnd.randint(2, 9)))
+             .capitalize() for _ in range(max(1000, rows // 20))]
+    word_weights = list(accumulate(
+        1.0 / rank for rank in range(1, len(words) + 1)))
+    genres = list(GENRE_WEIGHTS)
+    genre_weights = list(accumulate(GENRE_WEIGHTS.values()))
+
+    # (title, sequel suffixes it has not taken yet)
+    bases = []
+    written = movies = 0
+    with open(str(path), 'w') as data:
+        while written < rows:
+            base = rnd.choice(bases) if bases else None
+            if base and base[1] and rnd.random() < 0.1:
+                title = base[0] + base[1].pop(rnd.randrange(len(base[1])))
+            else:
+                title = ' '.join(rnd.choices(
+                    words, cum_weights=word_weights, k=rnd.randint(1, 4)))
+                if rnd.random() < 0.3:
+                    title = '{} {}'.format(rnd.choice(TITLE_STARTS), title)
+                # closed, so no title is the prefix of another by its number
+                title = '{} [{}]'.format(title, movies)
+                if len(bases) < 10000:
+                    bases.append((title, list(SEQUEL_SUFFIXES)))
+                elif rnd.random() < 0.01:
+                    bases[rnd.randrange(len(bases))] = (
+                        title, list(SEQUEL_SUFFIXES))
+
+            year = max(1890, 2020 - int(rnd.expovariate(1 / 25.0)))
+            count = min(rows - written, 1 + int(rnd.expovariate(2.5)))
+            for genre in set(rnd.choices(
+                    genres, cum_weights=genre_weights, k=count)):
+                data.write('{}\t{}\t{}\n'.format(title, year, genre))
+                written += 1
+            movies += 1
+    return movies
+
+
+def compare_results(results, baseline, tolerance):
+    """Return (name, baseline ms, current ms) of the regressed timings."""
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        before, after = base['median_ms'], result['median_ms']
+        if after > before * (1 + tolerance) and after - before > NOISE_FLOOR_MS:
+            regressions.append((name, before, after))
+    return regressions
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the loader and API endpoints on a synthetic dataset '
+            'in a throwaway database')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=10000,
+            help='Movie genre rows to generate (default: %(default)s).')
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='Timed requests per endpoint (default: %(default)s).')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the synthetic dataset (default: %(default)s).')
+        parser.add_argument(
+            '--output', default='benchmark.json',
+            help='JSON file to write results to (default: %(default)s).')
+        parser.add_argument(
+            '--baseline',
+            help='JSON results of an earlier run to compare against, '
+                 'fails on regressions.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Allowed slowdown against the baseline (default: '
+                 '%(default)s).')
+        parser.add_argument(
+            '--write-tsv', dest='write_tsv',
+            help='Only write the synthetic TSV to this path.')
+        parser.add_argument(
+            '--db-path', dest='db_path',
+            help='Build the database in this SQLite file, and keep it, '
+                 'instead of in memory.')
+
+    def handle(self, *args, **options):
+        if options['rows'] <= 0:
+            raise CommandError('--rows must be positive')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+        if options['write_tsv']:
+            movies = generate_tsv(
+                options['write_tsv'], options['rows'], options['seed'])
+            self.stdout.write('Wrote {} rows, {} movies to {}'.format(
+                options['rows'], movies, options['write_tsv']))
+            return
+
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark runs on SQLite only')
+        old_name = connection.settings_dict['NAME']
+        keepdb = bool(options['db_path'])
+        if keepdb:
+            # always start from an empty database, then leave it behind
+            db_path = Path(options['db_path'])
+            if db_path.exists():
+                db_path.unlink()
+            connection.settings_dict['TEST']['NAME'] = str(db_path)
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb)
+        # reads are routed to the replica, make it read the new database
+        replica = connections[REPLICA_DB_ALIAS] if has_replica() else None
+        if replica is not None:
+            old_replica_name = replica.settings_dict['NAME']
+            replica.close()
+            replica.creation.set_as_test_mirror(connection.settings_dict)
+        try:
+            results = self.run(options)
+        finally:
+            if replica is not None:
+                replica.close()
+                replica.settings_dict['NAME'] = old_replica_name
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=keepdb)
+
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+        self.stdout.write('Results written to {}'.format(options['output']))
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = compare_results(
+                    results, json.load(baseline), options['tolerance'])
+            for name, before, after in regressions:
+                self.stderr.write('{}: {:.2f}ms -> {:.2f}ms'.format(
+                    name, before, after))
+            if regressions:
+                raise CommandError('{} regression(s) against {}'.format(
+                    len(regressions), options['baseline']))
+            self.stdout.write('No regressions against {}'.format(
+                options['baseline']))
+
+    def run(self, options):
+        results = OrderedDict()
+        with tempfile.TemporaryDirectory() as tmp:
+            data_path = Path(tmp).joinpath('movies_genres.tsv')
+            start = time.time()
+            generate_tsv(data_path, options['rows'], options['seed'])
+            self.stdout.write('Generated {} rows in {:.2f}s'.format(
+                options['rows'], time.time() - start))
+
+            start = time.time()
+            with transaction.atomic():
+                LoadDataCommand().bulk_loaddata(data_path)
+            elapsed = time.time() - start
+        results['loaddata_bulk'] = OrderedDict([
+            ('median_ms', elapsed * 1000),
+            ('rows_per_second', options['rows'] / elapsed),
+        ])
+        self.report('loaddata_bulk', results['loaddata_bulk'])
+
+        results['rebuild_sequels_count'] = self.time(
+            'rebuild_sequels_count', denorm.rebuild_sequels_count, 3)
+        results['movie_create_delete'] = self.time(
+            'movie_create_delete', self.create_delete_movie,
+            options['repeat'])
+
+        # production settings, without the debug cursor recording queries
+        with override_settings(DEBUG=False, ALLOWED_HOSTS=['*']):
+            client = Client()
+            for name, url in self.endpoints():
+                results[name] = self.time(
+                    name, lambda: self.get(client, url), options['repeat'])
+
+            page = self.movie_page()
+            for name, render in self.renderers():
+                results[name] = self.time(
+                    name, lambda: render(page), options['repeat'])
+
+            transfers = OrderedDict()
+            for name, url in self.transfer_endpoints():
+                transfers[name] = self.transfer(name, client, url)
+
+        return OrderedDict([
+            ('meta', OrderedDict([
+                ('rows', options['rows']),
+                ('movies', Movie.objects.count()),
+                ('genres', Genre.objects.count()),
+                ('seed', options['seed']),
+                ('repeat', options['repeat']),
+                ('python', platform.python_version()),
+                ('django', django.get_version()),
+                ('sqlite', sqlite3.sqlite_version),
+                ('orjson', renderers.orjson is not None),
+                ('date', datetime.datetime.utcnow().isoformat()),
+            ])),
+            ('results', results),
+            ('transfers', transfers),
+        ])
+
+    def endpoints(self):
+        movie = Movie.objects.order_by('pk')[Movie.objects.count() // 2]
+        genre = Genre.objects.order_by('movie_count').first()
+        top_genre = Genre.objects.order_by('-movie_count').first()
+        pages = Movie.objects.count() // 10
+        # a word of the vocabulary, not the number making the title unique
+        word = max((w for w in movie.title.split() if w.isalpha()), key=len)
+        return [
+            ('movie_list', '/api/movies/'),
+            ('movie_list_deep', '/api/movies/?page={}'.format(max(pages, 1))),
+            ('movie_list_cursor', '/api/movies/?cursor='),
+            ('movie_detail', '/api/movies/{}/'.format(movie.pk)),
+            ('movie_genre_filter', '/api/movies/?genres={}'.format(genre.pk)),
+            ('movie_top_genre_filter',
+             '/api/movies/?genres={}'.format(top_genre.pk)),
+            ('movie_search', '/api/movies/?search={}'.format(word)),
+            ('genre_list', '/api/genres/'),
+            ('genre_detail', '/api/genres/{}/'.format(genre.pk)),
+            ('top_genre_by_year', '/api/topGenreByYear/?year=2000'),
+            ('top_genre_by_years',
+             '/api/topGenreByYear/?year_from=1900&year_to=2020'),
+        ]
+
+    def movie_page(self):
+        """A serialized page of `RENDER_PAGE_SIZE` movies, as listed."""
+        request = Request(APIRequestFactory().get('/api/movies/'))
+        movies = Movie.objects.prefetch_related('genres').order_by(
+            '-release_date')[:RENDER_PAGE_SIZE]
+        return MovieSerializer(
+            movies, many=True, context={'request': request}).data
+
+    def renderers(self):
+        drf = JSONRenderer()
+        cases = [
+            ('render_drf_indent',
+             lambda data: drf.render(data, renderer_context={'indent': 4})),
+            ('render_drf', drf.render),
+            ('render_compact_json',
+             lambda data: renderers.dumps(data, fast=False)),
+        ]
+        if renderers.orjson is not None:
+            cases.append(('render_compact_orjson', renderers.dumps))
+        return cases
+
+    def transfer_endpoints(self):
+        return [
+            ('movie_list', '/api/movies/'),
+            ('genre_year_stats', '/api/stats/genresByYear/?top=3'),
+            ('export_ndjson', '/api/export/movies.ndjson'),
+        ]
+
+    def transfer(self, name, client, url):
+        """Bytes and time of a response, without and with gzip."""
+        result = OrderedDict()
+        for prefix, encoding in [('', 'identity'), ('gzip_', 'gzip')]:
+            set_data_version()
+            start = time.time()
+            response = client.get(url, HTTP_ACCEPT='application/json',
+                                  HTTP_ACCEPT_ENCODING=encoding)
+            if response.status_code != 200:
+                raise CommandError('GET {} returned {}'.format(
+                    url, response.status_code))
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+            result[prefix + 'ms'] = (time.time() - start) * 1000
+            result[prefix + 'bytes'] = size
+        self.stdout.write('{:<24} {:>10} -> {:>10} bytes gzipped, '
+                          '{:.2f}ms -> {:.2f}ms'.format(
+                              name, result['bytes'], result['gzip_bytes'],
+                              result['ms'], result['gzip_ms']))
+        return result
+
+    def get(self, client, url):
+        # a new data version each time, so responses are never cached
+        set_data_version()
+        response = client.get(url, HTTP_ACCEPT='application/json')
+        if response.status_code != 200:
+            raise CommandError('GET {} returned {}'.format(
+                url, response.status_code))
+
+    def create_delete_movie(self):
+        # runs the incremental sequel, statistics and search updates
+        with transaction.atomic():
+            movie = Movie.objects.create(
+                title='Benchmark', release_date=datetime.date(2000, 1, 1))
+            movie.delete()
+
+    def time(self, name, func, repeat):
+        # warm up once, counting the queries, reads go to the replica
+        with ExitStack() as stack:
+            captures = [stack.enter_context(CaptureQueriesContext(
+                connections[alias])) for alias in connections]
+            func()
+        # requests reset the query log, read it before the next one
+        query_count = sum(len(queries) for queries in captures)
+
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            timings.append((time.time() - start) * 1000)
+        timings.sort()
+        result = OrderedDict([
+            ('median_ms', timings[len(timings) // 2]),
+            ('p95_ms', timings[min(len(timings) - 1,
+                                   int(len(timings) * 0.95))]),
+            ('min_ms', timings[0]),
+            ('queries', query_count),
+        ])
+        self.report(name, result)
+        return result
+
+    def report(self, name, result):
+        line = '{:<24} {:>10.2f}ms'.format(name, result['median_ms'])
+        if 'queries' in result:
+            line += ' {:>6} queries'.format(result['queries'])
+        self.stdout.write(line)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from movies import denorm, readmodel
+from movies.cache import bump_data_version
+from movies.models import Genre
+
+
+class Command(BaseCommand):
+    help = 'Checks denormalized genre movie counts and repairs any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report drift without repairing it.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            counts = denorm.genre_movie_counts()
+            drift = {}
+            for genre in Genre.objects.all():
+                if genre.movie_count != counts[genre.pk]:
+                    drift[genre.pk] = counts[genre.pk]
+                    self.stdout.write('{}: stored {}, actual {}'.format(
+                        genre.name, genre.movie_count, counts[genre.pk]))
+
+            if not drift:
+                self.stdout.write('Genre movie counts are consistent')
+            elif options['dry_run']:
+                self.stdout.write('Found drift in {} genre(s)'.format(
+                    len(drift)))
+            else:
+                denorm.set_genre_movie_counts(drift)
+                readmodel.log_reload()
+                bump_data_version(using=DEFAULT_DB_ALIAS)
+                self.stdout.write('Repaired {} genre(s)'.format(len(drift)))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from movies import export
+
+
+class Command(BaseCommand):
+    help = 'Exports every movie with its genre names as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=sorted(export.RENDERERS), default='ndjson',
+            help='Output format (default: %(default)s).')
+        parser.add_argument(
+            '--sequels', action='store_true', dest='sequels', default=False,
+            help='Include the sequel count of each movie.')
+        parser.add_argument(
+            '-o', '--output',
+            help='File to write to instead of standard output.')
+        parser.add_argument(
+            '--chunk-size', type=int, dest='chunk_size',
+            default=export.CHUNK_SIZE,
+            help='Movies read per query (default: %(default)s).')
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Database to export from (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        chunks = export.export_movies(
+            options['format'], sequels=options['sequels'],
+            chunk_size=options['chunk_size'], using=options['database'])
+
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(options['output'], 'w', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
@@ -1,54 +1,412 @@
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
+import hashlib
+import io
+import os
+import time
 
-from django.core.management.base import BaseCommand
-from django.db import DEFAULT_DB_ALIAS, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+import numpy as np
 import pandas as pd
 
-from movies.models import Movie, Genre
+from movies import bulk, denorm, readmodel
+from movies.cache import bump_data_version
+from movies.models import Movie, Genre, DataFile
+
+DATA_PATH = Path(__file__).parent.joinpath('movies_genres.tsv')
+
+COLUMNS = ['title', 'release_date', 'genre']
+
+# megabytes of input parsed at a time by each worker
+CHUNK_MB = 32
 
 
 class Command(BaseCommand):
     help = 'Loads denormalized movies genres data into database'
 
+    # parsing processes, one per CPU if None
+    workers = None
+    chunk_bytes = CHUNK_MB * 1024 * 1024
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*', metavar='path',
+            help='TSV files or glob patterns to load (default: the bundled '
+                 'movies_genres.tsv).')
+        parser.add_argument(
+            '--bulk', action='store_true', dest='bulk', default=False,
+            help='Load with set-based bulk inserts instead of row by row.')
+        parser.add_argument(
+            '--batch-size', type=int, dest='batch_size', default=None,
+            help='Rows per bulk insert statement (default: the largest '
+                 'the database backend allows).')
+        parser.add_argument(
+            '--incremental', action='store_true', dest='incremental',
+            default=False,
+            help='Only write the movies and genre links that differ from '
+                 'the database, skipping the files if unchanged since the '
+                 'last incremental load.')
+        parser.add_argument(
+            '--prune', action='store_true', dest='prune', default=False,
+            help='With --incremental, also delete movies missing from the '
+                 'files.')
+        parser.add_argument(
+            '--force', action='store_true', dest='force', default=False,
+            help='With --incremental, diff the files even if unchanged.')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Processes parsing the files (default: one per CPU).')
+        parser.add_argument(
+            '--chunk-mb', type=int, dest='chunk_mb', default=CHUNK_MB,
+            help='Megabytes of a file parsed at a time by a worker '
+                 '(default: %(default)s).')
+
     def handle(self, *args, **options):
-        data_path = Path(__file__).parent.joinpath('movies_genres.tsv')
+        self.workers = options['workers']
+        self.chunk_bytes = options['chunk_mb'] * 1024 * 1024
+        paths = expand_paths(options['paths']) or [DATA_PATH]
 
+        start = time.time()
         with transaction.atomic(using=DEFAULT_DB_ALIAS):
-            self.loaddata(data_path)
+            if options['incremental']:
+                rows = self.incremental_loaddata(
+                    paths, prune=options['prune'], force=options['force'])
+            elif options['bulk']:
+                rows = self.bulk_loaddata(paths, options['batch_size'])
+            else:
+                rows = self.loaddata(paths)
+        elapsed = time.time() - start
+
+        self.stdout.write('Loaded {} rows in {:.2f}s ({:.0f} rows/s)'.format(
+            rows, elapsed, rows / elapsed if elapsed else rows))
+
+    def read_data(self, data):
+        """
+        Parse one or more files, in chunks spread over worker processes.
+        Returns the number of rows read and a frame of the unique
+        (title, release_date, genre) rows, which are the genre links of
+        each (title, release_date) movie.
+        """
+        ranges = list(file_ranges(as_paths(data), self.chunk_bytes))
+        workers = self.workers or os.cpu_count()
+        if workers == 1 or len(ranges) < 2:
+            results = [parse_range(*args) for args in ranges]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(parse_range, *zip(*ranges)))
+
+        rows = sum(count for count, links in results)
+        links = pd.concat([links for count, links in results] or [
+            pd.DataFrame(columns=COLUMNS)], ignore_index=True)
+        if len(results) > 1:
+            # the same rows may appear in several chunks
+            links = links.drop_duplicates()
+        return rows, links
 
     def loaddata(self, data):
-        # load tsv to pandas
-        df = pd.read_csv(
-            data,
-            sep='\t',
-            index_col=False,
-            header=None,
-            names=['title', 'release_date', 'genre'],
-            parse_dates=['release_date'])
-
-        # take all unique genres
-        genres = pd.DataFrame(df.genre.unique(), columns=['name'])
-
-        # normalize movies by unique (title, release_date), concatenate genres
-        movies = df.groupby(
-            ['title', 'release_date']).apply(
-                lambda x: ','.join(x.genre)).reset_index()
-        movies.columns = ['title', 'release_date', 'genres']
+        rows, links = self.read_data(data)
 
         # need pk for genres first in order to save m2m fields on movies
         genre_objs = {}
-        for genre in genres.itertuples():
-            g, created = Genre.objects.get_or_create(name=genre.name)
+        for name in links.genre.unique():
+            g, created = Genre.objects.get_or_create(name=name)
             # cache genre objects to avoid lookups later
-            genre_objs[genre.name] = g
+            genre_objs[name] = g
 
         # create movies and associate with genres
-        for movie in movies.itertuples():
+        links = links.sort_values(['title', 'release_date'])
+        for (title, release_date), movie_links in groupby(
+                links.itertuples(index=False),
+                key=attrgetter('title', 'release_date')):
             m, created = Movie.objects.get_or_create(
-                title=movie.title, release_date=movie.release_date)
+                title=title, release_date=release_date)
 
             # link movies and genres
-            movie_genres = movie.genres.split(',')
-            for genre_name in movie_genres:
-                m.genres.add(genre_objs[genre_name])
-            m.save()
+            for link in movie_links:
+                m.genres.add(genre_objs[link.genre])
+
+        return rows
+
+    def bulk_loaddata(self, data, batch_size=None):
+        rows, links = self.read_data(data)
+
+        # resolve genres once, inserting only the missing ones
+        genre_ids = dict(Genre.objects.values_list('name', 'id'))
+        Genre.objects.bulk_create(
+            [Genre(name=name) for name in links.genre.unique()
+             if name not in genre_ids],
+            batch_size=batch_size)
+        genre_ids = dict(Genre.objects.values_list('name', 'id'))
+
+        # movies are identified by (title, release_date), as get_or_create
+        # does in the row by row load
+        links = with_fingerprints(links)
+        movies = links.drop_duplicates('key')
+        stored, stored_links = stored_movies()
+        new_movies = movies[~movies.key.isin(stored.key)]
+        Movie.objects.bulk_create([
+            Movie(title=title, release_date=release_date)
+            for title, release_date in zip(
+                new_movies.title, new_movies.release_date.dt.date)],
+            batch_size=batch_size)
+        if len(new_movies):
+            stored, stored_links = stored_movies()
+
+        # link movies and genres, skipping links that already exist
+        new_links = pd.merge(
+            links[['key', 'genre']], stored_links, on=['key', 'genre'],
+            how='left', indicator=True)
+        new_links = pd.merge(
+            new_links[new_links._merge == 'left_only'], stored[['key', 'id']],
+            on='key')
+        Through = Movie.genres.through
+        Through.objects.bulk_create([
+            Through(movie_id=movie_id, genre_id=genre_id)
+            for movie_id, genre_id in zip(
+                new_links.id.tolist(),
+                new_links.genre.map(genre_ids).tolist())],
+            batch_size=batch_size)
+
+        # bulk inserts skip the signals maintaining denormalized data
+        if len(new_movies) or len(new_links):
+            denorm.rebuild_all()
+            readmodel.log_reload()
+            bump_data_version()
+
+        return rows
+
+    def incremental_loaddata(self, data, prune=False, force=False):
+        """
+        Apply the difference between the files and the database: insert
+        the new movies, and add or remove links so that each movie of the
+        files has their genres. With `prune`, movies missing from the files
+        are deleted. Returns the rows read, 0 if the files were skipped.
+        """
+        files = []
+        for path in as_paths(data):
+            path = str(Path(path).resolve())
+            stat = Path(path).stat()
+            manifest = DataFile.objects.filter(path=path).first()
+            if manifest is not None and (manifest.size, manifest.mtime_ns) == (
+                    stat.st_size, stat.st_mtime_ns):
+                continue
+
+            sha256 = file_sha256(path)
+            if manifest is None:
+                manifest = DataFile(path=path)
+            elif manifest.sha256 == sha256:
+                # touched, but the same content
+                manifest.mtime_ns = stat.st_mtime_ns
+                manifest.save()
+                continue
+            manifest.size = stat.st_size
+            manifest.mtime_ns = stat.st_mtime_ns
+            manifest.sha256 = sha256
+            files.append(manifest)
+
+        if not files and not force:
+            self.stdout.write('Skipped unchanged {}'.format(
+                ', '.join(str(path) for path in as_paths(data))))
+            return 0
+
+        if not Movie.objects.exists():
+            # nothing to diff against, a plain bulk load is faster
+            rows = self.bulk_loaddata(data)
+        else:
+            rows, links = self.read_data(data)
+            self.apply_diff(links, prune)
+
+        for manifest in files:
+            manifest.save()
+        return rows
+
+    def apply_diff(self, links, prune=False):
+        file_links = with_fingerprints(links)
+        db_movies, db_links = stored_movies()
+
+        movies = pd.merge(
+            file_links.drop_duplicates('key')[['key']], db_movies,
+            on='key', how='outer', indicator=True)
+        links = pd.merge(
+            file_links[['key', 'genre']], db_links, on=['key', 'genre'],
+            how='outer', indicator=True)
+
+        added = set(movies.key[movies._merge == 'left_only'])
+        removed = movies.id[movies._merge == 'right_only']
+        # stored movies of the file, with links to add or remove
+        changed = set(links.key[links._merge != 'both']) - added
+        changed = movies[movies.key.isin(changed) &
+                         (movies._merge == 'both')]
+
+        # every genre of the file, creating the new ones
+        genre_ids = dict(Genre.objects.values_list('name', 'id'))
+        bulk.save_genres([{'name': name} for name in links.genre.unique()
+                          if name not in genre_ids], [])
+        genres = {name: Genre(pk=pk, name=name) for name, pk in
+                  Genre.objects.values_list('name', 'id')}
+
+        movie_genres = {}
+        for key, genre in file_links[
+                file_links.key.isin(added | set(changed.key))][
+                    ['key', 'genre']].itertuples(index=False):
+            movie_genres.setdefault(key, []).append(genres[genre])
+
+        creates = [
+            {'title': movie.title,
+             'release_date': movie.release_date.date(),
+             'genres': movie_genres[movie.key]}
+            for movie in file_links[file_links.key.isin(
+                added)].drop_duplicates('key').itertuples()]
+        updates = [
+            (Movie(pk=movie.id, title=movie.title,
+                   release_date=movie.release_date.date()),
+             {'genres': movie_genres.get(movie.key, [])})
+            for movie in changed.itertuples()]
+        bulk.save_movies(creates, updates)
+
+        if prune:
+            for chunk in denorm.chunked(removed.astype(int).tolist()):
+                Movie.objects.filter(pk__in=chunk).delete()
+        if creates or updates or (prune and len(removed)):
+            bump_data_version()
+
+        self.stdout.write(
+            '{} movies added, {} relinked, {} {}'.format(
+                len(creates), len(updates), len(removed),
+                'deleted' if prune else 'not in the file (see --prune)'))
+
+
+def as_paths(data):
+    if isinstance(data, (str, Path)):
+        return [data]
+    return list(data)
+
+
+def expand_paths(patterns):
+    """Paths of the given files and glob patterns, in order."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob(pattern)) or (
+            [pattern] if Path(pattern).exists() else [])
+        if not matches:
+            raise CommandError('No such file: {}'.format(pattern))
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def file_ranges(paths, chunk_bytes):
+    """Split files into (path, start, end) byte ranges to parse."""
+    for path in paths:
+        size = os.path.getsize(str(path))
+        for start in range(0, size, chunk_bytes):
+            yield str(path), start, min(start + chunk_bytes, size)
+
+
+def read_range(path, start, end):
+    """The lines of a file starting within the byte range."""
+    with open(path, 'rb') as data:
+        if start:
+            # the line going over `start` belongs to the previous range
+            data.seek(start - 1)
+            data.readline()
+        begin = data.tell()
+        if begin >= end:
+            return b''
+        block = data.read(end - begin)
+        if not block.endswith(b'\n'):
+            block += data.readline()
+    return block
+
+
+def parse_dates(values):
+    """Dates of years, or of anything else pandas can parse."""
+    dates = pd.to_datetime(values, format='%Y', errors='coerce')
+    others = dates.isnull()
+    if others.any():
+        dates[others] = pd.to_datetime(values[others])
+    return dates
+
+
+def parse_range(path, start, end):
+    """
+    Parse a byte range of a TSV file. Returns the number of rows and the
+    unique normalized (title, release_date, genre) rows.
+    """
+    block = read_range(path, start, end)
+    if not block.strip():
+        return 0, pd.DataFrame(columns=COLUMNS)
+    # load tsv to pandas
+    df = pd.read_csv(
+        io.BytesIO(block),
+        sep='\t',
+        index_col=False,
+        header=None,
+        names=COLUMNS,
+        dtype=str)
+    rows = len(df)
+    df['title'] = df.title.str.strip()
+    df['release_date'] = parse_dates(df.release_date)
+    return rows, df.drop_duplicates()
+
+
+def with_fingerprints(links):
+    """Add the `days` and `key` of the movie to (title, release_date) rows."""
+    links = links.assign(days=links.release_date.values.astype(
+        'datetime64[D]').astype(np.int64))
+    links['key'] = fingerprint(links)
+    return links
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for block in iter(lambda: data.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(movies):
+    """
+    64 bit hashes of the normalized (title, days since epoch) of movies.
+    Among a million movies two share a hash with a chance of about 1 in
+    30 million.
+    """
+    return pd.util.hash_pandas_object(
+        movies[['title', 'days']], index=False).values
+
+
+def stored_movies(using=DEFAULT_DB_ALIAS):
+    """
+    Return the stored movies as a (key, id, title, release_date) frame,
+    and their links as a (key, genre) frame of genre names.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT id, title, CAST(release_date AS TEXT) FROM {}'.format(
+                quote_name(Movie._meta.db_table)))
+        movies = pd.DataFrame(cursor.fetchall(),
+                              columns=['id', 'title', 'release_date'])
+        cursor.execute('SELECT movie_id, genre_id FROM {}'.format(
+            quote_name(Movie.genres.through._meta.db_table)))
+        links = pd.DataFrame(cursor.fetchall(),
+                             columns=['movie_id', 'genre_id'])
+
+    movies['release_date'] = pd.to_datetime(movies.release_date)
+    movies['days'] = movies.release_date.values.astype(
+        'datetime64[D]').astype(np.int64)
+    movies['key'] = fingerprint(movies)
+    # movies stored twice are matched once
+    movies = movies.drop_duplicates('key')
+
+    genre_names = dict(Genre.objects.using(using).values_list('id', 'name'))
+    links = pd.merge(links, movies[['id', 'key']], left_on='movie_id',
+                     right_on='id')
+    links['genre'] = links.genre_id.map(genre_names)
+    return (movies[['key', 'id', 'title', 'release_date']],
+            links[['key', 'genre']])
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from movies import loadtest
+
+SCENARIO_PATH = os.path.join(os.path.dirname(__file__), 'loadtest.json')
+
+
+class Command(BaseCommand):
+    help = ('Drives a weighted mix of API requests from concurrent threads, '
+            'reporting throughput, latency percentiles and errors')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenario', nargs='?', default=SCENARIO_PATH,
+            help='JSON scenario file (default: the bundled loadtest.json).')
+        parser.add_argument(
+            '--threads', type=int,
+            help='Threads per process (default: from the scenario, or '
+                 '{}).'.format(loadtest.THREADS))
+        parser.add_argument(
+            '--processes', type=int,
+            help='Processes, forked, each running the threads (default: '
+                 'from the scenario, or 1).')
+        parser.add_argument(
+            '--duration', type=float,
+            help='Seconds to run for (default: from the scenario, or {} '
+                 'without --requests).'.format(loadtest.DURATION))
+        parser.add_argument(
+            '--requests', type=int,
+            help='Stop after this many requests in total.')
+        parser.add_argument(
+            '--server', action='store_true', default=False,
+            help='Send requests over HTTP to a local server started for the '
+                 'run, instead of calling the WSGI application directly.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the request mix (default: %(default)s).')
+        parser.add_argument(
+            '--output', help='JSON file to write results to.')
+
+    def handle(self, *args, **options):
+        try:
+            scenario = loadtest.load_scenario(options['scenario'])
+            values = loadtest.sample_values(scenario, seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        settings = OrderedDict()
+        for name, default in [('threads', loadtest.THREADS),
+                              ('processes', 1), ('requests', None),
+                              ('duration', None)]:
+            value = options[name]
+            if value is None:
+                value = scenario.get(name, default)
+            settings[name] = value
+        if settings['duration'] is None and settings['requests'] is None:
+            settings['duration'] = loadtest.DURATION
+        if settings['threads'] < 1 or settings['processes'] < 1:
+            raise CommandError('Threads and processes must be at least 1')
+
+        # loaded here, as a WSGI server would
+        from moviemania.wsgi import application
+        try:
+            summary, elapsed = loadtest.run(
+                application, scenario, values, server=options['server'],
+                seed=options['seed'], **settings)
+        except RuntimeError as e:
+            raise CommandError(e)
+
+        self.stdout.write(
+            '{:<24} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+                'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms',
+                'p99 ms', 'errors'))
+        for name, result in summary.items():
+            self.stdout.write(
+                '{:<24} {:>8} {:>8.1f} {} {} {} {:>6.1%}'.format(
+                    name, result['requests'], result['rps'],
+                    *[format_ms(result['p{}_ms'.format(p)])
+                      for p in loadtest.PERCENTILES],
+                    result['error_rate']))
+
+        if options['output']:
+            settings.update(server=options['server'], seed=options['seed'],
+                            elapsed=elapsed, scenario=options['scenario'])
+            with open(options['output'], 'w') as output:
+                json.dump(OrderedDict([
+                    ('meta', settings), ('results', summary)]),
+                    output, indent=2)
+            self.stdout.write('Results written to {}'.format(
+                options['output']))
+
+
+def format_ms(value):
+    return '{:>8}'.format('-') if value is None else '{:>8.2f}'.format(value)
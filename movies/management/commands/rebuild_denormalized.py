@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from movies import denorm, readmodel
+from movies.cache import bump_data_version
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds denormalized movie data from movies and genres'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs='*', metavar='name',
+            choices=list(denorm.REBUILDERS),
+            help='Data to rebuild, all by default: {}.'.format(
+                ', '.join(denorm.REBUILDERS)))
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(denorm.REBUILDERS)
+
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            for name in names:
+                denorm.REBUILDERS[name]()
+                self.stdout.write('Rebuilt {}'.format(name))
+            # franchises and counts are read by the cached responses
+            readmodel.log_reload(using=DEFAULT_DB_ALIAS)
+            bump_data_version(using=DEFAULT_DB_ALIAS)
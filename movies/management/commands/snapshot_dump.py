@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from movies import snapshot
+
+
+class Command(BaseCommand):
+    help = 'Writes a binary snapshot of movies, genres and their links'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Snapshot file to write.')
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Database to dump (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        try:
+            counts = snapshot.dump(options['path'], using=options['database'])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write('Dumped {} to {} in {:.2f}s'.format(
+            describe(counts), options['path'], time.time() - start))
+
+
+def describe(counts):
+    return ', '.join('{} {}'.format(count, model._meta.verbose_name_plural)
+                     for model, count in counts.items())
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from movies import snapshot
+from movies.management.commands.snapshot_dump import describe
+
+
+class Command(BaseCommand):
+    help = ('Replaces movies, genres and their links with a snapshot '
+            'written by snapshot_dump')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Snapshot file to read.')
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Database to restore into (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        try:
+            counts = snapshot.restore(
+                options['path'], using=options['database'])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write('Restored {} from {} in {:.2f}s'.format(
+            describe(counts), options['path'], time.time() - start))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 14:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from movies import denorm
+
+
+def build_sequels_count(apps, schema_editor):
+    denorm.rebuild_sequels_count(
+        apps=apps, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='sequels_count',
+            field=models.PositiveIntegerField(default=0, editable=False, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='movie',
+            name='title',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.RunPython(build_sequels_count, migrations.RunPython.noop),
+    ]
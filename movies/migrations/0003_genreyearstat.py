@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 14:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from movies import denorm
+
+
+def build_genre_year_stats(apps, schema_editor):
+    denorm.rebuild_genre_year_stats(
+        apps=apps, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0002_movie_sequels_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenreYearStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.SmallIntegerField()),
+                ('movie_count', models.PositiveIntegerField(default=0)),
+                ('genre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='year_stats', to='movies.Genre')),
+            ],
+            options={
+                'ordering': ('year', '-movie_count'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='genreyearstat',
+            unique_together=set([('year', 'genre')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='genreyearstat',
+            index_together=set([('year', 'movie_count')]),
+        ),
+        migrations.RunPython(
+            build_genre_year_stats, migrations.RunPython.noop),
+    ]
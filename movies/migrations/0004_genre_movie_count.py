@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 14:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from movies import denorm
+
+
+def build_genre_movie_counts(apps, schema_editor):
+    denorm.rebuild_genre_movie_counts(
+        apps=apps, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0003_genreyearstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genre',
+            name='movie_count',
+            field=models.PositiveIntegerField(default=0, editable=False, serialize=False),
+        ),
+        migrations.RunPython(
+            build_genre_movie_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from movies import search
+
+
+def create_title_search(apps, schema_editor):
+    search.rebuild_title_search(
+        apps=apps, using=schema_editor.connection.alias)
+
+
+def drop_title_search(apps, schema_editor):
+    if search.is_supported(schema_editor.connection):
+        schema_editor.execute(search.DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0005_movie_release_date_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_title_search, drop_title_search),
+    ]
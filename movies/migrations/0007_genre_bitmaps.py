@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 14:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from movies import denorm
+
+
+def build_genre_masks(apps, schema_editor):
+    denorm.rebuild_genre_masks(
+        apps=apps, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0006_movie_title_search'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='movie',
+            name='movies_movie_release_id_idx',
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='bit',
+            field=models.PositiveSmallIntegerField(editable=False, null=True, serialize=False, unique=True),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='genre_mask',
+            field=models.BigIntegerField(default=0, editable=False, serialize=False),
+        ),
+        migrations.RunPython(build_genre_masks, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['release_date', 'id', 'genre_mask'], name='movies_movie_release_mask_idx'),
+        ),
+    ]
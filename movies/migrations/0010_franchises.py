@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 15:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from movies import denorm
+
+
+def build_franchises(apps, schema_editor):
+    denorm.rebuild_franchises(apps=apps, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0009_datafile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Franchise',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255, unique=True)),
+                ('movie_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('title',),
+            },
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='franchise',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='movies', serialize=False, to='movies.Franchise'),
+        ),
+        migrations.RunPython(build_franchises, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.2 on 2026-10-18 15:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import movies.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0010_franchises'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MovieTitleSearch',
+            fields=[
+                ('movie', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='title_search', serialize=False, to='movies.Movie')),
+                ('title', movies.models.SearchField()),
+                ('rank', models.FloatField(null=True)),
+            ],
+            options={
+                'db_table': 'movies_movie_fts',
+                'managed': False,
+            },
+        ),
+    ]
@@ -2,30 +2,127 @@
 from __future__ import unicode_literals
 
 from django.db import models
-from django.utils.functional import cached_property
 
 
 class Movie(models.Model):
-    title = models.CharField(max_length=255)
+    title = models.CharField(max_length=255, db_index=True)
     release_date = models.DateField('date released')
     genres = models.ManyToManyField('Genre')
+    # denormalized, maintained by `movies.denorm`
+    sequels_count = models.PositiveIntegerField(
+        default=0, editable=False, serialize=False)
+    # the `Genre.bit` of each of its genres, maintained by `movies.denorm`
+    genre_mask = models.BigIntegerField(
+        default=0, editable=False, serialize=False)
+    # denormalized, maintained by `movies.denorm`
+    franchise = models.ForeignKey(
+        'Franchise', on_delete=models.SET_NULL, null=True,
+        related_name='movies', editable=False, serialize=False)
 
     def __str__(self):
         return '{} ({})'.format(self.title, self.release_date.strftime('%Y'))
 
     class Meta:
         ordering = ('release_date',)
+        indexes = [
+            # keyset pagination, see `movies.pagination`, with the genre
+            # mask to test genre filters without reading the rows
+            models.Index(fields=['release_date', 'id', 'genre_mask'],
+                         name='movies_movie_release_mask_idx'),
+        ]
 
-    @cached_property
-    def sequels_count(self):
-        return Movie.objects.filter(title__startswith=self.title).count()-1
+
+class SearchField(models.TextField):
+    """A column of an SQLite FTS5 table, see `movies.search`."""
+
+
+@SearchField.register_lookup
+class Match(models.Lookup):
+    """A full text query of the column."""
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '{} MATCH {}'.format(lhs, rhs), lhs_params + rhs_params
+
+
+class MovieTitleSearch(models.Model):
+    """The full text index of movie titles, a table created and
+    maintained by `movies.search`, read to filter movies by title."""
+    movie = models.OneToOneField(
+        Movie, on_delete=models.DO_NOTHING, primary_key=True,
+        db_column='rowid', db_constraint=False, related_name='title_search')
+    title = SearchField()
+    # of the titles matched by a query, best first
+    rank = models.FloatField(null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'movies_movie_fts'
 
 
 class Genre(models.Model):
     name = models.CharField(max_length=255, unique=True)
+    # denormalized, maintained by `movies.denorm`
+    movie_count = models.PositiveIntegerField(
+        default=0, editable=False, serialize=False)
+    # position in `Movie.genre_mask`, unset once all bits are taken
+    bit = models.PositiveSmallIntegerField(
+        null=True, unique=True, editable=False, serialize=False)
 
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('name',)
+
+
+class Franchise(models.Model):
+    """Movies whose titles start with the same root title, itself a movie
+    title, maintained by `movies.denorm`."""
+    title = models.CharField(max_length=255, unique=True)
+    movie_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.title
+
+    class Meta:
+        ordering = ('title',)
+
+
+class GenreYearStat(models.Model):
+    """Number of movies of a genre released in a year, maintained by
+    `movies.denorm`."""
+    year = models.SmallIntegerField()
+    genre = models.ForeignKey(
+        Genre, on_delete=models.CASCADE, related_name='year_stats')
+    movie_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{} {} ({})'.format(self.year, self.genre, self.movie_count)
+
+    class Meta:
+        ordering = ('year', '-movie_count')
+        unique_together = ('year', 'genre')
+        index_together = ('year', 'movie_count')
+
+
+class DataChange(models.Model):
+    """A movie or genre written, for `movies.readmodel` to refresh from.
+    Neither set means the whole catalog may have changed."""
+    movie_id = models.IntegerField(null=True)
+    genre_id = models.IntegerField(null=True)
+
+
+class DataFile(models.Model):
+    """A file loaded by `loaddata_movies_genres --incremental`, to skip it
+    while unchanged."""
+    path = models.CharField(max_length=1024, unique=True)
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    loaded_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.path
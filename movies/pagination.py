@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+
+
+class ReleaseDateCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (release_date, id), newest first.
+
+    DRF's cursor pagination positions on the first ordering column only
+    and skips movies sharing a release date with OFFSET. Here the cursor
+    holds both columns, so every page is a range read on the composite
+    (release_date, id) index, and no COUNT(*) is run.
+    """
+    ordering = ('-release_date', '-id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        if reverse:
+            queryset = queryset.order_by('release_date', 'id')
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(
+                self.position_filter(current_position, reverse))
+
+        # fetch an extra item to know if there is a following page
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(
+                results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def position_filter(self, position, reverse):
+        try:
+            release_date, pk = position.split(',')
+            release_date, pk = parse_date(release_date), int(pk)
+        except ValueError:
+            release_date = None
+        if release_date is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        # the redundant bound lets the database seek on the index
+        if reverse:
+            return Q(release_date__gte=release_date) & (
+                Q(release_date__gt=release_date) |
+                Q(release_date=release_date, id__gt=pk))
+        return Q(release_date__lte=release_date) & (
+            Q(release_date__lt=release_date) |
+            Q(release_date=release_date, id__lt=pk))
+
+    def _get_position_from_instance(self, instance, ordering):
+        # unique positions, so links never need an offset
+        if isinstance(instance, dict):
+            return '{},{}'.format(instance['release_date'], instance['id'])
+        return '{},{}'.format(instance.release_date.isoformat(), instance.pk)
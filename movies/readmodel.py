@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory columnar read model of the movie catalog.
+
+With ``MOVIES_READ_MODEL`` on, each process keeps movies, genres and their
+links in NumPy arrays, and serves the movie and genre lists and the top
+genres by year from them instead of the database. Sequel, genre and year
+counts are computed from the arrays with vectorized operations, so they
+don't depend on the denormalized columns. Franchises are read from their
+table, to link movies to them.
+
+Writes record the movies and genres they touch as ``DataChange`` rows,
+in whichever process they run. Each read compares the id of the last
+change with the one its catalog was built at, and when it moved, reads
+the changes logged since and patches its arrays with the rows they name.
+It loads the whole catalog again when a change covers everything, e.g. a
+bulk load, or when changes it missed were pruned.
+"""
+from __future__ import unicode_literals
+
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils.functional import cached_property
+import numpy as np
+
+from movies.denorm import MAX_CHAR, chunked
+from movies.models import (
+    Movie, Genre, GenreYearStat, DataChange, Franchise)
+
+# changes kept for processes to catch up with, older ones are pruned
+KEEP_CHANGES = 10000
+
+# rows fetched at a time by a full load
+FETCH_SIZE = 10000
+
+_read_models = {}
+
+
+def is_enabled():
+    return getattr(settings, 'MOVIES_READ_MODEL', False)
+
+
+def log_changes(movie_ids=(), genre_ids=(), using=DEFAULT_DB_ALIAS):
+    """Record written movies and genres, for read models to refresh."""
+    if not is_enabled():
+        return
+    changes = ([DataChange(movie_id=pk) for pk in set(movie_ids)] +
+               [DataChange(genre_id=pk) for pk in set(genre_ids)])
+    if changes:
+        DataChange.objects.using(using).bulk_create(changes)
+        prune_changes(using=using)
+
+
+def log_reload(using=DEFAULT_DB_ALIAS):
+    """Record a change of the whole catalog, e.g. by a bulk load."""
+    if is_enabled():
+        DataChange.objects.using(using).create()
+        prune_changes(using=using)
+
+
+def latest_change_id(using=DEFAULT_DB_ALIAS):
+    """The id of the last `DataChange`, 0 if there is none."""
+    return DataChange.objects.using(using).order_by('-id').values_list(
+        'id', flat=True).first() or 0
+
+
+def prune_changes(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    table = connection.ops.quote_name(DataChange._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM {0} WHERE id <= (SELECT MAX(id) FROM {0}) - %s'
+            .format(table), [KEEP_CHANGES])
+
+
+def remove_sorted(values, removed):
+    """Remove one occurrence of each of `removed` from sorted `values`."""
+    if not len(removed):
+        return values
+    unique, counts = np.unique(removed, return_counts=True)
+    starts = np.searchsorted(values, unique)
+    # consecutive positions for values removed more than once
+    offsets = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts,
+                                                  counts)
+    return np.delete(values, np.repeat(starts, counts) + offsets)
+
+
+def insert_sorted(values, added):
+    added = np.sort(added)
+    return np.insert(values, np.searchsorted(values, added), added)
+
+
+def object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def prefetch_genres(movie, genres):
+    """Attach genres to a movie as `prefetch_related('genres')` would."""
+    queryset = Genre.objects.all()
+    queryset._result_cache = genres
+    queryset._prefetch_done = True
+    movie._prefetched_objects_cache = {'genres': queryset}
+
+
+class Catalog(object):
+    """
+    One version of the catalog, never modified once built.
+
+    Movies are stored in primary key order, links in movie order with
+    genres interned as their index in the genre arrays. Titles are kept
+    sorted a second time, so the sequels of a title are the width of its
+    prefix range, like in `denorm.rebuild_sequels_count()`.
+    """
+
+    def __init__(self, change_id, genres, movie_ids, titles, dates,
+                 link_movies, link_genres, sorted_titles, franchises):
+        self.change_id = change_id
+        # (pk, name) pairs in primary key order
+        self.genres = [Genre(pk=pk, name=name) for pk, name in genres]
+        self.genre_ids = np.array([pk for pk, name in genres], dtype=np.int64)
+        self.movie_ids = movie_ids
+        self.titles = titles
+        self.dates = dates
+        self.link_movies = link_movies
+        self.link_genres = link_genres
+        self.sorted_titles = sorted_titles
+        # {root title: pk} of the stored franchises
+        self.franchises = franchises
+
+    @classmethod
+    def load(cls, using=DEFAULT_DB_ALIAS):
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+        movies = quote_name(Movie._meta.db_table)
+        links = quote_name(Movie.genres.through._meta.db_table)
+
+        # one snapshot of the tables, and of the changes already applied
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            change_id = DataChange.objects.using(using).order_by(
+                '-id').values_list('id', flat=True).first() or 0
+            genres = list(Genre.objects.using(using).order_by(
+                'pk').values_list('pk', 'name'))
+            franchises = dict(Franchise.objects.using(using).values_list(
+                'title', 'pk'))
+
+            movie_ids, titles, dates = [], [], []
+            # dates as text, to parse them all at once
+            cursor.execute(
+                'SELECT id, title, CAST(release_date AS TEXT) FROM {} '
+                'ORDER BY id'.format(movies))
+            for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+                ids, chunk_titles, chunk_dates = zip(*rows)
+                movie_ids.append(np.array(ids, dtype=np.int64))
+                titles.append(object_array(chunk_titles))
+                dates.append(np.array(chunk_dates, dtype='datetime64[D]'))
+
+            link_movies, link_genres = [], []
+            cursor.execute('SELECT movie_id, genre_id FROM {} ORDER BY '
+                           'movie_id'.format(links))
+            for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+                rows = np.array(rows, dtype=np.int64)
+                link_movies.append(rows[:, 0])
+                link_genres.append(rows[:, 1])
+
+        genre_ids = np.array([pk for pk, name in genres], dtype=np.int64)
+        titles = np.concatenate(titles or [object_array([])])
+        link_genres = np.concatenate(link_genres or [[]]).astype(np.int64)
+        return cls(
+            change_id, genres,
+            movie_ids=np.concatenate(movie_ids or [[]]).astype(np.int64),
+            titles=titles,
+            dates=np.concatenate(dates or [[]]).astype('datetime64[D]'),
+            link_movies=np.concatenate(link_movies or [[]]).astype(np.int64),
+            link_genres=np.searchsorted(
+                genre_ids, link_genres).astype(np.int16),
+            sorted_titles=np.sort(titles), franchises=franchises)
+
+    def apply(self, changes, using=DEFAULT_DB_ALIAS):
+        """
+        Return a catalog with the (id, movie_id, genre_id) changes applied,
+        reading only the rows they name.
+        """
+        changed = np.array(sorted(
+            {movie_id for pk, movie_id, genre_id in changes
+             if movie_id is not None}), dtype=np.int64)
+        with transaction.atomic(using=using):
+            if any(genre_id is not None for pk, movie_id, genre_id in changes):
+                genres = list(Genre.objects.using(using).order_by(
+                    'pk').values_list('pk', 'name'))
+            else:
+                genres = [(genre.pk, genre.name) for genre in self.genres]
+            # a title written may regroup the franchises of other movies
+            franchises = self.franchises
+            if len(changed):
+                franchises = dict(Franchise.objects.using(
+                    using).values_list('title', 'pk'))
+            rows, links = [], []
+            for chunk in chunked(changed.tolist()):
+                rows.extend(Movie.objects.using(using).filter(
+                    pk__in=chunk).values_list('pk', 'title', 'release_date'))
+                links.extend(Movie.genres.through.objects.using(using).filter(
+                    movie_id__in=chunk).values_list('movie_id', 'genre_id'))
+        rows.sort()
+        links.sort()
+
+        kept = ~np.isin(self.movie_ids, changed)
+        movie_ids = self.movie_ids[kept]
+        titles = self.titles[kept]
+        dates = self.dates[kept]
+        sorted_titles = remove_sorted(self.sorted_titles, self.titles[~kept])
+        if rows:
+            ids, new_titles, new_dates = zip(*rows)
+            positions = np.searchsorted(movie_ids, ids)
+            movie_ids = np.insert(movie_ids, positions, ids)
+            titles = np.insert(titles, positions, object_array(new_titles))
+            dates = np.insert(dates, positions, np.array(
+                new_dates, dtype='datetime64[D]'))
+            sorted_titles = insert_sorted(
+                sorted_titles, object_array(new_titles))
+
+        # links to deleted genres went with them
+        genre_ids = np.array([pk for pk, name in genres], dtype=np.int64)
+        link_genre_ids = self.genre_ids[self.link_genres]
+        kept = (~np.isin(self.link_movies, changed) &
+                np.isin(link_genre_ids, genre_ids))
+        link_movies = self.link_movies[kept]
+        link_genres = np.searchsorted(genre_ids, link_genre_ids[kept])
+        if links:
+            new_movies, new_genres = np.array(links, dtype=np.int64).T
+            positions = np.searchsorted(link_movies, new_movies)
+            link_movies = np.insert(link_movies, positions, new_movies)
+            link_genres = np.insert(link_genres, positions, np.searchsorted(
+                genre_ids, new_genres))
+
+        return Catalog(
+            changes[-1][0], genres, movie_ids, titles, dates, link_movies,
+            link_genres.astype(np.int16), sorted_titles, franchises)
+
+    # derived columns, computed once per catalog when first needed
+
+    @cached_property
+    def newest_first(self):
+        """Movie positions by release date then primary key, descending."""
+        return np.lexsort((self.movie_ids, self.dates))[::-1]
+
+    @cached_property
+    def link_positions(self):
+        return np.searchsorted(self.movie_ids, self.link_movies)
+
+    @cached_property
+    def genres_by_name(self):
+        return np.array(sorted(range(len(self.genres)),
+                               key=lambda i: self.genres[i].name),
+                        dtype=np.int64)
+
+    @cached_property
+    def years(self):
+        return self.dates.astype('datetime64[Y]').astype(np.int64) + 1970
+
+    @cached_property
+    def genre_counts(self):
+        return np.bincount(self.link_genres, minlength=len(self.genres))
+
+    @cached_property
+    def genre_year_counts(self):
+        """Return the first year and a (year, genre) array of counts."""
+        if not len(self.movie_ids):
+            return 0, np.zeros((0, len(self.genres)), dtype=np.int64)
+        first_year = int(self.years.min())
+        span = int(self.years.max()) - first_year + 1
+        link_years = self.years[self.link_positions] - first_year
+        counts = np.bincount(
+            link_years * len(self.genres) + self.link_genres,
+            minlength=span * len(self.genres))
+        return first_year, counts.reshape(span, len(self.genres))
+
+    # queries
+
+    def genre_index(self, pk):
+        """The interned index of a genre, None if there is no such genre."""
+        index = int(np.searchsorted(self.genre_ids, pk))
+        if index < len(self.genre_ids) and self.genre_ids[index] == pk:
+            return index
+        return None
+
+    def in_genre(self, index):
+        """Boolean array of the movies of the genre at `index`."""
+        members = np.zeros(len(self.movie_ids), dtype=bool)
+        members[self.link_positions[self.link_genres == index]] = True
+        return members
+
+    def movie_positions(self, genres=(), genres_all=(), genres_none=()):
+        """
+        Positions of the movies of any of `genres`, all of `genres_all` and
+        none of `genres_none`, given as genre indexes, newest first.
+        """
+        selected = np.ones(len(self.movie_ids), dtype=bool)
+        if genres:
+            selected &= np.logical_or.reduce(
+                [self.in_genre(index) for index in genres])
+        for index in genres_all:
+            selected &= self.in_genre(index)
+        for index in genres_none:
+            selected &= ~self.in_genre(index)
+        order = self.newest_first
+        return order[selected[order]]
+
+    def franchise_id(self, title):
+        """
+        The franchise of a title: the one whose root is the shortest of
+        its prefixes with a franchise, like `denorm.franchise_roots()`.
+        """
+        for end in range(1, len(title) + 1):
+            if title[:end] in self.franchises:
+                return self.franchises[title[:end]]
+        return None
+
+    def movies(self, positions, fields=None):
+        """
+        Movies at `positions`, with their genres, sequel counts and
+        franchises unless `fields` names the only fields needed without
+        them.
+        """
+        titles = self.titles[positions]
+        ids = self.movie_ids[positions]
+        sequels = fields is None or 'sequels_count' in fields
+        if sequels:
+            starts = np.searchsorted(self.sorted_titles, titles)
+            ends = np.searchsorted(self.sorted_titles, object_array(
+                [t + MAX_CHAR for t in titles]))
+        genres = fields is None or 'genres' in fields
+        if genres:
+            link_starts = np.searchsorted(self.link_movies, ids)
+            link_ends = np.searchsorted(self.link_movies, ids, side='right')
+            rank = np.argsort(self.genres_by_name)
+
+        movies = []
+        for i, position in enumerate(positions):
+            movie = Movie(
+                pk=int(ids[i]), title=titles[i],
+                release_date=self.dates[position].item())
+            if sequels:
+                movie.sequels_count = int(ends[i] - starts[i] - 1)
+            if fields is None or 'franchise' in fields:
+                movie.franchise_id = self.franchise_id(titles[i])
+            if genres:
+                indexes = self.link_genres[link_starts[i]:link_ends[i]]
+                prefetch_genres(movie, [self.genres[index] for index in
+                                        sorted(indexes, key=rank.__getitem__)])
+            movies.append(movie)
+        return movies
+
+    def genre_list(self):
+        """Genres by name, with their movie counts."""
+        return [Genre(pk=self.genres[index].pk, name=self.genres[index].name,
+                      movie_count=int(self.genre_counts[index]))
+                for index in self.genres_by_name]
+
+    def top_genres(self, years=None, year_from=None, year_to=None):
+        """
+        `GenreYearStat`s of the genre with the most movies each year, by
+        year, ties going to the first genre by name.
+        """
+        first_year, counts = self.genre_year_counts
+        selected = np.arange(first_year, first_year + len(counts))
+        if years is not None:
+            selected = selected[np.isin(selected, list(years))]
+        if year_from is not None:
+            selected = selected[selected >= year_from]
+        if year_to is not None:
+            selected = selected[selected <= year_to]
+
+        by_name = counts[selected - first_year][:, self.genres_by_name]
+        best = by_name.argmax(axis=1) if len(self.genres) else []
+        stats = []
+        for year, row, column in zip(selected, by_name, best):
+            if row[column]:
+                stats.append(GenreYearStat(
+                    year=int(year), movie_count=int(row[column]),
+                    genre=self.genres[self.genres_by_name[column]]))
+        return stats
+
+
+class MovieRows(object):
+    """Movies at positions of a catalog, as a sequence to paginate."""
+
+    def __init__(self, catalog, positions, fields=None):
+        self.catalog = catalog
+        self.positions = positions
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.catalog.movies(self.positions[index], self.fields)
+        return self.catalog.movies(self.positions[[index]], self.fields)[0]
+
+
+class ReadModel(object):
+    """The latest catalog of a database, refreshed on data changes."""
+
+    def __init__(self, using):
+        self.using = using
+        self.lock = threading.Lock()
+        self.catalog = None
+
+    def get(self):
+        # one indexed query, seeing the writes of every process
+        change_id = latest_change_id(using=self.using)
+        if self.catalog is None or self.catalog.change_id < change_id:
+            with self.lock:
+                # another thread may have refreshed it past change_id
+                if self.catalog is None or self.catalog.change_id < change_id:
+                    self.catalog = self.refresh(self.catalog)
+        return self.catalog
+
+    def refresh(self, catalog):
+        if catalog is None:
+            return Catalog.load(using=self.using)
+        changes = list(DataChange.objects.using(self.using).filter(
+            id__gt=catalog.change_id).order_by('id').values_list(
+                'id', 'movie_id', 'genre_id'))
+        if not changes:
+            return catalog
+        # changes up to KEEP_CHANGES before the last one are still there
+        if (catalog.change_id < changes[-1][0] - KEEP_CHANGES or
+                any(movie_id is None and genre_id is None
+                    for pk, movie_id, genre_id in changes)):
+            return Catalog.load(using=self.using)
+        return catalog.apply(changes, using=self.using)
+
+
+def get_catalog(using=DEFAULT_DB_ALIAS):
+    """The current catalog of a database, None if the model is off."""
+    if not is_enabled():
+        return None
+    if using not in _read_models:
+        _read_models.setdefault(using, ReadModel(using))
+    return _read_models[using].get()
+
+
+def reset():
+    """Drop the catalogs of this process, e.g. after a database reset."""
+    _read_models.clear()
+
+
+def movie_filters(catalog, params):
+    """
+    Return the `Catalog.movie_positions()` arguments of the query
+    parameters of a movie list, None if the catalog can't answer it.
+    """
+    filters = {}
+    for name in params:
+        if name in ('page', 'format', 'fields', 'exclude'):
+            continue
+        if name not in ('genres', 'genres_all', 'genres_none'):
+            return None
+        indexes = []
+        for value in params.getlist(name):
+            try:
+                index = catalog.genre_index(int(value))
+            except ValueError:
+                index = None
+            if index is None:
+                # answered by the filter set, with its errors
+                return None
+            indexes.append(index)
+        filters[name] = indexes
+    return filters
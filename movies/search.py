@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Full text search of movie titles with an SQLite FTS5 index.
+
+The index is a separate virtual table keyed by movie id, created by a
+migration and kept in sync through `movies.denorm` like the other derived
+data. Queries join it through the unmanaged `MovieTitleSearch` model.
+Other database backends fall back to unindexed LIKE matching.
+"""
+from __future__ import unicode_literals
+
+import re
+
+from django.apps import apps as global_apps
+from django.db import DEFAULT_DB_ALIAS, connections
+
+FTS_TABLE = 'movies_movie_fts'
+
+# index prefixes of 2 and 3 characters to speed up short prefix queries
+CREATE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5("
+    "title, prefix='2 3', tokenize='unicode61 remove_diacritics 1')"
+).format(FTS_TABLE)
+DROP_SQL = 'DROP TABLE IF EXISTS {}'.format(FTS_TABLE)
+
+# tokens as split by the unicode61 tokenizer
+TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def is_supported(connection):
+    return connection.vendor == 'sqlite'
+
+
+def rebuild_title_search(apps=global_apps, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if not is_supported(connection):
+        return
+
+    table = apps.get_model('movies', 'Movie')._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_SQL)
+        cursor.execute('DELETE FROM {}'.format(FTS_TABLE))
+        cursor.execute(
+            'INSERT INTO {} (rowid, title) SELECT id, title FROM {}'.format(
+                FTS_TABLE, connection.ops.quote_name(table)))
+        cursor.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(
+            FTS_TABLE))
+
+
+def index_titles(movies, using=DEFAULT_DB_ALIAS):
+    """Add or replace the index entries of the given movies."""
+    connection = connections[using]
+    if not is_supported(connection) or not movies:
+        return
+
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE),
+            [(movie.pk,) for movie in movies])
+        cursor.executemany(
+            'INSERT INTO {} (rowid, title) VALUES (%s, %s)'.format(FTS_TABLE),
+            [(movie.pk, movie.title) for movie in movies])
+
+
+def unindex_titles(pks, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if not is_supported(connection) or not pks:
+        return
+
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE),
+            [(pk,) for pk in pks])
+
+
+def filter_titles(queryset, text, prefix=False):
+    """
+    Filter movies whose title contains all the words of `text`, or with
+    `prefix` starts with them, best matches first. A trailing `*` in a
+    word search matches the last word as a prefix.
+    """
+    tokens = TOKEN_RE.findall(text.lower())
+    if not tokens:
+        return queryset.none()
+
+    connection = connections[queryset.db]
+    if not is_supported(connection):
+        if prefix:
+            return queryset.filter(title__istartswith=text)
+        for token in tokens:
+            queryset = queryset.filter(title__icontains=token)
+        return queryset
+
+    if prefix:
+        # a phrase anchored on the first token, the last one as a prefix
+        match = '^"{}"*'.format(' '.join(tokens))
+    else:
+        match = ' '.join('"{}"'.format(token) for token in tokens)
+        if text.rstrip().endswith('*'):
+            match += '*'
+
+    return queryset.filter(title_search__title__match=match).order_by(
+        'title_search__rank', *queryset.query.order_by)
@@ -1,17 +1,100 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import six
 from rest_framework import serializers
 
-from movies.models import Movie, Genre
+from movies.models import Movie, Genre, GenreYearStat, Franchise
 
+URL_PLACEHOLDER = '00000placeholder00000'
+
+
+class CachedHyperlinkedRelatedField(serializers.HyperlinkedRelatedField):
+    """
+    Builds hyperlinks from a URL template reversed once per view name and
+    format, instead of resolving the URL for every related object. The
+    field instance is shared by every row of a list, so the template is
+    too. Output is identical to `HyperlinkedRelatedField`.
+    """
+
+    def get_url(self, obj, view_name, request, format):
+        if hasattr(obj, 'pk') and obj.pk in (None, ''):
+            return None
+
+        lookup_value = getattr(obj, self.lookup_field)
+        if not isinstance(lookup_value, six.integer_types):
+            return super(CachedHyperlinkedRelatedField, self).get_url(
+                obj, view_name, request, format)
+
+        templates = self.__dict__.setdefault('_url_templates', {})
+        key = (view_name, format, request)
+        if key not in templates:
+            templates[key] = self.reverse(
+                view_name, kwargs={self.lookup_url_kwarg: URL_PLACEHOLDER},
+                request=request, format=format)
+        return templates[key].replace(URL_PLACEHOLDER, str(lookup_value))
+
+    def get_object(self, view_name, view_args, view_kwargs):
+        # related objects loaded up front, by batch writes, saves a query
+        # per hyperlink
+        objects = self.context.get('related_objects', {}).get(
+            self.queryset.model)
+        if objects is None or self.lookup_field != 'pk':
+            return super(CachedHyperlinkedRelatedField, self).get_object(
+                view_name, view_args, view_kwargs)
+        try:
+            return objects[int(view_kwargs[self.lookup_url_kwarg])]
+        except KeyError:
+            raise ObjectDoesNotExist
+
+
+class SparseFieldsMixin(object):
+    """
+    Takes a `fields` argument naming the only fields to serialize, as
+    given by the `fields` and `exclude` query parameters of a list.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class MovieSerializer(SparseFieldsMixin,
+                      serializers.HyperlinkedModelSerializer):
+    serializer_related_field = CachedHyperlinkedRelatedField
+    # not editable, which would otherwise make it a plain read only field
+    franchise = CachedHyperlinkedRelatedField(
+        view_name='franchise-detail', read_only=True)
 
-class MovieSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Movie
-        fields = ('title', 'release_date', 'genres', 'sequels_count')
+        fields = ('title', 'release_date', 'genres', 'sequels_count',
+                  'franchise')
 
 
-class GenreSerializer(serializers.HyperlinkedModelSerializer):
+class GenreSerializer(SparseFieldsMixin,
+                      serializers.HyperlinkedModelSerializer):
+    serializer_related_field = CachedHyperlinkedRelatedField
     movie_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Genre
         fields = ('name', 'movie_count')
+
+
+class FranchiseSerializer(SparseFieldsMixin,
+                          serializers.HyperlinkedModelSerializer):
+    serializer_related_field = CachedHyperlinkedRelatedField
+
+    class Meta:
+        model = Franchise
+        fields = ('url', 'title', 'movie_count')
+
+
+class GenreYearStatSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source='genre.name')
+
+    class Meta:
+        model = GenreYearStat
+        fields = ('year', 'name', 'movie_count')
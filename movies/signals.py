@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save)
+from django.dispatch import receiver
+
+from movies import denorm, readmodel, search
+from movies.cache import bump_data_version
+from movies.models import Movie, Genre
+
+
+# fixture loads are handled too (no `raw` check), since denormalized
+# fields are not serialized
+
+
+@receiver(pre_save, sender=Movie)
+def movie_pre_save(sender, instance, using, **kwargs):
+    # the stored row, instances in memory may be stale
+    instance._previous = None
+    if instance.pk is not None:
+        instance._previous = Movie.objects.using(using).filter(
+            pk=instance.pk).values(
+                'title', 'release_date', 'sequels_count', 'genre_mask',
+                'franchise_id').first()
+    # keep denormalized values maintained since the instance was loaded
+    if instance._previous is not None:
+        instance.sequels_count = instance._previous['sequels_count']
+        instance.genre_mask = instance._previous['genre_mask']
+        instance.franchise_id = instance._previous['franchise_id']
+
+
+@receiver(post_save, sender=Movie)
+def movie_post_save(sender, instance, created, using, **kwargs):
+    previous = instance._previous
+    if created or previous is None:
+        denorm.index_title(instance, using=using)
+        search.index_titles([instance], using=using)
+        update_franchise(instance, [instance.title], using)
+        return
+
+    if previous['title'] != instance.title:
+        denorm.unindex_title(instance, previous['title'], using=using)
+        denorm.index_title(instance, using=using)
+        search.index_titles([instance], using=using)
+        update_franchise(instance, [previous['title'], instance.title], using)
+    # the value assigned may be a string or a datetime
+    release_date = sender._meta.get_field('release_date').to_python(
+        instance.release_date)
+    if previous['release_date'].year != release_date.year:
+        denorm.move_year(
+            instance.pk, previous['release_date'].year, release_date.year,
+            using=using)
+
+
+def update_franchise(instance, titles, using):
+    denorm.update_franchises(titles, using=using)
+    instance.franchise_id = Movie.objects.using(using).filter(
+        pk=instance.pk).values_list('franchise_id', flat=True).first()
+
+
+@receiver(pre_delete, sender=Movie)
+def movie_pre_delete(sender, instance, using, **kwargs):
+    # links are removed by the deletion without any m2m_changed signal
+    denorm.update_links(
+        denorm.movie_links([instance.pk], using=using), -1, using=using)
+
+
+@receiver(post_delete, sender=Movie)
+def movie_post_delete(sender, instance, using, **kwargs):
+    denorm.unindex_title(instance, instance.title, using=using)
+    denorm.update_franchises([instance.title], using=using)
+    search.unindex_titles([instance.pk], using=using)
+
+
+@receiver(pre_save, sender=Genre)
+def genre_pre_save(sender, instance, using, **kwargs):
+    # keep the stored denormalized values, the instance may be stale or
+    # deserialized without them
+    previous = None
+    if instance.pk is not None:
+        previous = Genre.objects.using(using).filter(
+            pk=instance.pk).values('movie_count', 'bit').first()
+    if previous is not None:
+        instance.movie_count = previous['movie_count']
+        instance.bit = previous['bit']
+    # a bit freed since the genre was created, its movies don't have it
+    instance._filled_bit = None
+    if instance.bit is None:
+        instance.bit = denorm.free_genre_bit(using=using)
+        if previous is not None:
+            instance._filled_bit = instance.bit
+
+
+@receiver(post_save, sender=Genre)
+def genre_post_save(sender, instance, using, **kwargs):
+    if instance._filled_bit is not None:
+        denorm.fill_genre_bits({instance.pk: instance.bit}, using=using)
+
+
+@receiver(pre_delete, sender=Genre)
+def genre_pre_delete(sender, instance, using, **kwargs):
+    denorm.clear_genre_bit(instance, using=using)
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+def movie_genres_changed(sender, instance, action, reverse, pk_set, using,
+                         **kwargs):
+    if action == 'post_add':
+        if reverse:
+            links = [(movie_id, instance.pk) for movie_id in pk_set]
+        else:
+            links = [(instance.pk, genre_id) for genre_id in pk_set]
+        denorm.update_links(links, 1, using=using)
+
+    elif action in ('pre_remove', 'pre_clear'):
+        # only links that are actually stored are removed
+        links = sender.objects.using(using)
+        if reverse:
+            links = links.filter(genre_id=instance.pk)
+            if pk_set is not None:
+                links = links.filter(movie_id__in=pk_set)
+        else:
+            links = links.filter(movie_id=instance.pk)
+            if pk_set is not None:
+                links = links.filter(genre_id__in=pk_set)
+        denorm.update_links(
+            links.values_list('movie_id', 'genre_id'), -1, using=using)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Movie)
+@receiver(post_delete, sender=Genre)
+def data_changed(sender, using, **kwargs):
+    bump_data_version(using=using)
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+def movie_genres_data_changed(sender, action, using, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_data_version(using=using)
+
+
+@receiver(post_save, sender=Movie)
+@receiver(post_delete, sender=Movie)
+def movie_changed(sender, instance, using, **kwargs):
+    readmodel.log_changes(movie_ids=[instance.pk], using=using)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def genre_changed(sender, instance, using, **kwargs):
+    readmodel.log_changes(genre_ids=[instance.pk], using=using)
+
+
+@receiver(m2m_changed, sender=Movie.genres.through)
+def movie_genres_logged(sender, instance, action, reverse, pk_set, using,
+                        **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        readmodel.log_changes(movie_ids=[instance.pk], using=using)
+    elif pk_set is not None:
+        readmodel.log_changes(movie_ids=pk_set, using=using)
+    else:
+        # the movies of a cleared genre are not known anymore
+        readmodel.log_reload(using=using)
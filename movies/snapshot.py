@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of the movie catalog, to bootstrap a database quickly.
+
+A snapshot is a compressed NumPy ``.npz`` archive with an array per
+column of the movie, genre, genre link, franchise and genre year
+statistics tables, denormalized columns included. Text columns are
+stored as one UTF-8 buffer with the end offset of each value. Restoring
+replaces the stored catalog with batched inserts, building the secondary
+indexes once at the end on SQLite, and only recomputes the title search
+index.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+import numpy as np
+
+from movies import readmodel, search
+from movies.cache import bump_data_version
+from movies.models import (
+    Movie, Genre, GenreYearStat, DataFile, Franchise)
+
+# bumped whenever the layout of the archive changes
+VERSION = 1
+
+FETCH_SIZE = 10000
+
+INTEGER_TYPES = {
+    'AutoField', 'BigIntegerField', 'ForeignKey', 'IntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField', 'SmallIntegerField',
+}
+TEXT_TYPES = {'CharField', 'TextField'}
+DATE_TYPES = {'DateField'}
+
+
+def snapshot_models():
+    """Models in the order their tables are restored."""
+    return [Genre, Franchise, Movie, Movie.genres.through, GenreYearStat]
+
+
+def column_kind(field):
+    field_type = field.get_internal_type()
+    if field_type in INTEGER_TYPES:
+        return 'integer'
+    if field_type in TEXT_TYPES:
+        return 'text'
+    if field_type in DATE_TYPES:
+        return 'date'
+    raise ValueError('Cannot snapshot {} {}'.format(field_type, field))
+
+
+def encode_text(values):
+    data = [value.encode('utf-8') for value in values]
+    ends = np.cumsum([len(value) for value in data], dtype=np.int64)
+    return np.frombuffer(b''.join(data), dtype=np.uint8), ends
+
+
+def decode_text(buffer, ends):
+    data = buffer.tobytes()
+    starts = [0] + ends[:-1].tolist()
+    return [data[start:end].decode('utf-8')
+            for start, end in zip(starts, ends.tolist())]
+
+
+def dump_table(model, cursor, connection):
+    """Return the {name: array} of the columns of a model's table."""
+    quote_name = connection.ops.quote_name
+    fields = model._meta.concrete_fields
+    # dates as text, to parse them all at once
+    cursor.execute('SELECT {} FROM {} ORDER BY {}'.format(
+        ', '.join(
+            'CAST({} AS TEXT)'.format(quote_name(field.column))
+            if column_kind(field) == 'date' else quote_name(field.column)
+            for field in fields),
+        quote_name(model._meta.db_table),
+        quote_name(model._meta.pk.column)))
+    columns = [[] for field in fields]
+    for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+
+    arrays = {}
+    for field, values in zip(fields, columns):
+        name = '{}.{}'.format(model._meta.db_table, field.column)
+        kind = column_kind(field)
+        nulls = np.array([value is None for value in values], dtype=bool)
+        if nulls.any():
+            arrays[name + '.nulls'] = nulls
+        if kind == 'text':
+            arrays[name], arrays[name + '.ends'] = encode_text(
+                '' if value is None else value for value in values)
+        elif kind == 'date':
+            arrays[name] = np.array(
+                ['NaT' if value is None else value for value in values],
+                dtype='datetime64[D]')
+        else:
+            arrays[name] = np.array(
+                [0 if value is None else value for value in values],
+                dtype=np.int64)
+    return arrays
+
+
+def dump(path, using=DEFAULT_DB_ALIAS):
+    """Write a snapshot of the catalog. Returns the rows per model."""
+    connection = connections[using]
+    arrays = {'version': np.array(VERSION)}
+    counts = OrderedDict()
+    # one consistent view of all the tables
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for model in snapshot_models():
+            table = dump_table(model, cursor, connection)
+            arrays.update(table)
+            counts[model] = len(table['{}.{}'.format(
+                model._meta.db_table, model._meta.pk.column)])
+    with open(path, 'wb') as output:
+        np.savez_compressed(output, **arrays)
+    return counts
+
+
+def load_table(model, arrays):
+    """Return the column names and rows of a model's table."""
+    names, columns = [], []
+    for field in model._meta.concrete_fields:
+        name = '{}.{}'.format(model._meta.db_table, field.column)
+        if name not in arrays:
+            raise ValueError(
+                'The snapshot has no {} column, it was dumped from another '
+                'version of the models'.format(name))
+        kind = column_kind(field)
+        if kind == 'text':
+            values = decode_text(arrays[name], arrays[name + '.ends'])
+        elif kind == 'date':
+            values = np.datetime_as_string(arrays[name]).tolist()
+        else:
+            values = arrays[name].tolist()
+        if name + '.nulls' in arrays:
+            values = [None if null else value for value, null in zip(
+                values, arrays[name + '.nulls'].tolist())]
+        names.append(field.column)
+        columns.append(values)
+    return names, list(zip(*columns))
+
+
+def deferred_indexes(model, cursor, connection):
+    """
+    Drop the secondary indexes of a model's table on SQLite, returning the
+    statements creating them again. Indexes of unique constraints stay.
+    """
+    if connection.vendor != 'sqlite':
+        return []
+    cursor.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND "
+        "tbl_name = %s AND sql IS NOT NULL", [model._meta.db_table])
+    indexes = cursor.fetchall()
+    for name, sql in indexes:
+        cursor.execute('DROP INDEX {}'.format(connection.ops.quote_name(name)))
+    return [sql for name, sql in indexes]
+
+
+def restore(path, using=DEFAULT_DB_ALIAS):
+    """
+    Replace the catalog with a snapshot. Returns the rows per model.
+    """
+    with np.load(path) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+    if arrays.get('version') != VERSION:
+        raise ValueError('{} is not a version {} snapshot'.format(
+            path, VERSION))
+
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    models = snapshot_models()
+    counts = OrderedDict()
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # bulk deletes, without the signals maintaining denormalized data
+        for model in reversed(models):
+            cursor.execute('DELETE FROM {}'.format(
+                quote_name(model._meta.db_table)))
+        # the loaded files are no longer what the database holds
+        DataFile.objects.using(using).all().delete()
+
+        for model in models:
+            names, rows = load_table(model, arrays)
+            indexes = deferred_indexes(model, cursor, connection)
+            sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                quote_name(model._meta.db_table),
+                ', '.join(quote_name(name) for name in names),
+                ', '.join(['%s'] * len(names)))
+            for start in range(0, len(rows), FETCH_SIZE):
+                cursor.executemany(sql, rows[start:start + FETCH_SIZE])
+            for index in indexes:
+                cursor.execute(index)
+            counts[model] = len(rows)
+
+        # inserting explicit ids doesn't advance sequences on every backend
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+        search.rebuild_title_search(using=using)
+        readmodel.log_reload(using=using)
+        bump_data_version(using=using)
+    return counts
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Genre by year movie counts, as a whole matrix.
+
+The matrix is read in one query from the materialized ``GenreYearStat``
+table, or taken from the read model when it is on, and reshaped with
+NumPy. Results are cached until the data version changes.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import hashlib
+
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.encoding import force_bytes
+import numpy as np
+
+from movies import readmodel
+from movies.cache import get_cache, get_data_version
+from movies.models import Genre, GenreYearStat
+
+
+def select_years(years, lookups):
+    """Boolean array of the `years` matching `views.year_filter` lookups."""
+    selected = np.ones(len(years), dtype=bool)
+    if 'year' in lookups:
+        selected &= years == lookups['year']
+    if 'year__in' in lookups:
+        selected &= np.isin(years, list(lookups['year__in']))
+    if 'year__gte' in lookups:
+        selected &= years >= lookups['year__gte']
+    if 'year__lte' in lookups:
+        selected &= years <= lookups['year__lte']
+    return selected
+
+
+def genre_year_matrix(lookups, genre_ids=None, using=DEFAULT_DB_ALIAS):
+    """
+    Return (years, genres, counts): the years with movies in any of the
+    genres, ascending, the (pk, name) of the genres by name, and a (year,
+    genre) array of movie counts. `genre_ids` restricts the genres,
+    `lookups` the years.
+    """
+    catalog = readmodel.get_catalog(using)
+    if catalog is not None:
+        genres = [(genre.pk, genre.name) for genre in catalog.genres]
+        first_year, counts = catalog.genre_year_counts
+        years = np.arange(first_year, first_year + len(counts))
+    else:
+        genres = list(Genre.objects.using(using).order_by(
+            'pk').values_list('pk', 'name'))
+        stats = GenreYearStat.objects.using(using).filter(**lookups)
+        if genre_ids is not None:
+            stats = stats.filter(genre_id__in=genre_ids)
+        rows = np.array(list(stats.order_by().values_list(
+            'year', 'genre_id', 'movie_count')), dtype=np.int64)
+        rows = rows.reshape(-1, 3)
+        years = np.unique(rows[:, 0])
+        counts = np.zeros((len(years), len(genres)), dtype=np.int64)
+        genre_pks = np.array([pk for pk, name in genres], dtype=np.int64)
+        counts[np.searchsorted(years, rows[:, 0]),
+               np.searchsorted(genre_pks, rows[:, 1])] = rows[:, 2]
+
+    columns = sorted(range(len(genres)), key=lambda i: genres[i][1])
+    if genre_ids is not None:
+        columns = [i for i in columns if genres[i][0] in genre_ids]
+    counts = counts[select_years(years, lookups)][:, columns]
+    years = years[select_years(years, lookups)]
+    # years without any movie of the genres
+    found = counts.any(axis=1)
+    return (years[found], [genres[i] for i in columns], counts[found])
+
+
+def top_columns(counts, top):
+    """
+    The columns of the `top` genres of each row of `counts`, most movies
+    first. Genres tied with the last one make it too, so rows may be
+    longer than `top`. Genres without movies never do.
+    """
+    # genres are ordered by name, a stable sort keeps ties that way
+    order = np.argsort(-counts, axis=1, kind='stable')
+    ordered = np.take_along_axis(counts, order, axis=1)
+    # the rank of a count is one more than the number of greater counts
+    ranks = 1 + (ordered[:, np.newaxis, :] > ordered[:, :, np.newaxis]).sum(
+        axis=2)
+    kept = (ranks <= top) & (ordered > 0)
+    return [row[mask].tolist() for row, mask in zip(order, kept)]
+
+
+def genre_year_stats(lookups, genre_ids=None, top=None,
+                     using=DEFAULT_DB_ALIAS):
+    """
+    Return the matrix in a columnar layout, with the top genres of each
+    year if `top` is given, from the cache when the data didn't change.
+    """
+    arguments = [get_data_version()[0], using, top] + [
+        (name, sorted(value) if isinstance(value, set) else value)
+        for name, value in sorted(lookups.items())]
+    if genre_ids is not None:
+        arguments.append(sorted(genre_ids))
+    key = 'movies:stats:{}'.format(
+        hashlib.md5(force_bytes(repr(arguments))).hexdigest())
+    cache = get_cache()
+    stats = cache.get(key)
+    if stats is None:
+        years, genres, counts = genre_year_matrix(
+            lookups, genre_ids=genre_ids, using=using)
+        stats = OrderedDict([
+            ('years', years.tolist()),
+            ('genres', OrderedDict([
+                ('id', [pk for pk, name in genres]),
+                ('name', [name for pk, name in genres]),
+            ])),
+            ('counts', counts.tolist()),
+        ])
+        if top is not None:
+            stats['top'] = top_columns(counts, top)
+        cache.set(key, stats)
+    return stats
@@ -6,8 +6,12 @@ from movies import views
 router = routers.DefaultRouter()
 router.register(r'movies', views.MovieViewSet)
 router.register(r'genres', views.GenreViewSet)
+router.register(r'franchises', views.FranchiseViewSet)
 
 urlpatterns = [
     url(r'^', include(router.urls)),
-    url(r'^topGenreByYear/', views.topGenreByYearView)
+    url(r'^topGenreByYear/', views.topGenreByYearView),
+    url(r'^stats/genresByYear/$', views.genreYearStatsView),
+    url(r'^stats/topGenresByYear/$', views.genreYearStatsView, {'top': 1}),
+    url(r'^export/movies\.(?P<format>ndjson|csv)$', views.exportMoviesView),
 ]
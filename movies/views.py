@@ -1,53 +1,474 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from datetime import date
+from collections import OrderedDict
 
-from django.db.models import Count
+from django.db import IntegrityError, router, transaction
+from django.http import StreamingHttpResponse
+from django.utils import six
+from django.views.decorators.http import require_GET
 from rest_framework import viewsets
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, list_route
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.response import Response
+from rest_framework.serializers import as_serializer_error
+from rest_framework.validators import UniqueValidator
 from django_filters import rest_framework as filters
 
-from movies.models import Movie, Genre
-from movies.serializers import MovieSerializer, GenreSerializer
+from movies import bulk, denorm, readmodel, stats
+from movies.cache import bump_data_version
+from movies.export import CONTENT_TYPES, export_movies
+from movies.filters import FranchiseFilter, MovieFilter
+from movies.models import Movie, Genre, GenreYearStat, Franchise
+from movies.pagination import ReleaseDateCursorPagination
+from movies.serializers import (
+    CachedHyperlinkedRelatedField, MovieSerializer, GenreSerializer,
+    FranchiseSerializer, GenreYearStatSerializer)
 
+BATCH_ACTIONS = ('create', 'update', 'delete')
 
-class MovieViewSet(viewsets.ModelViewSet):
-    queryset = Movie.objects.all().order_by('-release_date')
+YEAR_PARAMS = ('year', 'years', 'year_from', 'year_to')
+
+# years of a `years` list, kept under SQLite's limit of query parameters
+MAX_YEARS = 200
+
+
+class BatchUniqueValidator(UniqueValidator):
+    """
+    A `UniqueValidator` checking against the `existing` {value: pk} read
+    for all the items of a batch at once.
+    """
+
+    def __init__(self, validator, existing):
+        super(BatchUniqueValidator, self).__init__(
+            validator.queryset, message=validator.message)
+        self.existing = existing
+
+    def __call__(self, value):
+        pk = self.existing.get(value)
+        if pk is not None and (self.instance is None or
+                               pk != self.instance.pk):
+            raise ValidationError(self.message, code='unique')
+
+
+class BatchMixin(object):
+    """
+    Adds a `batch` route applying a list of actions in one transaction:
+
+        [{"action": "create", "data": {...}},
+         {"action": "update", "id": 1, "data": {...}},
+         {"action": "delete", "id": 2}]
+
+    Updates are partial. Every item is validated by the serializer first,
+    and if any is invalid nothing is applied. Deletes go through the usual
+    cascade and signals. Creates and updates are written with bulk
+    statements by `perform_batch_save(creates, updates, using)`, which
+    views define: given the validated data of each create and (instance,
+    data) pairs of the updates, it saves them to the `using` database and
+    returns the created objects, in the order of `creates`.
+    """
+    batch_max_size = 10000
+
+    @list_route(methods=['post'])
+    def batch(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({'message': 'Expected a list of actions'},
+                            status=400)
+        if len(items) > self.batch_max_size:
+            return Response({'message': 'Expected at most {} actions'.format(
+                self.batch_max_size)}, status=400)
+
+        db = router.db_for_write(self.get_queryset().model)
+        queryset = self.get_queryset().using(db).prefetch_related(None)
+        ids = {item.get('id') for item in items
+               if isinstance(item, dict) and is_batch_id(item.get('id'))}
+        instances = {}
+        for chunk in denorm.chunked(ids):
+            instances.update(queryset.in_bulk(chunk))
+
+        context = self.get_serializer_context()
+        context['related_objects'] = self.batch_related_objects()
+        serializer_class = self.get_serializer_class()
+        # one serializer per kind of action validates every item, like a
+        # list serializer does, instead of building one per item
+        serializers = {
+            'create': serializer_class(context=context),
+            'update': serializer_class(context=context, partial=True),
+        }
+        self.batch_unique_validators(serializers, items, queryset)
+
+        results = []
+        creates, updates, deletes = [], [], []
+        seen = set()
+        for item in items:
+            result = self.validate_batch_item(
+                item, serializers, instances, seen)
+            results.append(result)
+            if 'errors' in result:
+                continue
+            if item['action'] == 'create':
+                creates.append(result.pop('data'))
+            elif item['action'] == 'update':
+                updates.append((result['instance'], result.pop('data')))
+            else:
+                deletes.append(result['instance'])
+
+        if any('errors' in result for result in results):
+            for result in results:
+                if 'errors' not in result:
+                    result.clear()
+                    result.update(status=424, errors={
+                        'detail': 'Not applied, the batch has invalid items.'})
+            return Response({'results': results}, status=400)
+
+        try:
+            with transaction.atomic(using=db):
+                for chunk in denorm.chunked(obj.pk for obj in deletes):
+                    queryset.model.objects.using(db).filter(
+                        pk__in=chunk).delete()
+                created = iter(self.perform_batch_save(creates, updates, db))
+                bump_data_version(using=db)
+        except IntegrityError as exc:
+            return Response({'message': 'Conflicting batch: {}'.format(exc)},
+                            status=409)
+
+        for item, result in zip(items, results):
+            instance = result.pop('instance', None) or next(created)
+            result['id'] = instance.pk
+        return Response({'results': results})
+
+    def validate_batch_item(self, item, serializers, instances, seen):
+        """Return the result of an item, with its `instance` and `data`."""
+        if (not isinstance(item, dict) or
+                item.get('action') not in BATCH_ACTIONS):
+            return {'status': 400, 'errors': {'action': [
+                'Expected one of {}.'.format(', '.join(BATCH_ACTIONS))]}}
+
+        action = item['action']
+        instance = None
+        if action != 'create':
+            if item.get('id') is None:
+                return {'status': 400,
+                        'errors': {'id': ['This field is required.']}}
+            if not is_batch_id(item['id']):
+                return {'status': 400,
+                        'errors': {'id': ['A valid integer is required.']}}
+            if item['id'] in seen:
+                return {'status': 400, 'errors': {
+                    'id': ['Appears more than once in the batch.']}}
+            instance = instances.get(item['id'])
+            if instance is None:
+                return {'status': 404, 'errors': {'detail': 'Not found.'}}
+            seen.add(item['id'])
+
+        if action == 'delete':
+            return {'status': 204, 'instance': instance}
+
+        serializer = serializers[action]
+        serializer.instance = instance
+        try:
+            data = serializer.run_validation(item.get('data', {}))
+        except ValidationError as exc:
+            return {'status': 400, 'errors': as_serializer_error(exc)}
+        if action == 'create':
+            return {'status': 201, 'data': data}
+        return {'status': 200, 'instance': instance, 'data': data}
+
+    def batch_unique_validators(self, serializers, items, queryset):
+        """
+        Check unique fields with a query per field for the whole batch,
+        instead of a query per item.
+        """
+        for name, field in serializers['create'].fields.items():
+            if not any(isinstance(validator, UniqueValidator) and
+                       validator.lookup == 'exact'
+                       for validator in field.validators):
+                continue
+            values = set()
+            for item in items:
+                data = item.get('data') if isinstance(item, dict) else None
+                if not isinstance(data, dict) or name not in data:
+                    continue
+                try:
+                    values.add(field.to_internal_value(data[name]))
+                except (ValidationError, TypeError):
+                    pass
+            source = field.source_attrs[-1]
+            existing = {}
+            for chunk in denorm.chunked(values):
+                existing.update(queryset.filter(**{
+                    source + '__in': chunk}).values_list(source, 'pk'))
+            for serializer in serializers.values():
+                field = serializer.fields[name]
+                field.validators = [
+                    BatchUniqueValidator(validator, existing)
+                    if isinstance(validator, UniqueValidator) and
+                    validator.lookup == 'exact' else validator
+                    for validator in field.validators]
+
+    def batch_related_objects(self):
+        """Load the objects of writable hyperlinked relations, by model."""
+        related = {}
+        for field in self.get_serializer().fields.values():
+            field = getattr(field, 'child_relation', field)
+            if (isinstance(field, CachedHyperlinkedRelatedField) and
+                    not field.read_only):
+                related[field.queryset.model] = field.get_queryset().in_bulk()
+        return related
+
+
+class SparseFieldsetMixin(object):
+    """
+    Serializes only the fields named by a comma separated `fields` query
+    parameter, or all but those of `exclude`, on reads. Model columns of
+    the fields left out are deferred, and their relations not prefetched.
+    """
+
+    def get_fields_param(self):
+        """The names of the fields requested, None for all of them."""
+        if not hasattr(self, '_fields_param'):
+            self._fields_param = None
+            params = self.request.query_params
+            if (self.request.method in SAFE_METHODS and
+                    (params.get('fields') or params.get('exclude'))):
+                self._fields_param = self.parse_fields_param(params)
+        return self._fields_param
+
+    def parse_fields_param(self, params):
+        names = self.get_serializer_class().Meta.fields
+        requested = set(names)
+        if params.get('fields'):
+            requested = set(params['fields'].split(','))
+        excluded = set(params.get('exclude', '').split(',')) - {''}
+        unknown = (requested | excluded) - set(names)
+        if unknown:
+            raise ValidationError({'message': 'Unknown fields: {}'.format(
+                ', '.join(sorted(unknown)))})
+        return [name for name in names
+                if name in requested and name not in excluded]
+
+    def get_queryset(self):
+        queryset = super(SparseFieldsetMixin, self).get_queryset()
+        fields = self.get_fields_param()
+        if fields is None:
+            return queryset
+
+        opts = queryset.model._meta
+        prefetched = [
+            lookup for lookup in queryset._prefetch_related_lookups
+            if getattr(lookup, 'prefetch_through', lookup).split(
+                '__')[0] in fields]
+        # columns read by the ordering, e.g. for the positions of cursors
+        ordering = [name.lstrip('-') for name in
+                    queryset.query.order_by or opts.ordering]
+        columns = {field.name for field in opts.concrete_fields
+                   if field.name in fields or field.name in ordering}
+        return queryset.prefetch_related(None).prefetch_related(
+            *prefetched).only(*columns)
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_fields_param()
+        if fields is not None:
+            kwargs.setdefault('fields', fields)
+        return super(SparseFieldsetMixin, self).get_serializer(
+            *args, **kwargs)
+
+
+class MovieViewSet(SparseFieldsetMixin, BatchMixin, viewsets.ModelViewSet):
+    # fetch genre links of a whole page at once
+    queryset = Movie.objects.prefetch_related('genres').order_by(
+        '-release_date')
     serializer_class = MovieSerializer
     filter_backends = (filters.DjangoFilterBackend,)
-    filter_fields = ('genres',)
+    filter_class = MovieFilter
+
+    @property
+    def paginator(self):
+        """
+        Page numbers by default, keyset pages once a `cursor` parameter is
+        given (empty for the first page).
+        """
+        if not hasattr(self, '_paginator'):
+            cursor_param = ReleaseDateCursorPagination.cursor_query_param
+            if cursor_param in self.request.query_params:
+                self._paginator = ReleaseDateCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def list(self, request, *args, **kwargs):
+        catalog = readmodel.get_catalog(router.db_for_read(Movie))
+        filters = catalog and readmodel.movie_filters(
+            catalog, request.query_params)
+        if filters is None:
+            return super(MovieViewSet, self).list(request, *args, **kwargs)
 
+        movies = readmodel.MovieRows(
+            catalog, catalog.movie_positions(**filters),
+            fields=self.get_fields_param())
+        page = self.paginate_queryset(movies)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
-class GenreViewSet(viewsets.ModelViewSet):
-    queryset = Genre.objects.annotate(movie_count=Count('movie'))
+    def perform_batch_save(self, creates, updates, using):
+        return bulk.save_movies(creates, updates, using=using)
+
+
+class GenreViewSet(SparseFieldsetMixin, BatchMixin, viewsets.ModelViewSet):
+    queryset = Genre.objects.all()
     serializer_class = GenreSerializer
 
+    def list(self, request, *args, **kwargs):
+        catalog = readmodel.get_catalog(router.db_for_read(Genre))
+        if catalog is None:
+            return super(GenreViewSet, self).list(request, *args, **kwargs)
+
+        page = self.paginate_queryset(catalog.genre_list())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def perform_batch_save(self, creates, updates, using):
+        return bulk.save_genres(creates, updates, using=using)
+
+
+class FranchiseViewSet(SparseFieldsetMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Franchises by root title, filtered by the genres and release years of
+    their movies. `/api/movies/?franchise=<pk>` lists the movies of one.
+    """
+    queryset = Franchise.objects.all()
+    serializer_class = FranchiseSerializer
+    filter_backends = (filters.DjangoFilterBackend,)
+    filter_class = FranchiseFilter
+
+
+def is_batch_id(value):
+    # booleans are integers too
+    return (isinstance(value, six.integer_types) and
+            not isinstance(value, bool))
+
+
+def year_filter(params):
+    """
+    Return lookups for the years requested by `year`, a comma separated
+    `years` list or a `year_from`/`year_to` range. Raises ValueError with
+    the message to respond with.
+    """
+    lookups = {}
+    try:
+        if params.get('years'):
+            lookups['year__in'] = {
+                int(year) for year in params['years'].split(',')}
+        else:
+            if params.get('year_from'):
+                lookups['year__gte'] = int(params['year_from'])
+            if params.get('year_to'):
+                lookups['year__lte'] = int(params['year_to'])
+            if not lookups:
+                lookups['year'] = int(params['year'])
+    except ValueError:
+        raise ValueError('Unexpected year, must be 4 digits')
+    if len(lookups.get('year__in', ())) > MAX_YEARS:
+        raise ValueError('Too many years, at most {}'.format(MAX_YEARS))
+    return lookups
+
 
 @api_view(['GET'])
 def topGenreByYearView(request):
-    year = request.GET.get('year')
+    params = request.GET
+    single = not any(params.get(name) for name in YEAR_PARAMS[1:])
 
-    if not year:
+    if single and not params.get('year'):
         return Response({'message': 'Required `year` query parameter'},
                         status=400)
 
     try:
-        year = int(year)
-    except:
-        return Response({'message': 'Unexpected year, must be 4 digits'},
-                        status=400)
+        lookups = year_filter(params)
+    except ValueError as e:
+        return Response({'message': str(e)}, status=400)
 
-    start = date(int(year)-1, 12, 31)
-    end = date(int(year)+1, 1, 1)
-    top_genre = Genre.objects.filter(
-        movie__release_date__gt=start,
-        movie__release_date__lt=end).annotate(
-            c=Count('name')).order_by('-c').first()
+    catalog = readmodel.get_catalog(router.db_for_read(GenreYearStat))
+    if catalog is not None:
+        years = ([lookups['year']] if 'year' in lookups else
+                 lookups.get('year__in'))
+        top_genres = catalog.top_genres(
+            years=years, year_from=lookups.get('year__gte'),
+            year_to=lookups.get('year__lte'))
+    else:
+        # one indexed read of the materialized statistics for all years,
+        # the first row of each year is its top genre
+        stats = GenreYearStat.objects.filter(**lookups).select_related(
+            'genre').order_by('year', '-movie_count', 'genre__name')
+        top_genres = OrderedDict()
+        for stat in stats:
+            top_genres.setdefault(stat.year, stat)
+        top_genres = list(top_genres.values())
+    serializer = GenreYearStatSerializer(
+        top_genres, many=True, context={'request': request})
 
-    if top_genre:
-        serializer = GenreSerializer(top_genre, context={'request': request})
+    if not single:
         return Response(serializer.data)
+    elif top_genres:
+        return Response(serializer.data[0])
     else:
         return Response({'message': 'No top genre found'}, status=404)
+
+
+@api_view(['GET'])
+def genreYearStatsView(request, top=None):
+    """
+    Movie counts of every genre and year: the `years` and `genres` of the
+    matrix, and its `counts` by year then genre. With `top` (a number of
+    genres), the columns of the genres with the most movies each year,
+    ties included. Years and genres can be restricted like in
+    `topGenreByYearView`, and by a `genres` list of ids.
+    """
+    params = request.GET
+    try:
+        lookups = {}
+        if any(params.get(name) for name in YEAR_PARAMS):
+            lookups = year_filter(params)
+    except ValueError as e:
+        return Response({'message': str(e)}, status=400)
+
+    genre_ids = None
+    if params.get('genres'):
+        try:
+            genre_ids = {int(pk) for pk in ','.join(
+                params.getlist('genres')).split(',')}
+        except ValueError:
+            return Response(
+                {'message': 'Unexpected genres, must be genre ids'},
+                status=400)
+
+    if params.get('top'):
+        try:
+            top = int(params['top'])
+        except ValueError:
+            top = 0
+        if top < 1:
+            return Response(
+                {'message': 'Unexpected top, must be a positive number'},
+                status=400)
+
+    return Response(stats.genre_year_stats(
+        lookups, genre_ids=genre_ids, top=top,
+        using=router.db_for_read(GenreYearStat)))
+
+
+@require_GET
+def exportMoviesView(request, format):
+    """
+    Stream every movie with its genre names, and with `sequels=1` its
+    sequel count, as NDJSON or CSV.
+    """
+    sequels = request.GET.get('sequels') in ('1', 'true')
+    response = StreamingHttpResponse(
+        export_movies(format, sequels=sequels,
+                      using=router.db_for_read(Movie)),
+        content_type=CONTENT_TYPES[format])
+    response['Content-Disposition'] = (
+        'attachment; filename="movies.{}"'.format(format))
+    return response